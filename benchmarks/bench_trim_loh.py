@@ -0,0 +1,73 @@
+"""Benchmark vectorized LOH interval trimming against the per-segment loop.
+
+Compares trim_loh_intervals (searchsorted over per-chromosome LOH SNP
+positions) with the previous iterrows implementation, which scanned the
+whole zygosity table twice per segment. The loop is quadratic, so it is
+timed on the first --n_legacy segments only and extrapolated.
+
+Usage:
+    python benchmarks/bench_trim_loh.py --n_segs 100000 --n_snps 1000000
+"""
+import os
+import sys
+import time
+import tempfile
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # cnv_pipeline from this checkout
+from cnv_pipeline.get_loh_intervals_adtex import trim_loh_intervals
+from generators import synthetic_loh
+
+
+def legacy_trim(z, loh_segs, min_ratio=0.8):
+    """Per-segment loop from the previous trim_loh_intervals, without file output."""
+    z.sort_values(['chrom', 'SNP_loc'], inplace=True)
+    for ind, seg in loh_segs.iterrows():
+        try:
+            l_a = z[(z.chrom == seg.chrom) & (z.SNP_loc > seg.pos_start) & (z.zygosity == 'LOH')].iloc[0]
+        except IndexError:
+            break
+        l_b = z[(z.chrom == seg.chrom) & (z.SNP_loc <= seg.pos_end) & (z.zygosity == 'LOH')].iloc[-1]
+        l_d = l_b.SNP_loc - l_a.SNP_loc
+        s_d = seg.pos_end - seg.pos_start - 1
+        seg_ratio = l_d / s_d if s_d != 0 else 0
+        if l_a.name == l_b.name:
+            loh_segs.loc[seg.name, ['pos_start', 'pos_end']] = (np.nan, np.nan)
+            continue
+        if seg_ratio < min_ratio:
+            loh_segs.loc[seg.name, ['pos_start', 'pos_end']] = (l_a.SNP_loc - 1, l_b.SNP_loc)
+    return loh_segs.dropna()
+
+
+def main():
+    parser = argparse.ArgumentParser("LOH TRIM BENCHMARK")
+    parser.add_argument('--n_segs', help='Number of LOH segments [100000]', type=int, default=100000)
+    parser.add_argument('--n_snps', help='Number of zygosity SNPs [1000000]', type=int, default=1000000)
+    parser.add_argument('--n_legacy', help='Segments timed with the legacy loop [300]', type=int, default=300)
+    args = parser.parse_args()
+
+    print("Building {} segments and {} SNPs.".format(args.n_segs, args.n_snps))
+    z, segs = synthetic_loh(args.n_segs, args.n_snps)
+    with tempfile.TemporaryDirectory() as out_dir:
+        t0 = time.perf_counter()
+        new = trim_loh_intervals(z.copy(), segs.copy(), out_dir=out_dir)
+        t_new = time.perf_counter() - t0
+
+        n_legacy = min(args.n_legacy, len(segs))
+        t0 = time.perf_counter()
+        old = legacy_trim(z.copy(), segs.iloc[:n_legacy].copy())
+        t_old = (time.perf_counter() - t0) * len(segs) / n_legacy
+        new_subset = trim_loh_intervals(z.copy(), segs.iloc[:n_legacy].copy(), out_dir=out_dir)
+    pd.testing.assert_frame_equal(old.reset_index(drop=True), new_subset.reset_index(drop=True),
+                                  check_dtype=False)
+    print("kept {} of {} segments".format(len(new), len(segs)))
+    print("per-segment loop: {:.1f}s (extrapolated from {} segments)".format(t_old, n_legacy))
+    print("vectorized:       {:.2f}s".format(t_new))
+    print("speedup:          {:.0f}x".format(t_old / t_new))
+
+
+if __name__ == '__main__':
+    main()
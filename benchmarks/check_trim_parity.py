@@ -0,0 +1,59 @@
+"""Compare the GATK and python trim_vcf backends on a VCF.
+
+Runs both backends with the same thresholds and checks that they select the
+same records with the same tumor/normal genotype fields. Requires GATK (see
+GATK_ALIAS in README) and a reference FASTA.
+
+Usage:
+    python benchmarks/check_trim_parity.py -v variants.vcf -tid tumor1 -nid normal1 \
+        -R genome.fasta -o parity_dir
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # cnv_pipeline from this checkout
+from cnv_pipeline.baf_from_vcf import read_vcf_header, read_vcf_chunks
+from cnv_pipeline.trim_vcf import trim_vcf
+
+
+def load_records(vcf_path, tumor_id, normal_id):
+    meta, _ = read_vcf_header(vcf_path)
+    df = next(read_vcf_chunks(vcf_path, len(meta)))
+    df = df[['#CHROM', 'POS', 'REF', 'ALT', 'FORMAT', normal_id, tumor_id]]
+    return df.sort_values(['#CHROM', 'POS']).reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser("TRIM PARITY CHECK")
+    parser.add_argument('-v', '--vcf', required=True)
+    parser.add_argument('-tid', '--tumor_id', required=True)
+    parser.add_argument('-nid', '--normal_id', required=True)
+    parser.add_argument('-R', '--ref_fasta', required=True)
+    parser.add_argument('-o', '--out_dir', required=True)
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    records = {}
+    for backend in ['gatk', 'python']:
+        vcf_out = os.path.join(args.out_dir, 'snps_trimmed.{}.vcf'.format(backend))
+        t0 = time.perf_counter()
+        trim_vcf(vcf_in=args.vcf, tumor_id=args.tumor_id, normal_id=args.normal_id,
+                 ref_fasta=args.ref_fasta, vcf_out=vcf_out, backend=backend)
+        print("{} backend: {:.1f}s".format(backend, time.perf_counter() - t0))
+        records[backend] = load_records(vcf_out, args.tumor_id, args.normal_id)
+
+    gatk, python = records['gatk'], records['python']
+    if gatk.equals(python):
+        print("PARITY OK: {} records.".format(len(gatk)))
+        return
+    merged = gatk.merge(python, how='outer', indicator=True)
+    diff = merged[merged._merge != 'both']
+    print("PARITY FAILED: {} differing records.".format(len(diff)))
+    print(diff.head(20).to_string())
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+"""Deterministic synthetic inputs for the benchmarks.
+
+Every generator takes a seed and returns (or writes) identical data for
+identical arguments, so timings from different commits compare like for
+like. Chromosomes and lengths follow hg19 (autosomes and X); records are
+spread over chromosomes in proportion to length and sorted by position.
+
+Import from scripts in this directory (`from generators import ...`), or
+write inputs to disk with:
+
+    python benchmarks/generators.py vcf variants.vcf --n_records 1000000
+    python benchmarks/generators.py adtex adtex_dir --n_segs 10000 --n_snps 500000
+    python benchmarks/generators.py coverage cov_dir --scale exome
+"""
+import os
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # cnv_pipeline from this checkout
+from cnv_pipeline.plot_chr_axis import HG19_CHROM_LENGTHS
+
+GENOME = HG19_CHROM_LENGTHS[:23]  # 1-22, X
+DEFAULT_FORMAT = ('GT', 'AD', 'DP', 'GQ', 'PL')
+PHASED_FORMAT = ('GT', 'AD', 'DP', 'GQ', 'PGT', 'PID', 'PL')
+NORMAL_ID, TUMOR_ID = 'NORMAL', 'TUMOR'
+WRITE_CHUNK_LINES = 1000000
+# per-base coverage presets: (number of targets, mean target length)
+COVERAGE_SCALES = {'small': (10000, 150), 'exome': (200000, 170), 'genome': (1000000, 1000)}
+
+
+def genomic_positions(n, seed=0, genome=GENOME):
+    """n (chrom, 1-based position) pairs, sorted, with chromosomes weighted by length.
+
+    Returns:
+        chrom (np.ndarray): chromosome names (object).
+        pos (np.ndarray): int64 positions, unique within each chromosome.
+    """
+    # Generator.choice samples without replacement without permuting the whole
+    # chromosome, unlike RandomState.choice (seconds and GBs per chromosome)
+    rng = np.random.default_rng(seed)
+    names = np.array([c for c, _ in genome], dtype=object)
+    lengths = np.array([n for _, n in genome], dtype=np.int64)
+    counts = rng.multinomial(n, lengths / lengths.sum())
+    pos = []
+    for count, length in zip(counts, lengths):
+        pos.append(np.sort(rng.choice(length - 1, size=count, replace=False)) + 1)
+    return np.repeat(names, counts), np.concatenate(pos).astype(np.int64)
+
+
+def vcf_records(n_records, sample_ids=(NORMAL_ID, TUMOR_ID), formats=(DEFAULT_FORMAT,), format_p=None,
+                snp_fraction=0.9, het_fraction=0.6, missing_fraction=0.02, seed=0):
+    """Multi-sample VCF records resembling GATK HaplotypeCaller output.
+
+    Args:
+        sample_ids (tuple): sample column names. The first is treated as the
+            normal: its genotype is heterozygous in het_fraction of records,
+            with alt allele fractions around 0.5.
+        formats (tuple): FORMAT layouts, each a tuple of keys. Keys other
+            than GT, AD, DP, GQ, PL, PGT and PID are filled with '.'.
+        format_p (tuple): [optional] probability of each layout. Default uniform.
+        snp_fraction (float): fraction of biallelic SNPs; the rest are indels
+            or multiallelic.
+        missing_fraction (float): fraction of DP and GQ values given as '.'.
+
+    Returns:
+        pd.DataFrame: VCF columns as strings, '#CHROM' through the samples.
+    """
+    rng = np.random.RandomState(seed)
+    chrom, pos = genomic_positions(n_records, seed=seed)
+    bases = np.array(list('ACGT'), dtype=object)
+    ref = bases[rng.randint(0, 4, n_records)]
+    alt = bases[(rng.randint(1, 4, n_records) + np.searchsorted(bases, ref)) % 4]
+    kind = rng.uniform(size=n_records)
+    ref = np.where(kind < snp_fraction, ref, ref + 'T')
+    alt = np.where(kind < snp_fraction + (1 - snp_fraction) / 2, alt, alt + ',T')
+    mq = np.round(rng.uniform(20, 70, n_records), 2)
+    depth = rng.randint(5, 200, n_records)
+    layout = rng.choice(len(formats), size=n_records, p=format_p)
+    df = pd.DataFrame({'#CHROM': chrom, 'POS': pos.astype(str), 'ID': '.', 'REF': ref, 'ALT': alt,
+                       'QUAL': np.round(rng.uniform(30, 5000, n_records), 2).astype(str),
+                       'FILTER': 'PASS',
+                       'INFO': ['AC=1;AF=0.5;AN=2;DP={};MQ={};QD=20.1'.format(d, m) for d, m in zip(depth, mq)],
+                       'FORMAT': np.array([':'.join(f) for f in formats], dtype=object)[layout]})
+    for i, sample_id in enumerate(sample_ids):
+        df[sample_id] = _sample_column(rng, df, layout, formats, normal=i == 0,
+                                       het_fraction=het_fraction, missing_fraction=missing_fraction)
+    return df
+
+
+def write_vcf(vcf_path, n_records, sample_ids=(NORMAL_ID, TUMOR_ID), seed=0, **record_kw):
+    """Write vcf_records to vcf_path, with a minimal meta-information header."""
+    df = vcf_records(n_records, sample_ids=sample_ids, seed=seed, **record_kw)
+    with open(vcf_path, 'w') as out:
+        out.write('##fileformat=VCFv4.2\n')
+        out.write('##INFO=<ID=MQ,Number=1,Type=Float,Description="RMS Mapping Quality">\n')
+        for key, desc in [('GT', 'Genotype'), ('AD', 'Allelic depths'), ('DP', 'Read depth'),
+                          ('GQ', 'Genotype quality')]:
+            out.write('##FORMAT=<ID={},Number=1,Type=String,Description="{}">\n'.format(key, desc))
+        for c, length in GENOME:
+            out.write('##contig=<ID={},length={}>\n'.format(c, length))
+        _write_chunked(df, out, header=True)
+    return vcf_path
+
+
+def synthetic_loh(n_segs, n_snps, seed=0, genome=GENOME):
+    """Zygosity table and LOH segments, as after prep_loh_dataframes.
+
+    Segments tile each chromosome evenly and every segment holds at least
+    one LOH SNP. The remaining SNPs are placed uniformly at random.
+
+    Returns:
+        z (pd.DataFrame): chrom, SNP_loc, zygosity, tumor_BAF.
+        segs (pd.DataFrame): chrom, pos_start (0-based), pos_end, orig_start, orig_end.
+    """
+    from cnv_pipeline.get_loh_intervals_adtex import chroms
+    rng = np.random.RandomState(seed)
+    names = [c for c, _ in genome]
+    lengths = dict(genome)
+    segs_per_chrom = -(-n_segs // len(names))
+    seg_chrom, seg_start, seg_end = [], [], []
+    for c in names:
+        seg_len = lengths[c] // segs_per_chrom
+        starts = np.arange(segs_per_chrom) * seg_len
+        seg_chrom.append(np.repeat(c, segs_per_chrom))
+        seg_start.append(starts)
+        seg_end.append(starts + rng.randint(seg_len // 2, seg_len, segs_per_chrom))
+    segs = pd.DataFrame({'chrom': np.concatenate(seg_chrom), 'pos_start': np.concatenate(seg_start),
+                         'pos_end': np.concatenate(seg_end)}).iloc[:n_segs]
+    n_random = max(n_snps - len(segs), 0)
+    rand_chrom, rand_pos = genomic_positions(n_random, seed=seed, genome=genome)
+    z = pd.DataFrame({'chrom': np.concatenate([rand_chrom, segs.chrom]),
+                      'SNP_loc': np.concatenate([rand_pos, rng.randint(segs.pos_start + 1, segs.pos_end + 1)]),
+                      'zygosity': np.concatenate([rng.choice(['LOH', 'HET', 'ASCNA'], n_random, p=[0.4, 0.4, 0.2]),
+                                                  np.repeat('LOH', len(segs))])})
+    z['tumor_BAF'] = rng.uniform(size=len(z))
+    z.chrom = pd.Categorical(z.chrom, categories=chroms, ordered=True)
+    segs.chrom = pd.Categorical(segs.chrom, categories=chroms, ordered=True)
+    segs['orig_start'] = segs.pos_start
+    segs['orig_end'] = segs.pos_end
+    return z, segs.reset_index(drop=True)
+
+
+def write_adtex_output(adtex_dir, n_segs, n_snps, seed=0):
+    """Write ADTEx-style cnv.result and zygosity/zygosity.res, as read by finalize_loh.
+
+    Returns:
+        tuple: (cnv.result path, zygosity.res path).
+    """
+    rng = np.random.RandomState(seed)
+    z, segs = synthetic_loh(n_segs, n_snps, seed=seed)
+    z = z.sort_values(['chrom', 'SNP_loc'])
+    os.makedirs(os.path.join(adtex_dir, 'zygosity'), exist_ok=True)
+    res_path = os.path.join(adtex_dir, 'zygosity', 'zygosity.res')
+    cnv_path = os.path.join(adtex_dir, 'cnv.result')
+    z[['chrom', 'SNP_loc', 'tumor_BAF', 'zygosity']].to_csv(res_path, sep='\t', index=False)
+    cnv = pd.DataFrame({'chr': segs.chrom.astype(str), 'CNV_start': segs.pos_start + 1,
+                        'CNV_end': segs.pos_end,
+                        'CNV': rng.choice(['loss', 'gain', 'normal'], len(segs))})
+    cnv.to_csv(cnv_path, sep='\t', index=False)
+    return cnv_path, res_path
+
+
+def target_intervals(n_targets, mean_len=150, seed=0):
+    """Sorted, non-overlapping BED targets (chrom, start, end, name)."""
+    rng = np.random.RandomState(seed)
+    chrom, pos = genomic_positions(n_targets, seed=seed)
+    lengths = np.maximum(rng.poisson(mean_len, n_targets), 1)
+    start = pos - 1
+    end = start + lengths
+    # clip each target at the next target's start on the same chromosome
+    same_next = np.r_[chrom[1:] == chrom[:-1], False]
+    end = np.where(same_next, np.minimum(end, np.r_[start[1:], 0]), end)
+    targets = pd.DataFrame({'chrom': chrom, 'start': start, 'end': end,
+                            'name': ['t{}'.format(i) for i in range(n_targets)]})
+    return targets[targets.end > targets.start].reset_index(drop=True)
+
+
+def write_per_base_coverage(out_dir, n_targets=None, mean_len=None, scale='small', mean_depth=60, seed=0):
+    """Write targets.bed and `bedtools coverage -d` style per-base text (cov.txt).
+
+    Args:
+        scale (str): preset from COVERAGE_SCALES, used for n_targets and
+            mean_len when these are not given.
+
+    Returns:
+        tuple: (targets.bed path, cov.txt path, number of bases).
+    """
+    preset_targets, preset_len = COVERAGE_SCALES[scale]
+    targets = target_intervals(n_targets or preset_targets, mean_len or preset_len, seed=seed)
+    rng = np.random.RandomState(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    bed_path = os.path.join(out_dir, 'targets.bed')
+    cov_path = os.path.join(out_dir, 'cov.txt')
+    targets.to_csv(bed_path, sep='\t', index=False, header=False)
+    lengths = (targets.end - targets.start).to_numpy()
+    bounds = np.r_[0, np.cumsum(lengths)]
+    with open(cov_path, 'w') as out:
+        lo = 0
+        while lo < len(targets):  # ~WRITE_CHUNK_LINES bases per chunk
+            hi = max(int(np.searchsorted(bounds, bounds[lo] + WRITE_CHUNK_LINES, side='right')) - 1, lo + 1)
+            chunk = targets.iloc[lo:hi]
+            chunk_lengths = lengths[lo:hi]
+            rep = chunk.loc[chunk.index.repeat(chunk_lengths)]
+            n = len(rep)
+            offsets = np.arange(n) - np.repeat(bounds[lo:hi] - bounds[lo], chunk_lengths)
+            rep = rep.assign(pos=offsets + 1, depth=rng.poisson(mean_depth, n))
+            rep.to_csv(out, sep='\t', index=False, header=False)
+            lo = hi
+    return bed_path, cov_path, int(bounds[-1])
+
+
+def format_columns(n_rows, seed=0):
+    """INFO, FORMAT and sample columns resembling GATK output, as Series."""
+    rng = np.random.RandomState(seed)
+    mq = pd.Series(np.round(rng.uniform(20, 70, n_rows), 2)).astype(str)
+    info = 'AC=1;AF=0.5;AN=2;DP=' + pd.Series(rng.randint(10, 500, n_rows)).astype(str) \
+        + ';MQ=' + mq + ';MQRankSum=0.5'
+    formats = pd.Series(np.where(rng.uniform(size=n_rows) < 0.9, 'GT:AD:DP:GQ:PL', 'GT:AD:DP:GQ:PGT:PID:PL'))
+    n_ref = pd.Series(rng.randint(0, 300, n_rows)).astype(str)
+    n_alt = pd.Series(rng.randint(0, 300, n_rows)).astype(str)
+    sample = '0/1:' + n_ref + ',' + n_alt + ':100:99:'
+    sample = sample.where(formats == 'GT:AD:DP:GQ:PL', sample + '0|1:100_A_G:')
+    sample = sample + '5815,0,1176'
+    return info, formats, sample
+
+
+def _sample_column(rng, df, layout, formats, normal=False, het_fraction=0.6, missing_fraction=0.02):
+    """FORMAT values for one sample, following each record's layout."""
+    n = len(df)
+    if normal:
+        het = rng.uniform(size=n) < het_fraction
+        gt = np.where(het, np.where(rng.uniform(size=n) < 0.1, '0|1', '0/1'),
+                      np.where(rng.uniform(size=n) < 0.5, '0/0', '1/1'))
+        alt_frac = np.where(het, np.clip(rng.normal(0.5, 0.08, n), 0, 1),
+                            np.where(gt == '1/1', 0.98, 0.02))
+    else:
+        gt = np.array(['0/0', '0/1', '1/1', './.'], dtype=object)[rng.choice(4, n, p=[0.2, 0.6, 0.15, 0.05])]
+        alt_frac = rng.uniform(size=n)
+    dp = rng.poisson(60, n)
+    n_alt = rng.binomial(dp, alt_frac)
+    values = {'GT': gt,
+              'AD': pd.Series(dp - n_alt).astype(str) + ',' + pd.Series(n_alt).astype(str),
+              'DP': _with_missing(rng, dp, missing_fraction),
+              'GQ': _with_missing(rng, rng.randint(0, 100, n), missing_fraction),
+              'PL': pd.Series(rng.randint(0, 5000, n)).astype(str) + ',0,'
+                    + pd.Series(rng.randint(0, 5000, n)).astype(str),
+              'PGT': np.where(gt == '0|1', '0|1', '.'),
+              'PID': df.POS + '_' + df.REF + '_' + df.ALT}
+    out = pd.Series(np.empty(n, dtype=object))
+    for i, keys in enumerate(formats):
+        mask = layout == i
+        if not mask.any():
+            continue
+        col = None
+        for key in keys:
+            vals = pd.Series(np.asarray(values.get(key, np.repeat('.', n)), dtype=object)[mask])
+            col = vals if col is None else col + ':' + vals
+        out[mask] = col.to_numpy()
+    return out.to_numpy()
+
+
+def _with_missing(rng, vals, missing_fraction):
+    vals = pd.Series(vals).astype(str).to_numpy(dtype=object)
+    vals[rng.uniform(size=len(vals)) < missing_fraction] = '.'
+    return vals
+
+
+def _write_chunked(df, out, header=False):
+    for lo in range(0, max(len(df), 1), WRITE_CHUNK_LINES):
+        df.iloc[lo:lo + WRITE_CHUNK_LINES].to_csv(out, sep='\t', index=False, header=header and lo == 0)
+
+
+def main():
+    parser = argparse.ArgumentParser("BENCHMARK DATA GENERATORS")
+    parser.add_argument('--seed', help='Random seed [0]', type=int, default=0)
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_vcf = sub.add_parser('vcf', help='Tumor/normal VCF')
+    p_vcf.add_argument('out_path')
+    p_vcf.add_argument('--n_records', help='Number of records [1000000]', type=int, default=1000000)
+    p_vcf.add_argument('--format', help="FORMAT layout, e.g. GT:AD:DP:GQ:PL. Repeatable "
+                                        "[GT:AD:DP:GQ:PL and GT:AD:DP:GQ:PGT:PID:PL]",
+                       action='append', default=[])
+    p_adtex = sub.add_parser('adtex', help='ADTEx cnv.result and zygosity/zygosity.res')
+    p_adtex.add_argument('out_dir')
+    p_adtex.add_argument('--n_segs', help='Number of CNV segments [10000]', type=int, default=10000)
+    p_adtex.add_argument('--n_snps', help='Number of zygosity SNPs [500000]', type=int, default=500000)
+    p_cov = sub.add_parser('coverage', help='Targets BED and per-base coverage text')
+    p_cov.add_argument('out_dir')
+    p_cov.add_argument('--scale', help='Size preset [small]', choices=list(COVERAGE_SCALES), default='small')
+    args = parser.parse_args()
+
+    if args.command == 'vcf':
+        formats = tuple(tuple(f.split(':')) for f in args.format) or (DEFAULT_FORMAT, PHASED_FORMAT)
+        write_vcf(args.out_path, args.n_records, formats=formats, seed=args.seed)
+        print("Wrote {} (samples {}, {})".format(args.out_path, NORMAL_ID, TUMOR_ID))
+    elif args.command == 'adtex':
+        print("Wrote {} and {}".format(*write_adtex_output(args.out_dir, args.n_segs, args.n_snps,
+                                                           seed=args.seed)))
+    else:
+        bed_path, cov_path, n_bases = write_per_base_coverage(args.out_dir, scale=args.scale, seed=args.seed)
+        print("Wrote {} and {} ({} bases)".format(bed_path, cov_path, n_bases))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,384 @@
+"""Per-stage benchmark suite: throughput and peak memory.
+
+Inputs are written once per scale with the deterministic generators in
+generators.py. Each benchmark then runs in a fresh process, so peak RSS
+(ru_maxrss) reflects that stage alone: peak_rss_mb is the process high-water
+mark, rss_growth_mb its growth while the stage ran, above the imports and any
+in-memory inputs. Times are the best of --repeat runs.
+
+Results are written as JSON. Given --baseline (an earlier results file), the
+suite exits with status 1 if any stage is slower or uses more memory than the
+baseline by more than the allowed fractions.
+
+Usage:
+    python benchmarks/run_benchmarks.py --scale small -o bench_new.json
+    python benchmarks/run_benchmarks.py --scale exome --only baf_from_vcf trim_loh_intervals \
+        --baseline bench_main.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)  # cnv_pipeline from this checkout
+import generators
+
+RESULTS_VERSION = 1
+# per-scale input sizes
+SCALES = {
+    'small': dict(n_records=100000, n_segs=2000, n_snps=100000, coverage='small', n_plot_points=200000),
+    'exome': dict(n_records=1000000, n_segs=10000, n_snps=1000000, coverage='exome', n_plot_points=1000000),
+    'genome': dict(n_records=5000000, n_segs=50000, n_snps=5000000, coverage='genome', n_plot_points=5000000),
+}
+CHROMS_STR = ','.join(c for c, _ in generators.GENOME)
+# cohort VCF: one normal shared by several tumors, with records scaled to a similar file size
+COHORT_TUMOR_IDS = tuple('TUMOR{}'.format(i) for i in range(1, 5))
+COHORT_RECORD_FRACTION = 0.4
+# CLI startup: `<cli> -h` runs per timing, and libraries the CLIs must not import before a stage runs
+STARTUP_RUNS = 10
+CLI_MODULES = ('cnv_pipeline.pipeline', 'cnv_pipeline.cohort')
+HEAVY_MODULES = ('numpy', 'pandas', 'pyarrow', 'matplotlib')
+
+
+def write_inputs(data_dir, scale, seed=0):
+    """Write file inputs for a scale to data_dir, reusing existing files.
+
+    Returns:
+        dict: input paths and sizes, passed to each benchmark.
+    """
+    sizes = SCALES[scale]
+    inputs = dict(sizes, data_dir=data_dir, seed=seed)
+    vcf_path = os.path.join(data_dir, 'variants.vcf')
+    if not os.path.exists(vcf_path):
+        print("Writing {} VCF records.".format(sizes['n_records']))
+        generators.write_vcf(vcf_path + '.tmp', sizes['n_records'], seed=seed,
+                             formats=(generators.DEFAULT_FORMAT, generators.PHASED_FORMAT), format_p=(0.9, 0.1))
+        os.replace(vcf_path + '.tmp', vcf_path)
+    inputs['vcf_path'] = vcf_path
+
+    cohort_vcf_path = os.path.join(data_dir, 'cohort.vcf')
+    inputs['n_cohort_records'] = int(sizes['n_records'] * COHORT_RECORD_FRACTION)
+    if not os.path.exists(cohort_vcf_path):
+        print("Writing {} cohort VCF records.".format(inputs['n_cohort_records']))
+        generators.write_vcf(cohort_vcf_path + '.tmp', inputs['n_cohort_records'], seed=seed,
+                             sample_ids=(generators.NORMAL_ID,) + COHORT_TUMOR_IDS)
+        os.replace(cohort_vcf_path + '.tmp', cohort_vcf_path)
+    inputs['cohort_vcf_path'] = cohort_vcf_path
+
+    adtex_dir = os.path.join(data_dir, 'adtex')
+    if not os.path.exists(os.path.join(adtex_dir, 'cnv.result')):
+        print("Writing ADTEx output: {} segments, {} SNPs.".format(sizes['n_segs'], sizes['n_snps']))
+        generators.write_adtex_output(adtex_dir, sizes['n_segs'], sizes['n_snps'], seed=seed)
+    inputs['adtex_dir'] = adtex_dir
+
+    cov_dir = os.path.join(data_dir, 'coverage')
+    cov_path = os.path.join(cov_dir, 'cov.txt')
+    n_bases_path = os.path.join(cov_dir, 'n_bases')
+    if not os.path.exists(n_bases_path):
+        print("Writing {} per-base coverage.".format(sizes['coverage']))
+        _, _, n_bases = generators.write_per_base_coverage(cov_dir, scale=sizes['coverage'], seed=seed)
+        with open(n_bases_path, 'w') as f:
+            f.write(str(n_bases))
+    with open(n_bases_path) as f:
+        inputs['n_bases'] = int(f.read())
+    inputs['cov_path'] = cov_path
+    return inputs
+
+
+# Benchmarks. Each takes the inputs dict and a scratch dir, and returns
+# (untimed setup callable or None, timed callable, number of items, item unit).
+
+def bench_baf_from_vcf(inputs, work_dir):
+    from cnv_pipeline.baf_from_vcf import baf_from_vcf
+
+    def run():
+        baf_from_vcf(inputs['vcf_path'], os.path.join(work_dir, 'baf.txt'),
+                     parquet_path=os.path.join(work_dir, 'saas.parquet'),
+                     tumor_id=generators.TUMOR_ID, normal_id=generators.NORMAL_ID,
+                     chroms_str=CHROMS_STR, chunksize=100000)
+    return None, run, inputs['n_records'], 'records'
+
+
+def bench_trim_vcf(inputs, work_dir):
+    from cnv_pipeline.trim_vcf import trim_vcf
+
+    def run():
+        trim_vcf(vcf_in=inputs['vcf_path'], tumor_id=generators.TUMOR_ID, normal_id=generators.NORMAL_ID,
+                 vcf_out=os.path.join(work_dir, 'snps_trimmed.vcf'), backend='python')
+    return None, run, inputs['n_records'], 'records'
+
+
+def bench_fused_trim_baf(inputs, work_dir):
+    from cnv_pipeline.trim_vcf import iter_selected_snps
+    from cnv_pipeline.baf_from_vcf import baf_from_vcf
+
+    def run():
+        chunks = iter_selected_snps(inputs['vcf_path'], tumor_id=generators.TUMOR_ID,
+                                    normal_id=generators.NORMAL_ID)
+        baf_from_vcf(None, os.path.join(work_dir, 'baf.txt'),
+                     parquet_path=os.path.join(work_dir, 'saas.parquet'),
+                     tumor_id=generators.TUMOR_ID, normal_id=generators.NORMAL_ID,
+                     chroms_str=CHROMS_STR, vcf_chunks=chunks, compact=True)
+    return None, run, inputs['n_records'], 'records'
+
+
+def bench_cohort_baf(inputs, work_dir):
+    from cnv_pipeline.cohort_baf import extract_pairs, PairOutput
+    pairs = [PairOutput(t, generators.NORMAL_ID, os.path.join(work_dir, t + '.baf.txt'),
+                        os.path.join(work_dir, t + '.saas.parquet')) for t in COHORT_TUMOR_IDS]
+
+    def run():
+        extract_pairs(inputs['cohort_vcf_path'], pairs, chroms_str=CHROMS_STR, compact=True)
+    return None, run, inputs['n_cohort_records'] * len(pairs), 'pair records'
+
+
+def bench_cohort_baf_per_pair(inputs, work_dir):
+    """Fused pass once per pair, for comparison with bench_cohort_baf."""
+    from cnv_pipeline.trim_vcf import iter_selected_snps
+    from cnv_pipeline.baf_from_vcf import baf_from_vcf
+
+    def run():
+        for tumor_id in COHORT_TUMOR_IDS:
+            chunks = iter_selected_snps(inputs['cohort_vcf_path'], tumor_id=tumor_id,
+                                        normal_id=generators.NORMAL_ID)
+            baf_from_vcf(None, os.path.join(work_dir, tumor_id + '.baf.txt'),
+                         parquet_path=os.path.join(work_dir, tumor_id + '.saas.parquet'),
+                         tumor_id=tumor_id, normal_id=generators.NORMAL_ID,
+                         chroms_str=CHROMS_STR, vcf_chunks=chunks, compact=True)
+    return None, run, inputs['n_cohort_records'] * len(COHORT_TUMOR_IDS), 'pair records'
+
+
+def bench_prep_loh_dataframes(inputs, work_dir):
+    from cnv_pipeline.get_loh_intervals_adtex import prep_loh_dataframes
+    return None, lambda: prep_loh_dataframes(inputs['adtex_dir']), inputs['n_snps'], 'SNPs'
+
+
+def bench_trim_loh_intervals(inputs, work_dir):
+    from cnv_pipeline.get_loh_intervals_adtex import trim_loh_intervals
+    z, segs = generators.synthetic_loh(inputs['n_segs'], inputs['n_snps'], seed=inputs['seed'])
+    return None, lambda: trim_loh_intervals(z.copy(), segs.copy(), out_dir=work_dir), len(segs), 'segments'
+
+
+def bench_plot_loh(inputs, work_dir):
+    _use_agg()
+    import matplotlib.pyplot as plt
+    from cnv_pipeline.get_loh_intervals_adtex import plot_loh
+    z, segs = generators.synthetic_loh(inputs['n_segs'], inputs['n_plot_points'], seed=inputs['seed'])
+
+    def run():
+        plot_loh(segs.copy(), z, out_dir=work_dir, density=True)
+        plt.close('all')
+    return None, run, len(z), 'SNPs'
+
+
+def bench_plot_case_cnv(inputs, work_dir):
+    _use_agg()
+    import numpy as np
+    import pandas as pd
+    import matplotlib.pyplot as plt
+    from cnv_pipeline.plot_case_cnv import plot_case_cnv
+    n = inputs['n_plot_points']
+    chrom, pos = generators.genomic_positions(n, seed=inputs['seed'])
+    rng = np.random.RandomState(inputs['seed'])
+    baf = pd.DataFrame({'CHROM': chrom, 'POS': pos, 'baf': rng.uniform(size=n), 'lrd': rng.normal(0, 0.5, n)})
+    segs = generators.target_intervals(inputs['n_segs'], mean_len=1000000, seed=inputs['seed'])
+    cnv = pd.DataFrame({'chr': segs.chrom, 'posStart': segs.start + 1, 'posEnd': segs.end,
+                        'CNV': rng.choice(['loss', 'gain', 'LOH', 'normal'], len(segs))})
+    sample_data = {generators.TUMOR_ID: (baf, cnv)}
+
+    def run():
+        for dim in ('lrd', 'baf'):
+            hf, _ = plot_case_cnv('case', tumor_ids=[generators.TUMOR_ID], dim=dim, sample_data=sample_data,
+                                  density=True)
+            hf.savefig(os.path.join(work_dir, 'case_{}.png'.format(dim)))
+        plt.close('all')
+    return None, run, 2 * n, 'points'
+
+
+def bench_coverage_import(inputs, work_dir):
+    from cnv_pipeline.coverage_store import text_to_coverage_store
+    store_dir = os.path.join(work_dir, 'cov.cov')
+    return None, lambda: text_to_coverage_store(inputs['cov_path'], store_dir), inputs['n_bases'], 'bases'
+
+
+def bench_coverage_export(inputs, work_dir):
+    from cnv_pipeline.coverage_store import text_to_coverage_store, export_per_base_bed
+    store_dir = os.path.join(work_dir, 'cov.cov')
+
+    def setup():
+        if not os.path.exists(store_dir):
+            text_to_coverage_store(inputs['cov_path'], store_dir)
+    return setup, lambda: export_per_base_bed(store_dir, os.path.join(work_dir, 'cov.txt')), \
+        inputs['n_bases'], 'bases'
+
+
+def bench_cli_startup(inputs, work_dir):
+    """`run_cnv -h` and `run_cnv_cohort -h` in fresh interpreters.
+
+    Setup fails if importing a CLI module loads any of HEAVY_MODULES.
+    """
+    cmds = [[sys.executable, '-c', 'from {} import main; main()'.format(module), '-h'] for module in CLI_MODULES]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')])))
+
+    def setup():
+        for module in CLI_MODULES:
+            code = 'import sys, {}; print(" ".join(m for m in {!r} if m in sys.modules))'.format(
+                module, HEAVY_MODULES)
+            loaded = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True,
+                                    universal_newlines=True, env=env).stdout.split()
+            if loaded:
+                raise RuntimeError("Importing {} loads {}.".format(module, ', '.join(loaded)))
+
+    def run():
+        for _ in range(STARTUP_RUNS):
+            for cmd in cmds:
+                subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True, env=env)
+    return setup, run, STARTUP_RUNS * len(cmds), 'starts'
+
+
+BENCHMARKS = {
+    'baf_from_vcf': bench_baf_from_vcf,
+    'trim_vcf': bench_trim_vcf,
+    'fused_trim_baf': bench_fused_trim_baf,
+    'cohort_baf': bench_cohort_baf,
+    'cohort_baf_per_pair': bench_cohort_baf_per_pair,
+    'prep_loh_dataframes': bench_prep_loh_dataframes,
+    'trim_loh_intervals': bench_trim_loh_intervals,
+    'plot_loh': bench_plot_loh,
+    'plot_case_cnv': bench_plot_case_cnv,
+    'coverage_import': bench_coverage_import,
+    'coverage_export': bench_coverage_export,
+    'cli_startup': bench_cli_startup,
+}
+
+
+def run_benchmark(name, inputs, repeat=1):
+    """Run one benchmark in a fresh process.
+
+    Returns:
+        dict: seconds (best of repeat), n, unit, per_second, peak_rss_mb,
+            rss_growth_mb.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+        return pool.submit(_run_in_process, name, inputs, repeat).result()
+
+
+def _run_in_process(name, inputs, repeat):
+    with tempfile.TemporaryDirectory(dir=inputs['data_dir']) as work_dir:
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull  # silence stage progress messages
+            try:
+                setup, run, n, unit = BENCHMARKS[name](inputs, work_dir)
+                if setup is not None:
+                    setup()
+                rss_before = _peak_rss()
+                times = []
+                for _ in range(repeat):
+                    t0 = time.perf_counter()
+                    run()
+                    times.append(time.perf_counter() - t0)
+            finally:
+                sys.stdout = stdout
+    seconds = min(times)
+    peak = _peak_rss()
+    return dict(seconds=seconds, n=n, unit=unit, per_second=n / seconds if seconds else None,
+                peak_rss_mb=peak / 1024 ** 2, rss_growth_mb=(peak - rss_before) / 1024 ** 2)
+
+
+def compare_results(results, baseline, max_slowdown=0.2, max_memory_growth=0.2):
+    """Stages slower, or with higher peak RSS, than baseline by more than the allowed fraction.
+
+    Returns:
+        list: (stage, metric, baseline value, new value) for each regression.
+    """
+    regressions = []
+    for name, new in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        if new['seconds'] > old['seconds'] * (1 + max_slowdown):
+            regressions.append((name, 'seconds', old['seconds'], new['seconds']))
+        if new['peak_rss_mb'] > old['peak_rss_mb'] * (1 + max_memory_growth):
+            regressions.append((name, 'peak_rss_mb', old['peak_rss_mb'], new['peak_rss_mb']))
+    return regressions
+
+
+def _peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # Linux reports KiB
+
+
+def _use_agg():
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser("CNV PIPELINE BENCHMARKS")
+    parser.add_argument('--scale', help='Input size preset [small]', choices=list(SCALES), default='small')
+    parser.add_argument('--only', help='Run these benchmarks only [all]', nargs='+', choices=list(BENCHMARKS))
+    parser.add_argument('--repeat', help='Timed runs per benchmark; best is kept [1]', type=int, default=1)
+    parser.add_argument('--data_dir', help='Directory for generated inputs, reused across runs '
+                                           '[bench_data/<scale>]', default=None)
+    parser.add_argument('--seed', help='Random seed for generated inputs [0]', type=int, default=0)
+    parser.add_argument('-o', '--out_path', help='Results JSON path [bench_<scale>.json]', default=None)
+    parser.add_argument('--baseline', help='Earlier results JSON to check for regressions', default=None)
+    parser.add_argument('--max_slowdown', help='Allowed fractional increase in time [0.2]',
+                        type=float, default=0.2)
+    parser.add_argument('--max_memory_growth', help='Allowed fractional increase in peak RSS [0.2]',
+                        type=float, default=0.2)
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or os.path.join('bench_data', args.scale)
+    out_path = args.out_path or 'bench_{}.json'.format(args.scale)
+    os.makedirs(data_dir, exist_ok=True)
+    inputs = write_inputs(data_dir, args.scale, seed=args.seed)
+
+    results = {}
+    for name in args.only or BENCHMARKS:
+        res = run_benchmark(name, inputs, repeat=args.repeat)
+        results[name] = res
+        print("{:<20} {:>8.2f}s {:>12,.0f} {}/s  peak {:>7.0f} MB  (+{:.0f} MB)".format(
+            name, res['seconds'], res['per_second'] or 0, res['unit'], res['peak_rss_mb'], res['rss_growth_mb']))
+
+    report = dict(version=RESULTS_VERSION, scale=args.scale, seed=args.seed, repeat=args.repeat,
+                  commit=_git_commit(), host=socket.gethostname(), python=platform.python_version(),
+                  created=time.time(), results=results)
+    with open(out_path, 'w') as f:
+        json.dump(report, f, indent=1)
+    print("Results written to {}".format(out_path))
+
+    if args.baseline is None:
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('scale') != args.scale:
+        print("WARNING: baseline scale is {}, not {}.".format(baseline.get('scale'), args.scale))
+    regressions = compare_results(results, baseline['results'], max_slowdown=args.max_slowdown,
+                                  max_memory_growth=args.max_memory_growth)
+    for name, metric, old, new in regressions:
+        print("REGRESSION {} {}: {:.2f} -> {:.2f} ({:+.0%})".format(name, metric, old, new, new / old - 1))
+    if regressions:
+        sys.exit(1)
+    print("No regressions against {}.".format(args.baseline))
+
+
+if __name__ == '__main__':
+    main()
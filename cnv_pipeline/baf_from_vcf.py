@@ -1,7 +1,15 @@
+import os
 import re
+from functools import partial
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from .baf_store import CompactParquetWriter
+from .vcf_io import read_vcf_header, read_vcf_chunks, indexed_chroms, map_vcf_regions, REGION_CHUNKSIZE
 
 DTYPE_DICT = {'ALT': str,
               'CHROM': str,
@@ -17,20 +25,22 @@ DTYPE_DICT = {'ALT': str,
               'Tumor.GT': str,
               'Tumor.REF.DP': int,
               }
+SAAS_SCHEMA = pa.schema([('CHROM', pa.string()), ('POS', pa.int64()), ('ID', pa.string()),
+                         ('REF', pa.string()), ('ALT', pa.string()), ('QUAL', pa.float64()),
+                         ('MQ', pa.float64()),
+                         ('Normal.GT', pa.string()), ('Normal.REF.DP', pa.int64()),
+                         ('Normal.ALT.DP', pa.int64()),
+                         ('Tumor.GT', pa.string()), ('Tumor.REF.DP', pa.int64()),
+                         ('Tumor.ALT.DP', pa.int64())])
+BAF_TEXT_FLOAT_FORMAT = '%.6g'  # compact mode: BAF precision in baf.txt
 
 
 def get_vcf_properties(vcf_path, tumor_id=None, normal_id=None):
     """Locate tumor and normal columns. Identify AD index within FORMAT."""
-    skip = 0
-    with open(vcf_path, 'r') as file:
-        for line in file:
-            if line.startswith('##'):
-                skip += 1
-            else:
-                break
-    df = pd.read_csv(vcf_path, sep='\t', skiprows=skip, nrows=100)
-    col_tumor = list(df.columns).index(tumor_id)  # 0-based
-    col_normal = list(df.columns).index(normal_id)  # 0-based
+    meta, columns = read_vcf_header(vcf_path)
+    skip = len(meta)
+    col_tumor = columns.index(tumor_id)  # 0-based
+    col_normal = columns.index(normal_id)  # 0-based
     # get 'AD' location
     # index_ad = df.FORMAT.str.split(':').apply(lambda l: l.index('AD')).unique()
     # if len(index_ad) > 1:
@@ -39,30 +49,117 @@ def get_vcf_properties(vcf_path, tumor_id=None, normal_id=None):
     return col_tumor, col_normal, skip
 
 
-def get_mq(info):
-    v = info.split(';')
-    vals = [i for i in v if re.match('^MQ=[0-9\.]+$', i)]
-    if len(vals) != 1:
-        return np.nan
-    mq = float(vals[0].split('=')[1])
-    return mq
+def extract_info_float(info, key='MQ'):
+    """Parse a numeric INFO field (e.g. MQ) from a whole INFO column.
+
+    Returns NaN where the key is absent, repeated or non-numeric.
+    """
+    # Double separators so that adjacent matches don't share a ';'.
+    arr = pc.replace_substring(_string_array(info), ';', ';;')
+    pattern = r'(?:^|;){}=(?P<value>[0-9.]+)(?:;|$)'.format(re.escape(key))
+    vals = pc.struct_field(pc.extract_regex(arr, pattern), 'value')
+    vals = pc.cast(vals, pa.float64()).to_numpy(zero_copy_only=False).copy()
+    vals[pc.count_substring_regex(arr, pattern).to_numpy(zero_copy_only=False) != 1] = np.nan
+    return pd.Series(vals, index=info.index)
+
+
+def extract_format_fields(formats, samples, fields=('GT', 'AD')):
+    """Vectorized FORMAT parsing for a whole sample column.
+
+    Field positions are located from each row's FORMAT key, so FORMAT layouts
+    can differ between records.
+
+    Args:
+        formats (pd.Series): FORMAT column, e.g. 'GT:AD:DP:GQ:PL'.
+        samples (pd.Series): sample column, e.g. '0/1:61,217:278:99:5815,0,1176'.
+        fields (iterable): FORMAT keys to extract.
+
+    Returns:
+        pd.DataFrame: string column per field, NaN where field is absent.
+    """
+    out = {field: np.full(len(samples), np.nan, dtype=object) for field in fields}
+    for mask, arrays in _iter_format_groups(formats, samples, fields):
+        for field, vals in arrays.items():
+            out[field][mask] = vals.to_numpy(zero_copy_only=False)
+    return pd.DataFrame(out, index=samples.index, columns=list(fields))
 
 
-def parse_format(f, col_gt=0, col_ad=1):
-    """0/1:61,217:278:99:5815,0,1176"""
-    vals = f.split(':')
-    n_ref, n_alt = vals[col_ad].split(',')
-    return vals[col_gt], int(n_ref), int(n_alt)
+def extract_gt_ad(formats, samples):
+    """GT and AD from a whole sample column. Returns genotype, ref depth and alt depth series."""
+    gt = np.full(len(samples), np.nan, dtype=object)
+    n_ref = np.zeros(len(samples), dtype=np.int64)
+    n_alt = np.zeros(len(samples), dtype=np.int64)
+    found = np.zeros(len(samples), dtype=bool)
+    for mask, arrays in _iter_format_groups(formats, samples, ('GT', 'AD')):
+        if 'GT' in arrays:
+            gt[mask] = arrays['GT'].to_numpy(zero_copy_only=False)
+        if 'AD' not in arrays or arrays['AD'].null_count:
+            continue
+        ad = pc.split_pattern(arrays['AD'], ',', max_splits=2)
+        n_ref[mask] = pc.cast(pc.list_element(ad, 0), pa.int64()).to_numpy()
+        n_alt[mask] = pc.cast(pc.list_element(ad, 1), pa.int64()).to_numpy()
+        found[mask] = True
+    if not found.all():
+        raise ValueError("AD missing for {} records.".format((~found).sum()))
+    index = samples.index
+    return (pd.Series(gt, index=index), pd.Series(n_ref, index=index),
+            pd.Series(n_alt, index=index))
+
+
+def _iter_format_groups(formats, samples, fields):
+    """Yield (row mask, {field: pyarrow string array}) per distinct FORMAT string.
+
+    Each group's sample values are split with a single pyarrow compute call.
+    Values are null where a sample omits trailing FORMAT fields.
+    """
+    codes, uniques = pd.factorize(formats)
+    sample_arr = _string_array(samples)
+    for code, fmt in enumerate(uniques):
+        keys = fmt.split(':')
+        present = [(field, keys.index(field)) for field in fields if field in keys]
+        if not present:
+            continue
+        mask = codes == code
+        sub = sample_arr.filter(pa.array(mask))
+        n_split = max(ind for _, ind in present) + 1
+        parts = pc.split_pattern(sub, ':', max_splits=n_split)
+        if len(parts) and pc.min(pc.list_value_length(parts)).as_py() <= n_split - 1:
+            # pad short records so every requested position exists
+            sub = pc.binary_join_element_wise(sub, ':' * n_split, '')
+            parts = pc.split_pattern(sub, ':', max_splits=n_split)
+            parts_short = True
+        else:
+            parts_short = False
+        arrays = {}
+        for field, ind in present:
+            vals = pc.list_element(parts, ind)
+            if parts_short:
+                vals = pc.if_else(pc.equal(vals, ''), pa.scalar(None, pa.string()), vals)
+            arrays[field] = vals
+        yield mask, arrays
+
+
+def _string_array(series):
+    return pa.array(series, type=pa.string(), from_pandas=True)
 
 
 def baf_from_vcf(vcf_path, baf_path, parquet_path=None, tumor_id=None, normal_id=None,
-                 mq_cutoff=30, chroms_str=None) -> None:
+                 mq_cutoff=30, chroms_str=None, chunksize=None, vcf_chunks=None,
+                 compact=False, n_workers=1) -> None:
     """Args:
         patient_id (str): used for saving saasCNV-style snp data to feather.
-        vcf_path (str): full or relative vcf path
+        vcf_path (str): full or relative path of a VCF, .vcf.gz or BCF.
         col_{tumor,normal} (int): index of {tumor,normal} column in vcf. 1-based.
         format_ad_index (int): index of AD in vcf FORMAT column. 1-based.
         MQ_cutoff (int): cutoff for MQ, in INFO column.
+        chunksize (int): [optional] number of VCF records to parse at a time.
+            Outputs are written incrementally, so peak memory depends on
+            chunksize rather than on VCF size. Default reads the whole file.
+        vcf_chunks (iterable): [optional] VCF record dataframes to use in place
+            of reading vcf_path, e.g. from trim_vcf.iter_selected_snps.
+        compact (bool): write parquet in the compact baf_store layout. See BafWriter.
+        n_workers (int): if vcf_path is indexed, read only the chroms_str
+            chromosomes, on this many processes (see vcf_io.map_vcf_regions).
 
     Intermediate files:
         <baf_path>.feather: created by vcf2table.R
@@ -70,18 +167,64 @@ def baf_from_vcf(vcf_path, baf_path, parquet_path=None, tumor_id=None, normal_id
     chrom_list = chroms_str.split(',')
     if parquet_path is None:
         parquet_path = baf_path + '.parquet'
-    v = get_vcf_properties(vcf_path=vcf_path, tumor_id=tumor_id,
-                           normal_id=normal_id)
-    col_tumor, col_normal, skip = v
-    df = pd.read_csv(vcf_path, sep='\t', skiprows=skip)
-    df.rename(columns={'#CHROM': 'CHROM'}, inplace=True)
-    df['MQ'] = df.INFO.apply(lambda info: get_mq(info))
-    for col, names in [(col_tumor, ['Tumor.GT', 'Tumor.REF.DP', 'Tumor.ALT.DP']),
-                       (col_normal, ['Normal.GT', 'Normal.REF.DP', 'Normal.ALT.DP'])]:
-        vals = df.iloc[:, col].apply(lambda f: parse_format(f))
-        df[names[0]], df[names[1]], df[names[2]] = zip(*vals)
-        df[names[1]] = df[names[1]].astype(np.int64)
-        df[names[2]] = df[names[2]].astype(np.int64)
+    to_table = partial(pair_saas_table, tumor_id=tumor_id, normal_id=normal_id,
+                       mq_cutoff=mq_cutoff, chrom_list=chrom_list)
+    regions = indexed_chroms(vcf_path, chrom_list) if vcf_chunks is None else None
+    if regions is not None:
+        get_vcf_properties(vcf_path=vcf_path, tumor_id=tumor_id, normal_id=normal_id)  # check sample ids
+        tables = map_vcf_regions(to_table, vcf_path, regions, n_workers=n_workers,
+                                 chunksize=chunksize or REGION_CHUNKSIZE)
+    else:
+        if vcf_chunks is None:
+            v = get_vcf_properties(vcf_path=vcf_path, tumor_id=tumor_id,
+                                   normal_id=normal_id)
+            skip = v[2]
+            if chunksize is not None:
+                print("Reading VCF in chunks of {} records.".format(chunksize))
+            vcf_chunks = read_vcf_chunks(vcf_path, skip, chunksize=chunksize)
+        tables = (to_table(df) for df in vcf_chunks)
+    with BafWriter(baf_path, parquet_path, compact=compact) as writer:
+        for df in tables:
+            writer.write(df)
+    print("Saved BAF data to file: {}".format(baf_path))
+
+
+def pair_saas_table(df, tumor_id=None, normal_id=None, mq_cutoff=30, chrom_list=None):
+    """vcf_to_saas_table, locating the tumor and normal columns by sample name."""
+    col_tumor = list(df.columns).index(tumor_id)  # 0-based
+    col_normal = list(df.columns).index(normal_id)  # 0-based
+    return vcf_to_saas_table(df, col_tumor, col_normal, mq_cutoff=mq_cutoff, chrom_list=chrom_list)
+
+
+def vcf_to_saas_table(df, col_tumor, col_normal, mq_cutoff=30, chrom_list=None):
+    """Extract MQ-filtered tumor and normal allele depths in saasCNV layout.
+
+    Args:
+        df (pd.DataFrame): VCF records, as yielded by read_vcf_chunks.
+        col_{tumor,normal} (int): index of {tumor,normal} column in df. 0-based.
+        mq_cutoff (int): cutoff for MQ, in INFO column.
+        chrom_list (list): chromosomes to retain.
+    """
+    mq = extract_info_float(df.INFO, key='MQ')
+    tumor = extract_gt_ad(df.FORMAT, df.iloc[:, col_tumor])
+    normal = extract_gt_ad(df.FORMAT, df.iloc[:, col_normal])
+    return build_saas_table(df, mq, tumor, normal, mq_cutoff=mq_cutoff, chrom_list=chrom_list)
+
+
+def build_saas_table(df, mq, tumor, normal, mq_cutoff=30, chrom_list=None):
+    """saasCNV table from VCF records and their already-parsed MQ and allele depths.
+
+    Args:
+        df (pd.DataFrame): VCF records; only the fixed columns are used.
+        mq (pd.Series): MQ per record, as from extract_info_float.
+        {tumor,normal} (tuple): genotype, ref depth and alt depth series, as
+            from extract_gt_ad.
+    """
+    df = df.rename(columns={'#CHROM': 'CHROM'})
+    df['MQ'] = mq
+    for vals, names in [(tumor, ['Tumor.GT', 'Tumor.REF.DP', 'Tumor.ALT.DP']),
+                        (normal, ['Normal.GT', 'Normal.REF.DP', 'Normal.ALT.DP'])]:
+        df[names[0]], df[names[1]], df[names[2]] = vals
     df = df.loc[(df.MQ > mq_cutoff) & (df.CHROM.isin(chrom_list)),
                 ["CHROM", "POS", "ID", "REF", "ALT", "QUAL", "MQ",
                  "Normal.GT", "Normal.REF.DP", "Normal.ALT.DP", "Tumor.GT",
@@ -89,11 +232,12 @@ def baf_from_vcf(vcf_path, baf_path, parquet_path=None, tumor_id=None, normal_id
 
     for col in DTYPE_DICT:
         df[col] = df[col].astype(DTYPE_DICT[col])
-    df.reset_index(drop=True).to_parquet(parquet_path)  # for saasCNV
+    return df.reset_index(drop=True)
+
 
-    # Finalize baf file
-    print("Finalizing dataframe.")
-    df.rename(columns={'CHROM': 'chrom', 'POS': 'SNP_loc'}, inplace=True)
+def saas_to_baf_table(df):
+    """Convert saasCNV-style table to ADTEx BAF table."""
+    df = df.rename(columns={'CHROM': 'chrom', 'POS': 'SNP_loc'})
     df['control_doc'] = df['Normal.REF.DP'] + df['Normal.ALT.DP']
     df['tumor_doc'] = df['Tumor.REF.DP'] + df['Tumor.ALT.DP']
     df['control_BAF'] = df['Normal.ALT.DP'] / df['control_doc']
@@ -104,5 +248,87 @@ def baf_from_vcf(vcf_path, baf_path, parquet_path=None, tumor_id=None, normal_id
     df = df[['chrom', 'SNP_loc', 'control_BAF', 'tumor_BAF', 'control_doc', 'tumor_doc']].copy()
     # df.chrom = df.chrom.apply(lambda x: 'chr' + str(x) if x != 'MT' else 'chrM')
     df.dropna(inplace=True)  # Drop null entries
-    df.to_csv(baf_path, sep='\t', index=False)
-    print("Saved BAF data to file: {}".format(baf_path))
+    return df
+
+
+def empty_saas_table():
+    """saasCNV-style table with no records, typed as SAAS_SCHEMA."""
+    return SAAS_SCHEMA.empty_table().to_pandas()
+
+
+class BafWriter:
+    """Incrementally writes saasCNV parquet and ADTEx baf.txt outputs.
+
+    Each call to write appends a saasCNV-style table (from vcf_to_saas_table)
+    to the parquet file as a new row group, and its BAF conversion to baf.txt.
+    The parquet schema is fixed (SAAS_SCHEMA), so chunks with no records,
+    whose string columns have no values to infer a type from, are written
+    like any other. Both outputs are created on close, with headers only if
+    nothing was written. If the with block raises, the outputs are removed
+    instead (see discard), so a failed extraction does not leave files that
+    look complete. With compact=True, the parquet file uses the compact layout of
+    baf_store (categorical strings, 32-bit numbers, one chromosome per row
+    group), and baf.txt BAFs are written to BAF_TEXT_FLOAT_FORMAT precision.
+    """
+    def __init__(self, baf_path, parquet_path, compact=False):
+        self.baf_path = baf_path
+        self.parquet_path = parquet_path
+        self.compact = compact
+        self._parquet_writer = None
+        self._baf_file = None
+        self._finished = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def write(self, df):
+        header = self._baf_file is None
+        if header:
+            self._baf_file = open(self.baf_path, 'w')
+        if self.compact:
+            if self._parquet_writer is None:
+                self._parquet_writer = CompactParquetWriter(self.parquet_path)
+            self._parquet_writer.write(df)  # for saasCNV
+            saas_to_baf_table(df).to_csv(self._baf_file, sep='\t', index=False, header=header,
+                                         float_format=BAF_TEXT_FLOAT_FORMAT)
+            return
+        table = pa.Table.from_pandas(df[SAAS_SCHEMA.names], schema=SAAS_SCHEMA, preserve_index=False)
+        if self._parquet_writer is None:
+            self._parquet_writer = pq.ParquetWriter(self.parquet_path, table.schema)
+        self._parquet_writer.write_table(table)  # for saasCNV
+        saas_to_baf_table(df).to_csv(self._baf_file, sep='\t', index=False, header=header)
+
+    def close(self):
+        if self._finished:
+            return
+        self._finished = True
+        if self._baf_file is None:
+            self.write(empty_saas_table())
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        if self._baf_file is not None:
+            self._baf_file.close()
+            self._baf_file = None
+
+    def discard(self):
+        """Close without finishing the outputs, and remove them."""
+        self._finished = True
+        if self._parquet_writer is not None:
+            if self.compact:
+                self._parquet_writer.discard()
+            else:
+                self._parquet_writer.close()
+            self._parquet_writer = None
+        if self._baf_file is not None:
+            self._baf_file.close()
+            self._baf_file = None
+        for path in (self.baf_path, self.parquet_path):
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,137 @@
+"""Compact columnar layout for the saasCNV SNP table (saas.parquet).
+
+The compact layout stores CHROM, ID, REF, ALT and genotypes as dictionary
+(categorical) columns, positions and allele depths as int32, and QUAL/MQ as
+float32, compressed with zstd. Every row group holds a single chromosome, so
+readers can load one chromosome, or a subset of columns, without decoding
+the rest of the file.
+R's arrow::read_parquet reads it as factors, integers and doubles.
+"""
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+ROW_GROUP_MAX_ROWS = 1000000  # larger chromosomes are split over several row groups
+
+_CATEGORY = pa.dictionary(pa.int32(), pa.string())
+COMPACT_SCHEMA = pa.schema([('CHROM', _CATEGORY), ('POS', pa.int32()), ('ID', _CATEGORY),
+                            ('REF', _CATEGORY), ('ALT', _CATEGORY), ('QUAL', pa.float32()),
+                            ('MQ', pa.float32()),
+                            ('Normal.GT', _CATEGORY), ('Normal.REF.DP', pa.int32()),
+                            ('Normal.ALT.DP', pa.int32()),
+                            ('Tumor.GT', _CATEGORY), ('Tumor.REF.DP', pa.int32()),
+                            ('Tumor.ALT.DP', pa.int32())])
+# sorted positions delta-encode well; QUAL is near-continuous, so split float bytes for zstd
+PARQUET_OPTIONS = dict(compression='zstd',
+                       use_dictionary=[f.name for f in COMPACT_SCHEMA if f.name not in ('POS', 'QUAL')],
+                       column_encoding={'POS': 'DELTA_BINARY_PACKED', 'QUAL': 'BYTE_STREAM_SPLIT'})
+
+
+class CompactParquetWriter:
+    """Write saasCNV tables in the compact layout, one chromosome per row group.
+
+    Rows are buffered until the chromosome changes (or ROW_GROUP_MAX_ROWS is
+    reached), so input chunks that split a chromosome still give
+    single-chromosome row groups.
+    """
+    def __init__(self, parquet_path, row_group_max_rows=ROW_GROUP_MAX_ROWS):
+        self.parquet_path = parquet_path
+        self.row_group_max_rows = row_group_max_rows
+        self._writer = pq.ParquetWriter(parquet_path, COMPACT_SCHEMA, **PARQUET_OPTIONS)
+        self._buffer = []
+        self._buffer_rows = 0
+        self._chrom = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, df):
+        chrom = df.CHROM.astype(str).to_numpy()
+        breaks = np.flatnonzero(chrom[1:] != chrom[:-1]) + 1
+        for lo, hi in zip(np.r_[0, breaks], np.r_[breaks, len(df)]):
+            if hi <= lo:
+                continue
+            if chrom[lo] != self._chrom:
+                self._flush()
+                self._chrom = chrom[lo]
+            self._buffer.append(df.iloc[lo:hi])
+            self._buffer_rows += hi - lo
+            if self._buffer_rows >= self.row_group_max_rows:
+                self._flush()
+
+    def close(self):
+        if self._writer is not None:
+            self._flush()
+            self._writer.close()
+            self._writer = None
+
+    def discard(self):
+        """Close the file without writing buffered rows, e.g. before removing it."""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._buffer = []
+        self._buffer_rows = 0
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        df = pd.concat(self._buffer, ignore_index=True)
+        table = pa.Table.from_pandas(df[COMPACT_SCHEMA.names], schema=COMPACT_SCHEMA, preserve_index=False)
+        self._writer.write_table(table, row_group_size=len(df))
+        self._buffer = []
+        self._buffer_rows = 0
+
+
+def read_baf_store(parquet_path, chroms=None, columns=None):
+    """Read a saasCNV SNP table, optionally restricted to chromosomes and columns.
+
+    Works on compact and standard saas.parquet files. For compact files, only
+    the row groups of the requested chromosomes are read.
+
+    Args:
+        chroms (list): [optional] chromosome names to load.
+        columns (list): [optional] column names to load.
+
+    Returns:
+        pd.DataFrame: categorical columns stay categorical.
+    """
+    if chroms is None:
+        return pq.read_table(parquet_path, columns=columns).to_pandas()
+    chroms = [str(c) for c in chroms]
+    f = pq.ParquetFile(parquet_path)
+    groups = row_groups_by_chrom(f)
+    if groups is None:  # not chromosome-partitioned: filter rows
+        return pq.read_table(parquet_path, columns=columns,
+                             filters=[('CHROM', 'in', chroms)]).to_pandas()
+    indices = sorted(i for c in chroms for i in groups.get(c, []))
+    read_columns = columns if columns is None or 'CHROM' in columns else list(columns) + ['CHROM']
+    df = f.read_row_groups(indices, columns=read_columns).to_pandas()
+    return df if columns is None else df[list(columns)]
+
+
+def row_groups_by_chrom(parquet_file):
+    """Map chromosome to row group indices, from CHROM column statistics.
+
+    Returns None if any row group spans several chromosomes or lacks statistics.
+    """
+    meta = parquet_file.metadata
+    chrom_ind = parquet_file.schema_arrow.get_field_index('CHROM')
+    groups = {}
+    for i in range(meta.num_row_groups):
+        stats = meta.row_group(i).column(chrom_ind).statistics
+        if stats is None or not stats.has_min_max or stats.min != stats.max:
+            return None
+        chrom = stats.min.decode() if isinstance(stats.min, bytes) else str(stats.min)
+        groups.setdefault(chrom, []).append(i)
+    return groups
+
+
+def baf_store_chroms(parquet_path):
+    """Chromosomes in a compact saas.parquet, in file order (None if not partitioned)."""
+    groups = row_groups_by_chrom(pq.ParquetFile(parquet_path))
+    return None if groups is None else list(groups)
@@ -1,44 +1,276 @@
 import os
-import subprocess
+import shutil
 import shlex
+import multiprocessing
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
+from .genome_dict import get_genome_dict, read_genome_dict, cached_genome_dict, write_genome_file
+from .run_report import submit_in_context
+from .supervisor import run_tool
 
-def build_genome_file(sample_bam=None, genome_path=None):
-    """Build genome file for use with bedtools coverage --sorted mode."""
+COVERAGE_BACKENDS = ('bedtools', 'pysam')
+SHARD_MODES = ('balanced', 'chrom')
+SHARDS_PER_WORKER = 4  # balanced mode: extra shards even out per-shard target density
+WINDOW_GAP = 1000  # targets closer than this share one BAM fetch
 
-    """samtools view -H {bam} | grep -P "@SQ\tSN:" | sed 's/@SQ\tSN://' | sed 's/\tLN:/\t/' > {genome_path}"""
-    cmd1 = f"samtools view -H {sample_bam}"
-    cmd2 = 'grep -P "@SQ\tSN:"'
-    cmd3 = "sed 's/@SQ\tSN://'"
-    cmd4 = "sed 's/\tLN:/\t/'"
 
-    with open(genome_path, 'w') as genome_file:
-        p1 = subprocess.Popen(shlex.split(cmd1), stdout=subprocess.PIPE)
-        p2 = subprocess.Popen(shlex.split(cmd2), stdout=subprocess.PIPE, stdin=p1.stdout)
-        p3 = subprocess.Popen(shlex.split(cmd3), stdout=subprocess.PIPE, stdin=p2.stdout)
-        p4 = subprocess.Popen(shlex.split(cmd4), stdout=genome_file, stdin=p3.stdout)
-    p4.communicate()
+def build_genome_file(sample_bam=None, genome_path=None, ref_fasta=None):
+    """Build genome file for use with bedtools coverage --sorted mode.
+
+    Chromosome names and lengths come from the reference .fai/.dict index if
+    ref_fasta is given (cached across samples, see genome_dict), otherwise
+    from the @SQ lines of the BAM header.
+    """
+    genome = get_genome_dict(bam_path=sample_bam, ref_fasta=ref_fasta)
+    write_genome_file(genome, genome_path)
+    print("Genome file written: {} ({} sequences)".format(genome_path, len(genome)))
 
 
 def build_coverage_files(tumor_bam=None, normal_bam=None, genome_path=None,
                          tumor_cov_path=None, normal_cov_path=None,
-                         target_bed_path=None):
+                         target_bed_path=None, parallel=True, overwrite=False,
+                         backend='bedtools', n_workers=1, shard_by='balanced'):
     """Build normal and tumor coverage files for whole exome.
 
     bedtools coverage -g $g -d -sorted -a $CODING_REGIONS -b normal.bam > cov_normal.bed;
     bedtools coverage -g $g -d -sorted -a $CODING_REGIONS -b tumor.bam > cov_tumor.bed;
+
+    Args:
+        parallel (bool): compute tumor and normal coverage concurrently: two
+            bedtools processes, or for the pysam backend two worker processes,
+            as its depth loop holds the GIL.
+        overwrite (bool): regenerate coverage files that already exist.
+        backend (str): 'bedtools' writes per-base text with bedtools coverage.
+            'pysam' computes depth in-process and writes a compact coverage
+            store (see coverage_store) to each *_cov_path; use
+            coverage_store.export_per_base_bed to get bedtools-style text.
+        n_workers (int): if greater than 1, split targets into shards (see
+            shard_targets) and compute them on a process pool with indexed
+            BAM region queries via pysam, for both BAMs at once. Shards are
+            merged in target order, so output matches the unsharded backend.
+            Requires pysam and BAM indexes. Only this mode reads genome_path.
+        shard_by (str): 'balanced' or 'chrom', see shard_targets.
     """
+    if backend not in COVERAGE_BACKENDS:
+        raise ValueError("Invalid coverage backend ({}). Choose from {}.".format(backend, COVERAGE_BACKENDS))
+    pending = []
     for (bam, out_path, which) in [(tumor_bam, tumor_cov_path, 'tumor'),
                                    (normal_bam, normal_cov_path, 'normal')]:
-        if os.path.exists(out_path):
+        if os.path.exists(out_path) and not overwrite:
             print("Coverage file for {} exists. Skipping.".format(which))
             continue
+        pending.append((bam, out_path))
+    if n_workers > 1 and pending:
+        build_sharded_coverage(pending, target_bed_path, genome_path=genome_path,
+                               store=backend == 'pysam', n_workers=n_workers, shard_by=shard_by)
+        return
+    jobs = []
+    for bam, out_path in pending:
+        if backend == 'pysam':
+            jobs.append(partial(build_coverage_store, bam, target_bed_path, out_path))
         else:
-            print("Generating coverage for {}".format(bam))
-            with open(out_path, 'w') as out:
-                cmd_template = "bedtools coverage -g {g} -d -sorted -a {target} -b {bam}"
-                cmd = cmd_template.format(g=genome_path, target=target_bed_path,
-                                          bam=bam)
-                print("...bedtools command: {}".format(cmd))
-                proc = subprocess.Popen(shlex.split(cmd), stdin=subprocess.DEVNULL, stdout=out)
-                proc.communicate()
+            jobs.append(partial(_run_bedtools_coverage, bam, out_path, genome_path, target_bed_path))
+    if parallel and len(jobs) > 1 and backend == 'pysam':
+        with _process_pool(len(jobs)) as pool:
+            futures = [pool.submit(job) for job in jobs]
+            for future in futures:
+                future.result()
+    elif parallel and len(jobs) > 1:
+        with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+            futures = [submit_in_context(pool, job) for job in jobs]
+            for future in futures:
+                future.result()
+    else:
+        for job in jobs:
+            job()
+
+
+def _run_bedtools_coverage(bam, out_path, genome_path, target_bed_path):
+    print("Generating coverage for {}".format(bam))
+    with open(out_path, 'w') as out:
+        cmd_template = "bedtools coverage -g {g} -d -sorted -a {target} -b {bam}"
+        cmd = cmd_template.format(g=genome_path, target=target_bed_path,
+                                  bam=bam)
+        print("...bedtools command: {}".format(cmd))
+        name = 'bedtools.' + os.path.splitext(os.path.basename(out_path))[0]
+        run_tool('bedtools', shlex.split(cmd), name=name, stdout=out)
+
+
+def build_coverage_store(bam_path, target_bed_path, store_dir):
+    """Compute per-base depth over targets in-process and write a coverage store."""
+    from .coverage_store import write_coverage_store
+    print("Generating coverage store for {}".format(bam_path))
+    bed_lines = read_target_bed(target_bed_path)
+    depths = iter_target_depths(bam_path, bed_lines)
+    write_coverage_store(store_dir, bed_lines, depths)
+    print("...coverage store written: {}".format(store_dir))
+
+
+def build_sharded_coverage(jobs, target_bed_path, genome_path=None, store=True,
+                           n_workers=2, shard_by='balanced'):
+    """Compute coverage for one or more BAMs over target shards on a process pool.
+
+    Args:
+        jobs (list): (bam_path, out_path) tuples.
+        genome_path (str): [optional] genome.txt from build_genome_file, used
+            to order and size shards. Default reads lengths from the first BAM header.
+        store (bool): write a coverage store to each out_path. Otherwise
+            write `bedtools coverage -d` style text.
+        n_workers (int): worker processes.
+        shard_by (str): 'balanced' or 'chrom', see shard_targets.
+    """
+    from .coverage_store import new_store_tmp_dir, assemble_coverage_store
+    bed_lines = read_target_bed(target_bed_path)
+    if genome_path is not None and os.path.exists(genome_path):
+        genome = read_genome_dict(genome_path)
+    else:
+        genome = cached_genome_dict(jobs[0][0])
+    shards = shard_targets(bed_lines, genome, n_shards=n_workers * SHARDS_PER_WORKER, shard_by=shard_by)
+    print("Generating coverage for {} in {} shards with {} workers".format(
+        ', '.join(bam for bam, _ in jobs), len(shards), n_workers))
+    futures = {}
+    with _process_pool(n_workers) as pool:
+        for bam, out_path in jobs:
+            tmp_dir = new_store_tmp_dir(out_path)
+            for i, (lo, hi) in enumerate(shards):
+                shard_path = os.path.join(tmp_dir, 'shard_{:05d}'.format(i))
+                futures[(out_path, i)] = pool.submit(_write_shard, bam, bed_lines[lo:hi],
+                                                     shard_path, store)
+        results = {k: f.result() for k, f in futures.items()}
+    for bam, out_path in jobs:
+        tmp_dir = out_path.rstrip('/') + '.tmp'
+        shard_paths = [results[(out_path, i)][0] for i in range(len(shards))]
+        if store:
+            lengths = [n for i in range(len(shards)) for n in results[(out_path, i)][1]]
+            assemble_coverage_store(out_path, bed_lines, shard_paths, lengths)
+        else:
+            _concatenate_files(shard_paths, out_path)
+            shutil.rmtree(tmp_dir)
+        print("...coverage written: {}".format(out_path))
+
+
+def shard_targets(bed_lines, genome, n_shards=1, shard_by='balanced'):
+    """Split targets into contiguous shards, returned as (start, stop) index ranges.
+
+    Args:
+        bed_lines (list): target BED lines, sorted in genome order.
+        genome (list): (chrom, length) tuples in genome order, as in genome.txt.
+        n_shards (int): 'balanced' mode: cut the genome into this many chunks
+            of equal length; each target falls in the chunk holding its start.
+        shard_by (str): 'balanced', or 'chrom' for one shard per chromosome.
+
+    Shards never reorder targets, so concatenating shard outputs reproduces
+    the target order. Empty shards are dropped.
+    """
+    import numpy as np
+    if shard_by not in SHARD_MODES:
+        raise ValueError("Invalid shard mode ({}). Choose from {}.".format(shard_by, SHARD_MODES))
+    chroms = [line.split('\t', 3)[:2] for line in bed_lines]
+    chrom_ind = {chrom: i for i, (chrom, _) in enumerate(genome)}
+    missing = {c for c, _ in chroms if c not in chrom_ind}
+    if missing:
+        raise ValueError("Target chromosomes not in genome: {}".format(', '.join(sorted(missing))))
+    if shard_by == 'chrom':
+        keys = np.array([chrom_ind[c] for c, _ in chroms], dtype=np.int64)
+    else:
+        lengths = np.array([length for _, length in genome], dtype=np.int64)
+        chrom_offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        g_pos = np.array([chrom_offsets[chrom_ind[c]] + int(start) for c, start in chroms], dtype=np.int64)
+        bounds = np.arange(1, n_shards) * (lengths.sum() / n_shards)
+        keys = np.searchsorted(bounds, g_pos, side='right')
+    cuts = np.flatnonzero(np.diff(keys)) + 1
+    edges = [0] + cuts.tolist() + [len(bed_lines)]
+    return [(lo, hi) for lo, hi in zip(edges[:-1], edges[1:]) if hi > lo]
+
+
+def read_target_bed(target_bed_path):
+    """Return target BED lines, skipping header, track and browser lines."""
+    with open(target_bed_path) as f:
+        return [line.rstrip('\r\n') for line in f
+                if line.strip() and not line.startswith(('#', 'track', 'browser'))]
+
+
+def iter_target_depths(bam_path, bed_lines):
+    """Yield per-base depth array for each target, reading the BAM through pysam.
+
+    Matches `bedtools coverage -d`: every mapped alignment counts over its
+    full reference span (including deletions and skipped regions), with no
+    filtering on duplicate, secondary or QC flags. Nearby targets are grouped
+    so that each BAM region is fetched once.
+    """
+    pysam = _import_pysam()
+    targets = [(f[0], int(f[1]), int(f[2])) for f in (line.split('\t') for line in bed_lines)]
+    with pysam.AlignmentFile(bam_path, 'rb') as bam:
+        for chrom, w_start, w_end, window in _target_windows(targets):
+            depth = _window_depth(bam, chrom, w_start, w_end)
+            for _, start, end in window:
+                yield depth[start - w_start:end - w_start]
+
+
+def _write_shard(bam_path, bed_lines, shard_path, store=True):
+    """Worker: compute depths for a shard of targets and write raw uint32 or text.
+
+    Returns:
+        tuple: shard_path, and per-target depth lengths (empty for text).
+    """
+    from .coverage_store import write_raw_depths, write_per_base_bed
+    depths = iter_target_depths(bam_path, bed_lines)
+    if store:
+        return shard_path, write_raw_depths(shard_path, depths)
+    write_per_base_bed(shard_path, bed_lines, depths)
+    return shard_path, []
+
+
+def _process_pool(n_workers):
+    """Process pool for depth workers, spawned as this runs in a stage thread."""
+    return ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def _concatenate_files(paths, out_path):
+    with open(out_path, 'wb') as out:
+        for path in paths:
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, out)
+
+
+def _target_windows(targets):
+    """Group consecutive targets on the same chromosome that lie within WINDOW_GAP."""
+    window = []
+    for target in targets:
+        if window and (target[0] != window[0][0] or target[1] > w_end + WINDOW_GAP
+                       or target[1] < w_start):
+            yield window[0][0], w_start, w_end, window
+            window = []
+        if not window:
+            w_start, w_end = target[1], target[2]
+        window.append(target)
+        w_end = max(w_end, target[2])
+    if window:
+        yield window[0][0], w_start, w_end, window
+
+
+def _window_depth(bam, chrom, w_start, w_end):
+    """Depth at each base of [w_start, w_end), via a difference array of read spans."""
+    import numpy as np
+    n = w_end - w_start
+    starts, ends = [], []
+    if n > 0:
+        for read in bam.fetch(chrom, w_start, w_end):
+            if read.is_unmapped:
+                continue
+            starts.append(read.reference_start)
+            ends.append(read.reference_end)
+    starts = np.clip(np.asarray(starts, dtype=np.int64) - w_start, 0, n)
+    ends = np.clip(np.asarray(ends, dtype=np.int64) - w_start, 0, n)
+    diff = np.bincount(starts, minlength=n + 1) - np.bincount(ends, minlength=n + 1)
+    return np.cumsum(diff[:n])
+
+
+def _import_pysam():
+    try:
+        import pysam
+    except ImportError:
+        raise ImportError("The pysam coverage backend requires pysam "
+                          "(conda install -c bioconda pysam, or pip install pysam).")
+    return pysam
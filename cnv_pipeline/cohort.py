@@ -0,0 +1,293 @@
+"""Run the CNV pipeline for a cohort of tumor/normal pairs on a process pool."""
+import os
+import sys
+import time
+import argparse
+import traceback
+import collections
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from .pipeline import run_cnv, add_run_arguments, get_run_kwargs, DEFAULT_CHROMS
+from .run_report import aggregate_run_reports
+from .stage_cache import StageCache
+from .stages import Stage, set_stage_limits, parse_stage_limits, STAGES
+from .supervisor import handle_sigterm
+
+REQUIRED_COLUMNS = ['tumor_id', 'normal_id', 'vcf', 'tumor_bam', 'normal_bam']
+
+
+def load_sample_sheet(sample_file, out_dir='.'):
+    """Read tab-separated sample sheet of tumor/normal pairs.
+
+    Columns: tumor_id (or sample_id), normal_id, vcf, tumor_bam, normal_bam.
+    Optional columns: case_id (or patient_id), sample_dir. sample_dir defaults
+    to <out_dir>/<tumor_id>, matching the layout read by
+    plot_case_cnv_samples_table.
+    """
+    import pandas as pd
+    s = pd.read_table(sample_file, dtype=str)
+    s.rename(columns={'patient_id': 'case_id', 'sample_id': 'tumor_id'}, inplace=True)
+    missing = [c for c in REQUIRED_COLUMNS if c not in s.columns]
+    if missing:
+        raise SampleSheetError("Sample sheet {} is missing columns: {}".format(sample_file, missing))
+    if s.tumor_id.duplicated().any():
+        raise SampleSheetError("Duplicate tumor_id values in {}".format(sample_file))
+    if 'sample_dir' not in s.columns:
+        s['sample_dir'] = None
+    s['sample_dir'] = [d if isinstance(d, str) and d else os.path.join(out_dir, t)
+                       for d, t in zip(s.sample_dir, s.tumor_id)]
+    if 'case_id' not in s.columns:
+        s['case_id'] = s['tumor_id']
+    return s
+
+
+def run_cohort(sample_file, out_dir='.', n_workers=1, stage_limits=None,
+               summary_path=None, joint_vcf=False, **run_kw):
+    """Run run_cnv for every pair in a sample sheet, using a process pool.
+
+    Args:
+        sample_file (str): sample sheet path, see load_sample_sheet.
+        out_dir (str): parent dir for default sample dirs and the summary.
+        n_workers (int): number of pairs processed concurrently.
+        stage_limits (dict): [optional] max concurrent pairs per stage, e.g.
+            {'saas': 2, 'coverage': 4}, across all workers.
+        summary_path (str): [optional] summary table path. Default is
+            <out_dir>/cohort_summary.txt. Per-stage resource totals over all
+            pairs' run reports go alongside, in cohort_run_report.txt.
+        joint_vcf (bool): first extract BAF for all pairs sharing a VCF in a
+            single pass over it (see cohort_baf), then run each pair from its
+            extracted BAF. Extraction output goes to <out_dir>/extract_baf.<i>.log.
+        run_kw: further run_cnv keyword arguments, shared by all pairs.
+
+    Returns:
+        pd.DataFrame: one row per pair, with status, timing and error message.
+    """
+    import pandas as pd
+    if summary_path is None:
+        summary_path = os.path.join(out_dir, 'cohort_summary.txt')
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    s = load_sample_sheet(sample_file, out_dir=out_dir)
+    ctx = multiprocessing.get_context()
+    print("Running {} sample pairs with {} workers.".format(len(s), n_workers))
+
+    results = []
+
+    def fail_pair(pair, error):
+        print("{}: failed ({})".format(pair['tumor_id'], error))
+        results.append(_pair_result(pair, status='failed', seconds=0, error=error))
+
+    # Tasks are submitted one per free worker, so every submitted task is running; if
+    # a worker dies, only those fail, and the queued tasks go to a new pool.
+    queue = collections.deque()  # (func, args, pairs) not yet submitted
+    if joint_vcf:
+        extract_kw = _get_extract_kwargs(run_kw)
+        for i, (vcf_path, group) in enumerate(s.groupby('vcf', sort=False)):
+            group_pairs = group.to_dict('records')
+            log_path = os.path.join(out_dir, 'extract_baf.{}.log'.format(i))
+            queue.append((_extract_group, (vcf_path, group_pairs, extract_kw, log_path,
+                                           run_kw.get('use_cache', True)), group_pairs))
+    else:
+        queue.extend((_run_pair, (pair, run_kw), [pair]) for pair in s.to_dict('records'))
+    running = {}  # future: (func, pairs)
+    pool = None
+    try:
+        while queue or running:
+            if pool is None:
+                # New semaphores too: those of a broken pool may be held by killed workers
+                semaphores = {stage: ctx.BoundedSemaphore(n) for stage, n in (stage_limits or {}).items()}
+                pool = ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx,
+                                           initializer=_init_worker, initargs=(semaphores,))
+            while queue and len(running) < n_workers:
+                func, args, pairs = queue.popleft()
+                running[pool.submit(func, *args)] = (func, pairs)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                # A worker died (e.g. killed for memory), and the pool stopped the others
+                done, _ = wait(running)
+                pool.shutdown()
+                pool = None
+            for future in done:
+                func, pairs = running.pop(future)
+                if func is _run_pair:
+                    try:
+                        res = future.result()
+                    except BrokenProcessPool as e:
+                        fail_pair(pairs[0], '{}: {}'.format(type(e).__name__, e))
+                        continue
+                    print("{tumor_id}: {status} ({seconds:.0f}s)".format(**res))
+                    results.append(res)
+                    continue
+                try:
+                    pair_errors = future.result()
+                except Exception as e:
+                    pair_errors = {pair['tumor_id']: '{}: {}'.format(type(e).__name__, e) for pair in pairs}
+                for pair in pairs:
+                    if pair['tumor_id'] in pair_errors:
+                        fail_pair(pair, 'BAF extraction failed: {}'.format(
+                            pair_errors[pair['tumor_id']].split('\n')[0]))
+                        continue
+                    queue.append((_run_pair, (pair, dict(run_kw, extracted_baf=True)), [pair]))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    columns = ['case_id', 'tumor_id', 'normal_id', 'status', 'seconds', 'error', 'sample_dir', 'log_path']
+    summary = pd.DataFrame(results, columns=columns).set_index('tumor_id', drop=False)
+    summary = summary.loc[s.tumor_id, columns].reset_index(drop=True)  # sample sheet order
+    summary['seconds'] = summary.seconds.round(1)
+    summary.to_csv(summary_path, sep='\t', index=False)
+    report_path = os.path.join(os.path.dirname(summary_path), 'cohort_run_report.txt')
+    _, totals = aggregate_run_reports(summary.sample_dir)
+    totals.round(3).to_csv(report_path, sep='\t')
+    print("Stage totals: {}".format(report_path))
+    n_failed = (summary.status != 'success').sum()
+    print("Cohort complete: {} succeeded, {} failed. Summary: {}".format(
+        len(summary) - n_failed, n_failed, summary_path))
+    return summary
+
+
+def _init_worker(semaphores):
+    set_stage_limits(semaphores)
+    handle_sigterm()
+
+
+def _get_extract_kwargs(run_kw):
+    """extract_pairs arguments matching run_cnv's baf stage for run_kw."""
+    from .cohort_baf import DEFAULT_CHUNKSIZE
+    return dict(mq_cutoff=run_kw.get('mq_cutoff', 30), chroms_str=run_kw.get('chroms') or DEFAULT_CHROMS,
+                chunksize=run_kw.get('chunksize') or DEFAULT_CHUNKSIZE,
+                ratio_min=run_kw.get('ratio_min', 0.4), ratio_max=run_kw.get('ratio_max', 0.6),
+                min_depth_n=run_kw.get('min_normal', 10), min_depth_t=run_kw.get('min_tumor', 20),
+                min_gq_n=run_kw.get('min_gq', 90), compact=run_kw.get('compact_baf', False),
+                n_workers=run_kw.get('vcf_workers', 1))
+
+
+def _extract_group(vcf_path, pairs, extract_kw, log_path, use_cache=True):
+    """Extract BAF for pairs sharing a VCF, skipping pairs whose outputs are cached.
+
+    Outputs go to the run_cnv default paths in each sample dir, and are
+    recorded in its stage cache as an 'extract' stage.
+
+    Returns:
+        dict: error message per tumor_id of pairs whose extraction failed.
+    """
+    from .cohort_baf import extract_pairs, PairOutput
+    todo = []
+    for pair in pairs:
+        sample_dir = pair['sample_dir']
+        if not os.path.exists(sample_dir):
+            os.makedirs(sample_dir)
+        outputs = [os.path.join(sample_dir, 'baf.txt'), os.path.join(sample_dir, 'saas.parquet')]
+        stage = Stage('extract', None, inputs=[vcf_path], outputs=outputs,
+                      params=dict(extract_kw, tumor_id=pair['tumor_id'], normal_id=pair['normal_id']))
+        cache = StageCache(sample_dir)
+        key = cache.stage_key(stage)
+        if not (use_cache and cache.is_valid(stage, key)):
+            todo.append((PairOutput(pair['tumor_id'], pair['normal_id'], *outputs), stage, cache, key))
+    with open(log_path, 'w', buffering=1) as log, _redirect_output(log):
+        if not todo:
+            print("BAF outputs for all {} pairs are up to date.".format(len(pairs)))
+            return {}
+        try:
+            t0 = time.time()
+            failed = extract_pairs(vcf_path, [t[0] for t in todo], **extract_kw)
+        except Exception:
+            traceback.print_exc(file=log)
+            raise
+        for pair_output, stage, cache, key in todo:
+            if pair_output not in failed:
+                cache.record(stage, key, seconds=time.time() - t0)
+    return {pair_output.tumor_id: error for pair_output, error in failed.items()}
+
+
+def _pair_result(pair, **fields):
+    res = dict(case_id=pair['case_id'], tumor_id=pair['tumor_id'], normal_id=pair['normal_id'],
+               sample_dir=pair['sample_dir'], log_path=os.path.join(pair['sample_dir'], 'run_cnv.log'),
+               error='')
+    res.update(fields)
+    return res
+
+
+@contextlib.contextmanager
+def _redirect_output(log):
+    """Send stdout and stderr to log, at the file descriptor level.
+
+    Tools run with the default stdout/stderr (GATK, bedtools, Rscript, ...)
+    inherit descriptors 1 and 2 rather than sys.stdout, so these are pointed
+    at log too. Only for use in a pool worker, which runs one task at a time.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [(fd, os.dup(fd)) for fd in (1, 2)]
+    try:
+        for fd, _ in saved:
+            os.dup2(log.fileno(), fd)
+        with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+            yield
+    finally:
+        log.flush()
+        for fd, saved_fd in saved:
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+
+
+def _run_pair(pair, run_kw):
+    """Run run_cnv for one pair, logging its output and its tools' to <sample_dir>/run_cnv.log."""
+    sample_dir = pair['sample_dir']
+    if not os.path.exists(sample_dir):
+        os.makedirs(sample_dir)
+    res = _pair_result(pair)
+    log_path = res['log_path']
+    t0 = time.time()
+    with open(log_path, 'w', buffering=1) as log, _redirect_output(log):
+        try:
+            run_cnv(vcf_path=pair['vcf'], sample_dir=sample_dir,
+                    tumor_bam=pair['tumor_bam'], normal_bam=pair['normal_bam'],
+                    tumor_id=pair['tumor_id'], normal_id=pair['normal_id'],
+                    **run_kw)
+            res['status'] = 'success'
+        except Exception as e:
+            traceback.print_exc(file=log)
+            res['status'] = 'failed'
+            res['error'] = '{}: {}'.format(type(e).__name__, str(e).split('\n')[0])  # one line per pair
+    res['seconds'] = time.time() - t0
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser("CNV COHORT PIPELINE")
+    parser.add_argument('-S', '--sample_sheet', help='Tab-separated sample sheet with columns tumor_id, '
+                                                     'normal_id, vcf, tumor_bam, normal_bam', required=True)
+    parser.add_argument('-o', '--out_dir', help='Parent dir for sample dirs and cohort summary [.]',
+                        default='.')
+    parser.add_argument('-w', '--workers', help='Number of sample pairs to run concurrently [1]',
+                        type=int, default=1)
+    parser.add_argument('--stage_limit', help='Max concurrent pairs in a stage, as STAGE=N. '
+                                              'Repeatable. Stages: {}'.format(', '.join(STAGES)),
+                        action='append', default=[])
+    parser.add_argument('--joint_vcf', help='Extract BAF for all pairs sharing a VCF in one pass over it, '
+                                            'e.g. for a jointly called cohort VCF', action='store_true',
+                        default=False)
+    add_run_arguments(parser)
+
+    args = parser.parse_args()
+    if args.joint_vcf and args.trim_backend == 'gatk':
+        parser.error("--joint_vcf filters with the python trim backend, so cannot be used with "
+                     "--trim_backend gatk")
+    if args.joint_vcf:
+        args.fused = True  # no trimmed VCF, so no GATK reference needed
+    run_kw = get_run_kwargs(args)
+    handle_sigterm()
+    summary = run_cohort(args.sample_sheet, out_dir=args.out_dir, n_workers=args.workers,
+                         stage_limits=parse_stage_limits(args.stage_limit), joint_vcf=args.joint_vcf,
+                         **run_kw)
+    if (summary.status != 'success').any():
+        raise SystemExit(1)
+
+
+class SampleSheetError(Exception):
+    pass
@@ -0,0 +1,129 @@
+"""BAF extraction for many tumor/normal pairs from one cohort VCF, in a single pass.
+
+When a cohort is called jointly, every pair's fused trim and BAF pass
+reads and tokenizes the same multi-sample VCF. extract_pairs reads it
+once instead: for each chunk of records, the tests shared by all pairs
+(biallelic SNP, MQ, chromosome) are applied once, and each sample column's
+FORMAT fields are parsed once, however many pairs use that sample (e.g. a
+normal shared by several tumors). Then each pair's select_snps filter is
+applied and the passing records go to that pair's baf.txt and saas.parquet.
+Outputs match those of run_cnv's baf stage for the pair. A pair whose
+records cannot be parsed (e.g. a missing AD value) fails alone: its outputs
+are removed and the other pairs carry on.
+"""
+import time
+import contextlib
+from functools import partial
+from collections import namedtuple, Counter
+
+import numpy as np
+
+from .baf_from_vcf import extract_info_float, extract_format_fields, build_saas_table, BafWriter
+from .trim_vcf import snp_mask, pair_mask, VCF_FIXED_COLUMNS, NORMAL_FIELDS, _to_numeric
+from .vcf_io import read_vcf_header, read_vcf_chunks, indexed_chroms, map_vcf_regions
+
+DEFAULT_CHUNKSIZE = 50000  # VCF records per chunk; each chunk holds all sample columns
+
+PairOutput = namedtuple('PairOutput', ['tumor_id', 'normal_id', 'baf_path', 'parquet_path'])
+
+
+def extract_pairs(vcf_path, pairs, mq_cutoff=30, chroms_str=None, chunksize=DEFAULT_CHUNKSIZE,
+                  ratio_min=0.4, ratio_max=0.6, min_depth_n=10, min_depth_t=20, min_gq_n=90,
+                  compact=False, n_workers=1):
+    """Write baf.txt and saas.parquet for each pair from one pass over a cohort VCF.
+
+    Args:
+        vcf_path (str): multi-sample VCF holding all tumor and normal columns.
+        pairs (list): PairOutput per tumor/normal pair.
+        chroms_str (str): comma-separated chromosomes to retain.
+        ratio_min, ratio_max, min_depth_{n,t}, min_gq_n: as for select_snps,
+            shared by all pairs.
+        compact (bool): write parquet in the compact baf_store layout. See BafWriter.
+        n_workers (int): if vcf_path is an indexed .vcf.gz or BCF, read only
+            the chroms_str chromosomes, on this many processes.
+
+    Returns:
+        dict: error message per failed PairOutput. Failed pairs have no outputs.
+        An error that is not specific to a pair (e.g. reading the VCF) is
+        raised, leaving no outputs for any pair.
+    """
+    meta, columns = read_vcf_header(vcf_path)
+    missing = sorted({s for p in pairs for s in (p.tumor_id, p.normal_id)} - set(columns))
+    if missing:
+        raise ValueError("Samples not found in VCF header ({}): {}".format(vcf_path, missing))
+    filter_kw = dict(ratio_min=ratio_min, ratio_max=ratio_max, min_depth_n=min_depth_n,
+                     min_depth_t=min_depth_t, min_gq_n=min_gq_n)
+    chrom_list = chroms_str.split(',')
+    print("Extracting BAF for {} pairs from {} in chunks of {} records.".format(
+        len(pairs), vcf_path, chunksize))
+    t0 = time.time()
+    to_tables = partial(_pair_tables, pairs=pairs, mq_cutoff=mq_cutoff, chrom_list=chrom_list, **filter_kw)
+    regions = indexed_chroms(vcf_path, chrom_list)
+    if regions is not None:
+        chunk_tables = map_vcf_regions(to_tables, vcf_path, regions, n_workers=n_workers, chunksize=chunksize)
+    else:
+        chunk_tables = (to_tables(df) for df in read_vcf_chunks(vcf_path, len(meta), chunksize=chunksize))
+    failed = {}
+    with contextlib.ExitStack() as stack:
+        writers = [stack.enter_context(BafWriter(p.baf_path, p.parquet_path, compact=compact))
+                   for p in pairs]
+        for tables in chunk_tables:
+            for pair, writer, table in zip(pairs, writers, tables):
+                if pair in failed:
+                    continue
+                try:
+                    if isinstance(table, Exception):
+                        raise table
+                    writer.write(table)
+                except Exception as e:
+                    writer.discard()
+                    failed[pair] = '{}: {}'.format(type(e).__name__, e)
+                    print("{}: BAF extraction failed ({}).".format(pair.tumor_id, failed[pair]))
+    print("Extracted BAF for {} pairs in {:.1f}s ({} failed).".format(
+        len(pairs) - len(failed), time.time() - t0, len(failed)))
+    return failed
+
+
+def iter_pair_tables(df, pairs, mq_cutoff=30, chrom_list=None, **filter_kw):
+    """Yield each pair's saasCNV table for one chunk of VCF records, in pair order.
+
+    Each table equals vcf_to_saas_table applied to the pair's select_snps
+    records. A sample's parsed FORMAT fields are kept only until the last
+    pair using it in this chunk. If a pair's records cannot be parsed, the
+    exception is yielded in place of its table, so other pairs are unaffected.
+    """
+    mq = extract_info_float(df.INFO, key='MQ')
+    shared = snp_mask(df) & (mq > mq_cutoff) & df['#CHROM'].isin(chrom_list)
+    df, mq = df.loc[shared], mq.loc[shared]
+    uses = Counter(s for p in pairs for s in (p.tumor_id, p.normal_id))
+    fields = {}
+    for pair in pairs:
+        try:
+            for sample_id in (pair.tumor_id, pair.normal_id):
+                if sample_id not in fields:
+                    fields[sample_id] = extract_format_fields(df.FORMAT, df[sample_id], fields=NORMAL_FIELDS)
+            tumor, normal = fields[pair.tumor_id], fields[pair.normal_id]
+            keep = pair_mask(normal, _to_numeric(tumor.DP), **filter_kw)
+            table = build_saas_table(df.loc[keep, VCF_FIXED_COLUMNS], mq.loc[keep],
+                                     _gt_ad(tumor.loc[keep]), _gt_ad(normal.loc[keep]),
+                                     mq_cutoff=mq_cutoff, chrom_list=chrom_list)
+        except Exception as e:
+            table = e
+        yield table
+        for sample_id in (pair.tumor_id, pair.normal_id):
+            uses[sample_id] -= 1
+            if not uses[sample_id]:
+                fields.pop(sample_id, None)
+
+
+def _pair_tables(df, pairs, **kwargs):
+    return list(iter_pair_tables(df, pairs, **kwargs))
+
+
+def _gt_ad(sample_fields):
+    """Genotype, ref depth and alt depth series from parsed FORMAT fields, as extract_gt_ad."""
+    missing = sample_fields.AD.isnull()
+    if missing.any():
+        raise ValueError("AD missing for {} records.".format(missing.sum()))
+    ad = sample_fields.AD.str.split(',', n=2)
+    return (sample_fields.GT, ad.str[0].astype(np.int64), ad.str[1].astype(np.int64))
@@ -0,0 +1,313 @@
+"""Compact binary store for per-base coverage over target intervals.
+
+A coverage store is a directory holding:
+    targets.bed: the target BED lines, in order.
+    offsets.npy: int64 array (n_targets + 1); target i covers
+        depth[offsets[i]:offsets[i + 1]].
+    depth.npy: uint32 per-base depth for all targets, concatenated.
+    summary.tsv: per-target aggregate depth (mean, min, max).
+
+This replaces the one-line-per-base text written by `bedtools coverage -d`,
+which can be exported on demand with export_per_base_bed. Existing text
+files can be converted with text_to_coverage_store, and stores read without
+copying through CoverageStore. The cnv_coverage command wraps these.
+"""
+import os
+import sys
+import csv
+import shutil
+import argparse
+
+import numpy as np
+import pandas as pd
+
+DEPTH_DTYPE = np.uint32
+EXPORT_CHUNK_BASES = 2000000
+IMPORT_CHUNK_LINES = 5000000
+
+
+def write_coverage_store(store_dir, bed_lines, depths):
+    """Write per-target depth arrays to a coverage store.
+
+    Args:
+        store_dir (str): output directory, replaced if it exists.
+        bed_lines (list): target BED lines (without newline), in output order.
+        depths (iterable): per-base depth array for each target, in the same order.
+    """
+    tmp_dir = new_store_tmp_dir(store_dir)
+    raw_path = os.path.join(tmp_dir, 'depth.u32')
+    lengths = write_raw_depths(raw_path, depths)
+    assemble_coverage_store(store_dir, bed_lines, [raw_path], lengths)
+
+
+def new_store_tmp_dir(store_dir):
+    """Create empty staging dir for store_dir, for raw depth files."""
+    tmp_dir = store_dir.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    return tmp_dir
+
+
+def write_raw_depths(raw_path, depths):
+    """Append uint32 depth arrays to a raw file. Returns list of array lengths."""
+    lengths = []
+    with open(raw_path, 'wb') as out:
+        for depth in depths:
+            depth = np.asarray(depth, dtype=DEPTH_DTYPE)
+            out.write(depth.tobytes())
+            lengths.append(len(depth))
+    return lengths
+
+
+def assemble_coverage_store(store_dir, bed_lines, raw_paths, lengths):
+    """Merge raw depth files (in order) from the staging dir into store_dir.
+
+    Args:
+        raw_paths (list): raw uint32 files in the staging dir, e.g. one per
+            shard, whose concatenation covers all targets in bed_lines order.
+        lengths (list): per-target depth array lengths, in bed_lines order.
+    """
+    if len(lengths) != len(bed_lines):
+        raise ValueError("Got {} depth arrays for {} targets.".format(len(lengths), len(bed_lines)))
+    tmp_dir = store_dir.rstrip('/') + '.tmp'
+    offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+    _raw_to_npy(raw_paths, os.path.join(tmp_dir, 'depth.npy'), offsets[-1])
+    np.save(os.path.join(tmp_dir, 'offsets.npy'), offsets)
+    with open(os.path.join(tmp_dir, 'targets.bed'), 'w') as out:
+        for line in bed_lines:
+            out.write(line + '\n')
+    _write_summary(tmp_dir, bed_lines, offsets)
+    if os.path.exists(store_dir):
+        shutil.rmtree(store_dir)
+    os.rename(tmp_dir, store_dir)
+
+
+def text_to_coverage_store(text_path, store_dir, chunksize=IMPORT_CHUNK_LINES):
+    """Convert `bedtools coverage -d` per-base text to a coverage store.
+
+    The text is streamed in chunks of lines. Each line holds the target BED
+    fields, the 1-based position within the target and the depth; a target
+    starts at each position 1. Zero-length targets have no lines, so are
+    absent from the store.
+    """
+    print("Converting per-base coverage {} to store {}".format(text_path, store_dir))
+    with open(text_path) as f:
+        first = f.readline()
+    if not first.strip():
+        raise CoverageStoreError("Empty coverage file: {}".format(text_path))
+    n_bed = len(first.rstrip('\r\n').split('\t')) - 2
+    if n_bed < 3:
+        raise CoverageStoreError("Expected BED fields, position and depth in {}".format(text_path))
+    tmp_dir = new_store_tmp_dir(store_dir)
+    raw_path = os.path.join(tmp_dir, 'depth.u32')
+    bed_lines, lengths = [], []
+    reader = pd.read_csv(text_path, sep='\t', header=None, dtype=str, na_filter=False,
+                         quoting=csv.QUOTE_NONE, chunksize=chunksize)
+    with reader, open(raw_path, 'wb') as out:
+        for df in reader:
+            pos = df[n_bed].to_numpy(dtype=np.int64)
+            starts = np.flatnonzero(pos == 1)
+            first_start = starts[0] if len(starts) else len(df)
+            if first_start:  # continues the previous chunk's last target
+                if not lengths:
+                    raise CoverageStoreError("{} does not start at position 1.".format(text_path))
+                lengths[-1] += int(first_start)
+            lengths.extend(np.diff(np.r_[starts, len(df)]).tolist())
+            keys = df.iloc[starts, 0]
+            for col in range(1, n_bed):
+                keys = keys + '\t' + df.iloc[starts, col]
+            bed_lines.extend(keys.tolist())
+            out.write(df[n_bed + 1].to_numpy(dtype=DEPTH_DTYPE).tobytes())
+    assemble_coverage_store(store_dir, bed_lines, [raw_path], lengths)
+    print("...coverage store written: {} ({} targets)".format(store_dir, len(bed_lines)))
+
+
+class CoverageStore:
+    """Read-only view of a coverage store, with the depth array memory-mapped.
+
+    Depth slices returned by target_depth and region_depth are views into the
+    mapped file, so no per-base data is copied or parsed.
+
+    Attributes:
+        bed_lines (list): target BED lines.
+        offsets (np.ndarray): depth offset of each target, plus total length.
+        depth (np.memmap): per-base depth of all targets, concatenated.
+        targets (pd.DataFrame): chrom, start, end of each target.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.bed_lines, self.offsets, self.depth = load_coverage_store(store_dir)
+        fields = [line.split('\t', 3) for line in self.bed_lines]
+        self.targets = pd.DataFrame({'chrom': [f[0] for f in fields],
+                                     'start': np.array([f[1] for f in fields], dtype=np.int64),
+                                     'end': np.array([f[2] for f in fields], dtype=np.int64)})
+
+    def __len__(self):
+        return len(self.bed_lines)
+
+    def target_depth(self, i):
+        """Per-base depth of target i (a view)."""
+        return self.depth[self.offsets[i]:self.offsets[i + 1]]
+
+    def region_depth(self, chrom, start, end):
+        """Depth over targets overlapping the 0-based, half-open region.
+
+        Returns:
+            list: (target index, first base, depth view) per overlapping
+                target, clipped to the region, in store order.
+        """
+        t = self.targets
+        hits = np.flatnonzero((t.chrom.to_numpy() == str(chrom)) & (t.start.to_numpy() < end)
+                              & (t.end.to_numpy() > start))
+        out = []
+        for i in hits:
+            t_start = t.start.iat[i]
+            lo = max(start, t_start)
+            hi = min(end, t_start + self.offsets[i + 1] - self.offsets[i])
+            if hi > lo:
+                view = self.depth[self.offsets[i] + lo - t_start:self.offsets[i] + hi - t_start]
+                out.append((int(i), int(lo), view))
+        return out
+
+    def summary(self):
+        """Per-target mean, min and max depth (from summary.tsv)."""
+        return pd.read_csv(os.path.join(self.store_dir, 'summary.tsv'), sep='\t', dtype={'chrom': str})
+
+    def export(self, out_path):
+        """Write `bedtools coverage -d` style text, for ADTEx."""
+        export_per_base_bed(self.store_dir, out_path)
+
+
+def load_coverage_store(store_dir, mmap_mode='r'):
+    """Load target BED lines, offsets and (memory-mapped) depth array."""
+    with open(os.path.join(store_dir, 'targets.bed')) as f:
+        bed_lines = f.read().splitlines()
+    offsets = np.load(os.path.join(store_dir, 'offsets.npy'))
+    depth = np.load(os.path.join(store_dir, 'depth.npy'), mmap_mode=mmap_mode)
+    return bed_lines, offsets, depth
+
+
+def export_per_base_bed(store_dir, out_path):
+    """Write store as `bedtools coverage -d` text, for ADTEx.
+
+    Each line holds the target BED fields, the 1-based position within the
+    target and the depth at that base.
+    """
+    print("Exporting per-base coverage from {} to {}".format(store_dir, out_path))
+    bed_lines, offsets, depth = load_coverage_store(store_dir)
+    lengths = np.diff(offsets)
+    with open(out_path, 'w') as out:
+        start = 0
+        while start < len(bed_lines):
+            # group targets into chunks of roughly EXPORT_CHUNK_BASES bases
+            stop = max(start + 1, np.searchsorted(offsets, offsets[start] + EXPORT_CHUNK_BASES, 'right') - 1)
+            stop = min(stop, len(bed_lines))
+            out.write(_per_base_text(bed_lines[start:stop], lengths[start:stop],
+                                     depth[offsets[start]:offsets[stop]]))
+            start = stop
+
+
+def write_per_base_bed(out_path, bed_lines, depths):
+    """Write per-target depth arrays directly as `bedtools coverage -d` text."""
+    with open(out_path, 'w') as out:
+        chunk_lines, chunk_depths = [], []
+        n_bases = 0
+        for line, depth in zip(bed_lines, depths):
+            chunk_lines.append(line)
+            chunk_depths.append(np.asarray(depth, dtype=DEPTH_DTYPE))
+            n_bases += len(depth)
+            if n_bases >= EXPORT_CHUNK_BASES:
+                out.write(_per_base_text(chunk_lines, [len(d) for d in chunk_depths],
+                                         np.concatenate(chunk_depths)))
+                chunk_lines, chunk_depths = [], []
+                n_bases = 0
+        if chunk_lines:
+            out.write(_per_base_text(chunk_lines, [len(d) for d in chunk_depths],
+                                     np.concatenate(chunk_depths)))
+
+
+def _per_base_text(bed_lines, lengths, depth):
+    """Format consecutive targets and their concatenated depths as per-base lines."""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    n_bases = lengths.sum()
+    if not n_bases:
+        return ''
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    target_ind = np.repeat(np.arange(len(lengths)), lengths)
+    pos = np.arange(n_bases) - np.repeat(starts, lengths) + 1
+    target = pd.Series(np.asarray(bed_lines, dtype=object)[target_ind])
+    lines = target + '\t' + pd.Series(pos).astype(str) + '\t' + pd.Series(depth).astype(str)
+    return '\n'.join(lines) + '\n'
+
+
+def _write_summary(store_dir, bed_lines, offsets):
+    depth = np.load(os.path.join(store_dir, 'depth.npy'), mmap_mode='r')
+    lengths = np.diff(offsets)
+    nonempty = lengths > 0
+    sums = np.zeros(len(lengths))
+    mins = np.zeros(len(lengths), dtype=DEPTH_DTYPE)
+    maxs = np.zeros(len(lengths), dtype=DEPTH_DTYPE)
+    if nonempty.any():
+        starts = offsets[:-1][nonempty]
+        sums[nonempty] = np.add.reduceat(depth, starts, dtype=np.float64)
+        mins[nonempty] = np.minimum.reduceat(depth, starts)
+        maxs[nonempty] = np.maximum.reduceat(depth, starts)
+    fields = [line.split('\t') for line in bed_lines]
+    summary = pd.DataFrame({'chrom': [f[0] for f in fields],
+                            'start': [int(f[1]) for f in fields],
+                            'end': [int(f[2]) for f in fields],
+                            'mean_depth': np.where(nonempty, sums / np.maximum(lengths, 1), np.nan),
+                            'min_depth': mins, 'max_depth': maxs})
+    summary.to_csv(os.path.join(store_dir, 'summary.tsv'), sep='\t', index=False,
+                   float_format='%.2f')
+
+
+def _raw_to_npy(raw_paths, npy_path, n):
+    """Concatenate raw uint32 files into .npy format without holding them in memory."""
+    n = int(n)
+    arr = np.lib.format.open_memmap(npy_path, mode='w+', dtype=DEPTH_DTYPE, shape=(n,))
+    pos = 0
+    for raw_path in raw_paths:
+        n_raw = os.path.getsize(raw_path) // np.dtype(DEPTH_DTYPE).itemsize
+        if n_raw:
+            raw = np.memmap(raw_path, dtype=DEPTH_DTYPE, mode='r', shape=(n_raw,))
+            for i in range(0, n_raw, EXPORT_CHUNK_BASES):
+                block = raw[i:i + EXPORT_CHUNK_BASES]
+                arr[pos:pos + len(block)] = block
+                pos += len(block)
+            del raw
+        os.remove(raw_path)
+    if pos != n:
+        raise ValueError("Raw depth files hold {} bases, expected {}.".format(pos, n))
+    arr.flush()
+    del arr
+
+
+def main():
+    parser = argparse.ArgumentParser("CNV COVERAGE STORE")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    p = subparsers.add_parser('import', help='Convert bedtools coverage -d text to a coverage store')
+    p.add_argument('text_path', help='Per-base coverage text, e.g. tumor_cov.bed')
+    p.add_argument('store_dir', help='Output store dir, e.g. tumor_cov.cov')
+    p.add_argument('--remove_text', help='Delete the text file after conversion',
+                   action='store_true', default=False)
+    p = subparsers.add_parser('export', help='Write a coverage store as bedtools coverage -d text')
+    p.add_argument('store_dir', help='Coverage store dir')
+    p.add_argument('text_path', help='Output per-base coverage text')
+    p = subparsers.add_parser('summary', help='Print per-target depth summary')
+    p.add_argument('store_dir', help='Coverage store dir')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        text_to_coverage_store(args.text_path, args.store_dir)
+        if args.remove_text:
+            os.remove(args.text_path)
+    elif args.command == 'export':
+        export_per_base_bed(args.store_dir, args.text_path)
+    else:
+        CoverageStore(args.store_dir).summary().to_csv(sys.stdout, sep='\t', index=False)
+
+
+class CoverageStoreError(Exception):
+    pass
@@ -0,0 +1,147 @@
+"""Genome dictionary: chromosome names and lengths, in reference order.
+
+Dictionaries are read from the @SQ lines of a BAM/CRAM header or a sequence
+dictionary (.dict), or from a FASTA index (.fai) or genome.txt file.
+Dictionaries read from a reference index or a BAM header are cached on disk,
+keyed by the file's path, size and modification time, so that e.g. all
+samples in a cohort share one parse of the reference index, and reruns do
+not read BAM headers again. The cache dir is $CNV_GENOME_CACHE, or
+~/.cache/cnv_pipeline/genome by default.
+"""
+import os
+import hashlib
+import functools
+import subprocess
+
+from .supervisor import get_tool_policy
+
+GENOME_CACHE_ENV = 'CNV_GENOME_CACHE'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'cnv_pipeline', 'genome')
+ALIGNMENT_EXTENSIONS = ('.bam', '.cram', '.sam')
+
+
+def get_genome_dict(bam_path=None, ref_fasta=None, cache_dir=None):
+    """Return [(chrom, length)], preferring the (cached) reference index.
+
+    Args:
+        bam_path (str): BAM/CRAM, read if ref_fasta is not given or has no
+            .fai/.dict index.
+        ref_fasta (str): [optional] reference FASTA, with .fai or .dict alongside.
+        cache_dir (str): [optional] override the cache dir.
+    """
+    if ref_fasta is not None:
+        try:
+            return reference_genome_dict(ref_fasta, cache_dir=cache_dir)
+        except GenomeDictError as e:
+            if bam_path is None:
+                raise
+            print("{} Reading BAM header instead.".format(e))
+    if bam_path is None:
+        raise GenomeDictError("Need a BAM or reference FASTA to build a genome dictionary.")
+    return cached_genome_dict(bam_path, cache_dir=cache_dir)
+
+
+def reference_genome_dict(ref_fasta, cache_dir=None):
+    """Genome dictionary from the .fai/.dict index of ref_fasta, via the cache."""
+    return cached_genome_dict(find_reference_index(ref_fasta), cache_dir=cache_dir)
+
+
+def cached_genome_dict(path, cache_dir=None):
+    """read_genome_dict of path, via the in-process and on-disk caches."""
+    if cache_dir is None:
+        cache_dir = os.environ.get(GENOME_CACHE_ENV, DEFAULT_CACHE_DIR)
+    path = os.path.realpath(path)
+    return list(_cached_genome_dict(path, file_key(path), cache_dir))
+
+
+def find_reference_index(ref_fasta):
+    """Return path of the .fai or .dict index for ref_fasta."""
+    stem = ref_fasta[:-3] if ref_fasta.endswith('.gz') else ref_fasta
+    candidates = [ref_fasta + '.fai', os.path.splitext(stem)[0] + '.dict', ref_fasta + '.dict']
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    raise GenomeDictError("No .fai or .dict index found for {}.".format(ref_fasta))
+
+
+def read_genome_dict(path):
+    """Return [(chrom, length)] from a BAM/CRAM/SAM, .dict, .fai or genome.txt file."""
+    if path.endswith(ALIGNMENT_EXTENSIONS):
+        return parse_sq_lines(_alignment_header_lines(path))
+    if path.endswith('.dict'):
+        with open(path) as f:
+            return parse_sq_lines(f)
+    genome = []  # .fai and genome.txt: name and length in the first two columns
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                chrom, length = line.rstrip('\r\n').split('\t')[:2]
+                genome.append((chrom, int(length)))
+    return genome
+
+
+def parse_sq_lines(lines):
+    """Parse @SQ header lines (SAM header or .dict) to [(chrom, length)]."""
+    genome = []
+    for line in lines:
+        if not line.startswith('@SQ'):
+            continue
+        tags = dict(field.split(':', 1) for field in line.rstrip('\r\n').split('\t')[1:] if ':' in field)
+        if 'SN' not in tags or 'LN' not in tags:
+            raise GenomeDictError("Malformed @SQ line: {}".format(line.rstrip()))
+        genome.append((tags['SN'], int(tags['LN'])))
+    if not genome:
+        raise GenomeDictError("No @SQ lines found.")
+    return genome
+
+
+def write_genome_file(genome, genome_path):
+    """Write [(chrom, length)] as genome.txt, for bedtools -g."""
+    tmp_path = '{}.{}.tmp'.format(genome_path, os.getpid())
+    with open(tmp_path, 'w') as out:
+        for chrom, length in genome:
+            out.write('{}\t{}\n'.format(chrom, length))
+    os.replace(tmp_path, genome_path)
+
+
+def file_key(path):
+    """Cache key from the path, size and modification time of a file, without reading it."""
+    st = os.stat(path)
+    return hashlib.sha256('{}\0{}\0{}'.format(path, st.st_size, st.st_mtime_ns).encode()).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_genome_dict(path, key, cache_dir):
+    cache_path = os.path.join(cache_dir, key + '.genome.txt')
+    if os.path.exists(cache_path):
+        return tuple(read_genome_dict(cache_path))
+    genome = read_genome_dict(path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_genome_file(genome, cache_path)
+    except OSError as e:
+        print("Could not cache genome dictionary in {}: {}".format(cache_dir, e))
+    return tuple(genome)
+
+
+def _alignment_header_lines(path):
+    """SAM header lines via pysam if installed, else a single samtools call."""
+    try:
+        import pysam
+    except ImportError:
+        try:
+            proc = subprocess.run(['samtools', 'view', '-H', path], stdin=subprocess.DEVNULL,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                                  timeout=get_tool_policy('samtools').timeout)
+        except subprocess.TimeoutExpired as e:
+            raise GenomeDictError("samtools view -H {} timed out after {}s.".format(path, e.timeout))
+        if proc.returncode != 0:
+            raise GenomeDictError("samtools view -H {} failed ({}): {}".format(
+                path, proc.returncode, proc.stderr.strip()))
+        return proc.stdout.splitlines()
+    with pysam.AlignmentFile(path) as f:
+        return str(f.header).splitlines()
+
+
+class GenomeDictError(Exception):
+    pass
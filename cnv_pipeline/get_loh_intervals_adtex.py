@@ -1,12 +1,11 @@
 """Parse ADTEx results, identify LOH-SNP CNV intervals, trim and plot."""
 
 import os
-import shlex
-import subprocess
 
 import numpy as np
 import pandas as pd
 
+from .intervals import overlaps_any
 from .plot_chr_axis import plot_chr_axis, plot_chr_intervals
 
 chroms = ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '11', '12',
@@ -14,17 +13,18 @@ chroms = ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '11', '12',
           'Y', 'MT']
 
 
-def finalize_loh(proj_dir):
+def finalize_loh(proj_dir, genome=None, density=False):
     zygosity_df, loh_segs = prep_loh_dataframes(proj_dir)
     loh_segs = trim_loh_intervals(zygosity_df, loh_segs, out_dir=proj_dir)  # min_ratio=0.8
-    plot_loh(loh_segs, zygosity_df, out_dir=proj_dir)
+    plot_loh(loh_segs, zygosity_df, out_dir=proj_dir, genome=genome, density=density)
 
 
 def prep_loh_dataframes(proj_dir):
     """Builds preliminary LOH dataframes from ADTEx results, ready for trimming.
 
-    loh_snps.bed: contains SNPs marked as loh in proj_dir/zygosity/zygosity.res
-    cnv_interval.bed: all CNV segments, extracted from proj_dir/cnv.result
+    LOH SNPs (from proj_dir/zygosity/zygosity.res) are intersected in memory
+    with all CNV segments (from proj_dir/cnv.result), keeping segments that
+    contain at least one LOH SNP (equivalent to `intersectBed -wa -u`).
 
     Args:
         proj_dir (str): adtex output dir. Includes cnv.result and 'zygosity' dir.
@@ -36,41 +36,23 @@ def prep_loh_dataframes(proj_dir):
     print(f"Building preliminary loh dataframes in {proj_dir}")
     res_path = os.path.join(proj_dir, 'zygosity', 'zygosity.res')
     cnv_path = os.path.join(proj_dir, 'cnv.result')
-    # TEMPORARY FILES
-    snp_out = os.path.join(proj_dir, 'temp_loh_snps.bed')
-    cnv_out = os.path.join(proj_dir, 'temp_cnv_interval.bed')
-    loh_bed = os.path.join(proj_dir, 'temp_loh_intervals.bed')
 
     z = pd.read_csv(res_path, sep='\t', dtype={'chrom': str})
     z.chrom = pd.Categorical(z.chrom, categories=chroms, ordered=True)
-    # SAVE SNP BED FILE
     z_loh = z[z.zygosity == 'LOH']
-    loh_snp_bed = pd.concat([z_loh.chrom, z_loh.SNP_loc - 1, z_loh.SNP_loc], axis=1)
-    loh_snp_bed.to_csv(snp_out, index=False, sep='\t', header=False)
-    # SAVE CNV_INTERVAL BED FILE
-    cnv = pd.read_csv(cnv_path, sep='\t', 
+    cnv = pd.read_csv(cnv_path, sep='\t',
                       dtype={'chr': str})
     cnv.rename(columns={'chr': 'chrom'}, inplace=True)
-    interval_bed = pd.concat([cnv.chrom, cnv.CNV_start - 1, cnv.CNV_end], axis=1).drop_duplicates()
-    interval_bed.to_csv(cnv_out, index=False, sep='\t', header=False)
-
-    # BEDTOOLS INTERSECTION
-    """intersectBed -b loh_snps.bed -a cnv_interval.bed -wa -u  > loh_intervals.bed;"""
-    print("Running bedtools intersection")
-    cmd = "intersectBed -b {snps} -a {cnv} -wa -u".format(snps=snp_out, cnv=cnv_out)
-    with open(loh_bed, 'w') as out:
-        proc = subprocess.Popen(shlex.split(cmd), stdin=subprocess.DEVNULL, stdout=out)
-        proc.communicate()
-
-    loh_segs = pd.read_csv(loh_bed, sep='\t', header=None, 
-                           names=['chrom', 'pos_start', 'pos_end'], dtype={'chrom': str})
+    intervals = pd.DataFrame({'chrom': cnv.chrom, 'pos_start': cnv.CNV_start - 1,
+                              'pos_end': cnv.CNV_end}).drop_duplicates()
+
+    print("Intersecting CNV intervals with LOH SNPs")
+    loh_segs = intervals[overlaps_any(intervals.chrom, intervals.pos_start, intervals.pos_end,
+                                      z_loh.chrom, z_loh.SNP_loc - 1, z_loh.SNP_loc)]
+    loh_segs = loh_segs.reset_index(drop=True)
     loh_segs.chrom = pd.Categorical(loh_segs.chrom, categories=chroms, ordered=True)
     loh_segs['orig_start'] = loh_segs['pos_start']
     loh_segs['orig_end'] = loh_segs['pos_end']
-    
-    # Remove temporary files
-    for i in [snp_out, cnv_out, loh_bed]:
-        os.remove(i)
 
     return z, loh_segs
 
@@ -94,22 +76,18 @@ def trim_loh_intervals(z, loh_segs, out_dir=None, min_ratio=0.8):
     final_path = os.path.join(out_dir, 'loh_intervals_final.bed')
 
     z.sort_values(['chrom', 'SNP_loc'], inplace=True)  # Ensure z is sorted
-    for ind, seg in loh_segs.iterrows():
-        try:
-            l_a = z[(z.chrom == seg.chrom) & (z.SNP_loc > seg.pos_start) & (z.zygosity == 'LOH')].iloc[0]
-        except IndexError:
-            break
-        l_b = z[(z.chrom == seg.chrom) & (z.SNP_loc <= seg.pos_end) & (z.zygosity == 'LOH')].iloc[-1]
-        l_d = l_b.SNP_loc - l_a.SNP_loc
-        s_d = seg.pos_end - seg.pos_start - 1
-        seg_ratio = l_d / s_d if s_d != 0 else 0
-        # delete seg if only one LOH point
-        if l_a.name == l_b.name:
-            loh_segs.loc[seg.name, ['pos_start', 'pos_end']] = (np.nan, np.nan)
-            continue  # !!!
-        # update seg if smaller than ratio
-        if seg_ratio < min_ratio:
-            loh_segs.loc[seg.name, ['pos_start', 'pos_end']] = (l_a.SNP_loc - 1, l_b.SNP_loc)
+    first, last, count = loh_snp_bounds(z, loh_segs)
+    s_d = (loh_segs.pos_end - loh_segs.pos_start - 1).to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        seg_ratio = np.where(s_d != 0, (last - first) / s_d, 0)
+    # delete seg if fewer than two LOH points
+    drop = count <= 1
+    # update seg if smaller than ratio
+    shrink = ~drop & (seg_ratio < min_ratio)
+    loh_segs[['pos_start', 'pos_end']] = loh_segs[['pos_start', 'pos_end']].astype(float)
+    loh_segs.loc[drop, ['pos_start', 'pos_end']] = np.nan
+    loh_segs.loc[shrink, 'pos_start'] = first[shrink] - 1
+    loh_segs.loc[shrink, 'pos_end'] = last[shrink]
 
     # dropped
     loh_segs.loc[loh_segs.isnull().any(axis=1), ['chrom', 'orig_start', 'orig_end']]\
@@ -124,13 +102,48 @@ def trim_loh_intervals(z, loh_segs, out_dir=None, min_ratio=0.8):
     return loh_segs
 
 
-def plot_loh(loh, z, out_dir=None, y_var='tumor_BAF'):
+def loh_snp_bounds(z, loh_segs):
+    """First and last LOH SNP position within each segment, in one vectorized pass.
+
+    A segment covers SNP_loc in (pos_start, pos_end]. LOH SNP positions are
+    sorted per chromosome and segment bounds located with searchsorted.
+
+    Returns:
+        first (np.ndarray): first LOH SNP_loc per segment, NaN if none.
+        last (np.ndarray): last LOH SNP_loc per segment, NaN if none.
+        count (np.ndarray): number of LOH SNPs per segment.
+    """
+    n = len(loh_segs)
+    first = np.full(n, np.nan)
+    last = np.full(n, np.nan)
+    count = np.zeros(n, dtype=np.int64)
+    seg_chrom = loh_segs.chrom.astype(object).to_numpy()
+    starts = loh_segs.pos_start.to_numpy()
+    ends = loh_segs.pos_end.to_numpy()
+    loh = z[z.zygosity == 'LOH']
+    for chrom, snp_loc in loh.groupby(loh.chrom.astype(object)).SNP_loc:
+        pos = np.sort(snp_loc.to_numpy())
+        ind = np.flatnonzero(seg_chrom == chrom)
+        lo = np.searchsorted(pos, starts[ind], side='right')
+        hi = np.searchsorted(pos, ends[ind], side='right')
+        count[ind] = np.maximum(hi - lo, 0)
+        has = count[ind] > 0
+        first[ind[has]] = pos[lo[has]]
+        last[ind[has]] = pos[hi[has] - 1]
+    return first, last, count
+
+
+def plot_loh(loh, z, out_dir=None, y_var='tumor_BAF', genome=None, density=False):
     """Plot ADTEx zygosity calls for filtered SNPs with boxes for LOH regions.
     Args:
         loh (df): stripped loh segs. start pos is 0-based.
         z (pd.DataFrame): raw zygosity dataframe, from ADTEx.
         out_dir (str): [optional] directory in which to save plot.
         y_var (str): z column name for y axis data.
+        genome: [optional] genome dictionary or genome.txt path for the x axis.
+            Default is hg19.
+        density (bool): draw SNPs as density images rather than markers,
+            see plot_chr_axis.
     """
     print('Plotting LOH.')
     if out_dir is None:
@@ -140,13 +153,13 @@ def plot_loh(loh, z, out_dir=None, y_var='tumor_BAF'):
     use_MT = (z.chrom == 'MT').any()
 
     out_path = os.path.join(out_dir, 'LOH_plot.png')
-
     loh.pos_start += 1  # convert from BED format
 
     # Plot raw data using zygosity calls for colors
     ax = None
-    arg_dict = dict(figsize=(19, 3), ylim=(0, 1), use_Y=use_Y, use_MT=use_MT)
-    update_dict = dict(format_axis=False, use_Y=use_Y, use_MT=use_MT)
+    arg_dict = dict(figsize=(19, 3), ylim=(0, 1), use_Y=use_Y, use_MT=use_MT, genome=genome,
+                    density=density)
+    update_dict = dict(format_axis=False, use_Y=use_Y, use_MT=use_MT, genome=genome, density=density)
 
     if sum(z.zygosity == 'LOH'):
         ax = plot_chr_axis('chrom', 'SNP_loc', y_var,
@@ -169,7 +182,8 @@ def plot_loh(loh, z, out_dir=None, y_var='tumor_BAF'):
 
     # Draw rectangles for intervals
     if len(loh):
-        plot_chr_intervals(ax, 'chrom', 'pos_start', 'pos_end', data=loh, use_Y=use_Y, use_MT=use_MT)
+        plot_chr_intervals(ax, 'chrom', 'pos_start', 'pos_end', data=loh, use_Y=use_Y, use_MT=use_MT,
+                           genome=genome)
 
     ax.set_xlabel('')
     ax.set_ylabel('Tumor BAF')
@@ -0,0 +1,55 @@
+"""In-process genomic interval overlap queries.
+
+Intervals are BED-style: 0-based, half-open [start, end), and non-empty.
+Queries take NumPy arrays or pandas Series and run a sorted sweep per
+chromosome: with the starts and ends of the B intervals sorted, the number
+of B intervals overlapping an A interval is
+
+    #(B.start < A.end) - #(B.end <= A.start)
+
+which is two searchsorted calls per chromosome, for all A intervals at once.
+"""
+import numpy as np
+import pandas as pd
+
+
+def count_overlaps(a_chrom, a_start, a_end, b_chrom, b_start, b_end):
+    """Number of B intervals overlapping each A interval.
+
+    Args:
+        a_chrom, a_start, a_end: A intervals, as array-likes of equal length.
+        b_chrom, b_start, b_end: B intervals.
+
+    Returns:
+        np.ndarray: int64 count per A interval, in A order.
+    """
+    a_chrom, b_chrom = _chrom_array(a_chrom), _chrom_array(b_chrom)
+    a_start, a_end = np.asarray(a_start, dtype=np.int64), np.asarray(a_end, dtype=np.int64)
+    b_start, b_end = np.asarray(b_start, dtype=np.int64), np.asarray(b_end, dtype=np.int64)
+    codes, uniques = pd.factorize(np.concatenate([a_chrom, b_chrom]))
+    a_codes, b_codes = codes[:len(a_chrom)], codes[len(a_chrom):]
+    counts = np.zeros(len(a_chrom), dtype=np.int64)
+    a_order = np.argsort(a_codes, kind='stable')
+    a_bounds = np.searchsorted(a_codes[a_order], np.arange(len(uniques) + 1))
+    b_order = np.argsort(b_codes, kind='stable')
+    b_bounds = np.searchsorted(b_codes[b_order], np.arange(len(uniques) + 1))
+    for code in range(len(uniques)):
+        a_ind = a_order[a_bounds[code]:a_bounds[code + 1]]
+        b_ind = b_order[b_bounds[code]:b_bounds[code + 1]]
+        if not len(a_ind) or not len(b_ind):
+            continue
+        starts = np.sort(b_start[b_ind])
+        ends = np.sort(b_end[b_ind])
+        counts[a_ind] = (np.searchsorted(starts, a_end[a_ind], side='left')
+                         - np.searchsorted(ends, a_start[a_ind], side='right'))
+    return counts
+
+
+def overlaps_any(a_chrom, a_start, a_end, b_chrom, b_start, b_end):
+    """Boolean mask of A intervals overlapping at least one B interval."""
+    return count_overlaps(a_chrom, a_start, a_end, b_chrom, b_start, b_end) > 0
+
+
+def _chrom_array(chrom):
+    """Chromosome labels as an object array of strings (categoricals included)."""
+    return np.asarray(pd.Series(chrom).astype(str), dtype=object)
@@ -2,14 +2,25 @@ import os
 import sys
 import shlex
 import pathlib
-import subprocess
 import argparse
+import importlib
 import contextlib
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
-from .baf_from_vcf import baf_from_vcf
-from .build_coverage_files import build_genome_file, build_coverage_files
-from .get_loh_intervals_adtex import finalize_loh
-from .trim_vcf import trim_vcf
+from .build_coverage_files import build_genome_file, build_coverage_files, COVERAGE_BACKENDS, SHARD_MODES
+from .genome_dict import get_genome_dict
+from .preflight import run_preflight, gatk_executable
+from .run_report import RunReport, current_stage_log
+from .saas_worker import get_worker_pool, saas_oneshot_args, SaasWorkerError, LIB_SCRIPT
+from .stage_cache import StageCache
+from .stages import Stage, run_stage_graph, print_stage_timings
+from .supervisor import run_tool, tool_policies, parse_tool_timeouts, handle_sigterm, get_tool_policy, TOOLS
+from .trim_vcf import trim_vcf, iter_selected_snps, tee_vcf, TRIM_BACKENDS
+
+# Stage functions from modules that import pandas, pyarrow or matplotlib at
+# import time are looked up when their stage runs (see _deferred), so that
+# `run_cnv -h`, argument errors and cached stages do not pay for them.
 
 
 def run_cnv(vcf_path, sample_dir=None, adtex_dir=None, tumor_bam=None, normal_bam=None,
@@ -18,8 +29,11 @@ def run_cnv(vcf_path, sample_dir=None, adtex_dir=None, tumor_bam=None, normal_ba
             ref_fasta=None,
             saas_only=False, adtex_only=False,
             adtex_stdout='-', bed_targets=None,
-            mq_cutoff=30, chroms=None, vcf_out=None,
-            ploidy=None, min_read_depth=10,
+            mq_cutoff=30, chroms=None, vcf_out=None, chunksize=None, trim_backend='gatk',
+            fused=False, keep_trimmed_vcf=False, stage_workers=None, use_cache=True,
+            compact_baf=False, coverage_backend='bedtools', coverage_workers=1, coverage_shard_by='balanced',
+            tool_timeouts=None, tool_retries=None, saas_worker=False, extracted_baf=False, vcf_workers=1,
+            preflight=True, build_indexes=False, ploidy=None, min_read_depth=10, loh_density=False,
             ratio_min=0.4, ratio_max=0.6, min_tumor=20, min_normal=10, min_gq=90):
     """Run pipeline.
 
@@ -27,6 +41,53 @@ def run_cnv(vcf_path, sample_dir=None, adtex_dir=None, tumor_bam=None, normal_ba
 
     Note:
         sample_dir (str): Must be sample specific to prevent file overwrite.
+        fused (bool): filter the input VCF and build BAF outputs in a single
+            streaming pass with the python trim backend. snps_trimmed.vcf is
+            only written if keep_trimmed_vcf is True.
+        stage_workers (int): max stages run concurrently. Independent branches
+            (e.g. saasCNV and coverage generation) overlap by default; use 1
+            to run stages one after another.
+        coverage_backend (str): 'bedtools', or 'pysam' to compute coverage
+            in-process into compact coverage stores (*_cov.cov). Per-base
+            text is then only exported for the duration of the ADTEx run.
+        coverage_workers (int): compute coverage in region shards on this many
+            processes (requires pysam and indexed BAMs). Shards are sized
+            from genome.txt, by chromosome or balanced genomic chunks
+            (coverage_shard_by).
+        compact_baf (bool): write saas.parquet in the compact baf_store layout
+            (categorical strings, 32-bit numbers, one chromosome per row
+            group) and baf.txt with 6 significant digits.
+        use_cache (bool): skip stages whose inputs, parameters and outputs
+            are unchanged since they last completed (see stage_cache).
+        tool_timeouts (dict): [optional] seconds (or None for no limit) per
+            external tool, overriding supervisor.TOOL_POLICIES.
+        tool_retries (int): [optional] retries after transient tool failures.
+        saas_worker (bool): run saasCNV on a persistent R worker, reused by
+            later run_cnv calls in this process (see saas_worker), instead of
+            a one-shot Rscript.
+        extracted_baf (bool): baf_path and parquet_path were already written
+            (e.g. by cohort_baf.extract_pairs), so the VCF is not read.
+        vcf_workers (int): vcf_path may be a VCF, .vcf.gz or BCF. If it has a
+            tabix or CSI index (and pysam is installed), the python trim
+            backend reads it one chromosome per process on this many
+            processes; with fused, only the chroms chromosomes are read.
+        preflight (bool): before any stage runs, check the inputs this run
+            needs (sample ids in the VCF header, BAM and FASTA indexes, BED
+            sort order, chromosome naming, tools), raising PreflightError
+            with every problem found (see preflight).
+        build_indexes (bool): in the pre-flight checks, build missing BAM,
+            FASTA and .vcf.gz indexes rather than failing.
+        loh_density (bool): draw the LOH plot's SNPs as density images rather
+            than markers (see plot_chr_axis), e.g. for whole-genome SNP counts.
+
+    External tools run under supervisor.run_tool: a failing, hung or
+    crashed tool fails its stage with a CommandError, and the subprocesses
+    of other running stages are then killed. Tool stderr is logged to
+    <sample_dir>/logs/.
+
+    Wall time, CPU, peak memory and I/O of each stage and subprocess are
+    written to <sample_dir>/run_report.json (see run_report), also when a
+    stage fails.
     """
 
     if baf_path is None:
@@ -40,60 +101,217 @@ def run_cnv(vcf_path, sample_dir=None, adtex_dir=None, tumor_bam=None, normal_ba
     if adtex_dir is None:
         adtex_dir = os.path.join(sample_dir, 'adtex_output')
     if chroms is None:
-        chroms = '1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,X,Y,MT'
-    if vcf_out is None:
+        chroms = DEFAULT_CHROMS
+    if vcf_out is None and (keep_trimmed_vcf or not fused):
         vcf_out = os.path.join(sample_dir, "snps_trimmed.vcf")
     genome_path = os.path.join(sample_dir, "genome.txt")
     if not os.path.exists(sample_dir):
         os.mkdir(sample_dir)
 
-    trim_vcf(vcf_in=vcf_path, tumor_id=tumor_id, normal_id=normal_id,
-             ref_fasta=ref_fasta,
-             ratio_min=ratio_min, ratio_max=ratio_max, min_depth_n=min_normal,
-             min_depth_t=min_tumor, min_gq_n=min_gq, vcf_out=vcf_out)
-
-    baf_from_vcf(vcf_out, baf_path, parquet_path=parquet_path,
-                 tumor_id=tumor_id, normal_id=normal_id,
-                 mq_cutoff=mq_cutoff, chroms_str=chroms)
+    stages = []
+    if extracted_baf:
+        stages.append(Stage('baf', partial(_require_files, baf_path, parquet_path),
+                            inputs=[baf_path, parquet_path], outputs=[baf_path, parquet_path]))
+    elif fused:
+        stages.append(Stage('baf', partial(
+            _fused_trim_baf, vcf_path, baf_path, parquet_path, vcf_out=vcf_out,
+            tumor_id=tumor_id, normal_id=normal_id, mq_cutoff=mq_cutoff, chroms=chroms,
+            chunksize=chunksize, ratio_min=ratio_min, ratio_max=ratio_max,
+            min_normal=min_normal, min_tumor=min_tumor, min_gq=min_gq, compact=compact_baf,
+            n_workers=vcf_workers),
+            inputs=[vcf_path], outputs=[baf_path, parquet_path, vcf_out]))
+    else:
+        stages.append(Stage('trim', partial(
+            trim_vcf, vcf_in=vcf_path, tumor_id=tumor_id, normal_id=normal_id,
+            ref_fasta=ref_fasta,
+            ratio_min=ratio_min, ratio_max=ratio_max, min_depth_n=min_normal,
+            min_depth_t=min_tumor, min_gq_n=min_gq, vcf_out=vcf_out,
+            backend=trim_backend, n_workers=vcf_workers),
+            inputs=[vcf_path], outputs=[vcf_out]))
+        stages.append(Stage('baf', partial(
+            _deferred('baf_from_vcf', 'baf_from_vcf'), vcf_out, baf_path, parquet_path=parquet_path,
+            tumor_id=tumor_id, normal_id=normal_id,
+            mq_cutoff=mq_cutoff, chroms_str=chroms, chunksize=chunksize, compact=compact_baf),
+            deps=['trim'],
+            inputs=[vcf_out], outputs=[baf_path, parquet_path]))
 
     if not adtex_only:
-        run_saasCNV(sample_id=tumor_id, sample_dir=sample_dir,
-                    baf_path=parquet_path, stdout_path='-')
+        saas_kw = dict(sample_id=tumor_id, sample_dir=sample_dir, baf_path=parquet_path, stdout_path='-')
+        stages.append(Stage('saas', partial(run_saasCNV, worker=saas_worker, **saas_kw), deps=['baf'],
+                            inputs=[parquet_path, os.path.join(PKG_DIR_PATH, 'run_saas.R'), LIB_SCRIPT],
+                            outputs=[os.path.join(sample_dir, 'saasCNV_results')],
+                            params={'args': (), 'kwargs': saas_kw}))  # same results either way
 
     if not saas_only:
-        build_genome_file(sample_bam=normal_bam, genome_path=genome_path)
+        adtex_outputs = [os.path.join(adtex_dir, 'cnv.result'),
+                         os.path.join(adtex_dir, 'zygosity', 'zygosity.res')]
+        # bedtools -sorted needs genome.txt, as do shards (sized from it); unsharded pysam does not
+        genome_file = coverage_backend == 'bedtools' or coverage_workers > 1
+        if genome_file:
+            stages.append(Stage('genome', partial(
+                build_genome_file, sample_bam=normal_bam, genome_path=genome_path, ref_fasta=ref_fasta),
+                inputs=[normal_bam], outputs=[genome_path]))
+        shard_kw = dict(n_workers=coverage_workers, shard_by=coverage_shard_by)
+        if coverage_backend == 'pysam':
+            tumor_store = os.path.splitext(tumor_cov_path)[0] + '.cov'
+            normal_store = os.path.splitext(normal_cov_path)[0] + '.cov'
+            stages.append(Stage('coverage', partial(
+                build_coverage_files, tumor_bam=tumor_bam, normal_bam=normal_bam,
+                genome_path=genome_path if genome_file else None,
+                tumor_cov_path=tumor_store, normal_cov_path=normal_store,
+                target_bed_path=bed_targets, overwrite=True, backend='pysam', **shard_kw),
+                deps=['genome'] if genome_file else [],
+                inputs=[tumor_bam, normal_bam, bed_targets, genome_path if genome_file else None],
+                outputs=[tumor_store, normal_store]))
+            adtex_func = partial(_run_adtex_from_stores, tumor_store, normal_store)
+            adtex_inputs = [normal_store, tumor_store, baf_path, bed_targets]
+        else:
+            stages.append(Stage('coverage', partial(
+                build_coverage_files, tumor_bam=tumor_bam, normal_bam=normal_bam, genome_path=genome_path,
+                tumor_cov_path=tumor_cov_path, normal_cov_path=normal_cov_path,
+                target_bed_path=bed_targets, overwrite=True, **shard_kw), deps=['genome'],
+                inputs=[tumor_bam, normal_bam, genome_path, bed_targets],
+                outputs=[tumor_cov_path, normal_cov_path]))
+            adtex_func = run_adtex
+            adtex_inputs = [normal_cov_path, tumor_cov_path, baf_path, bed_targets]
+        stages.append(Stage('adtex', partial(
+            adtex_func, normal_cov_path=normal_cov_path,
+            tumor_cov_path=tumor_cov_path,
+            adtex_dir=adtex_dir,
+            baf_path=baf_path,
+            target_path=bed_targets,
+            ploidy=ploidy, min_read_depth=min_read_depth,
+            stdout_path=adtex_stdout), deps=['baf', 'coverage'],
+            inputs=adtex_inputs,
+            outputs=adtex_outputs))
+        if genome_file:
+            loh_func = partial(_deferred('get_loh_intervals_adtex', 'finalize_loh'), adtex_dir, genome=genome_path,
+                               density=loh_density)
+        else:
+            loh_func = partial(_finalize_loh, adtex_dir, normal_bam=normal_bam, ref_fasta=ref_fasta,
+                               density=loh_density)
+        stages.append(Stage('loh', loh_func,
+                            deps=['adtex', 'genome'] if genome_file else ['adtex'],
+                            inputs=adtex_outputs + ([genome_path] if genome_file else [normal_bam]),
+                            outputs=[os.path.join(adtex_dir, 'loh_intervals_final.bed'),
+                                     os.path.join(adtex_dir, 'LOH_plot.png')]))
+
+    cache = StageCache(sample_dir) if use_cache else None
+    report = RunReport(sample_dir)
+    timings = {}
+    try:
+        with tool_policies(timeouts=tool_timeouts, retries=tool_retries):
+            if preflight:
+                trim_gatk = not (fused or extracted_baf) and trim_backend == 'gatk'
+                indexed_coverage = not saas_only and (coverage_backend == 'pysam' or coverage_workers > 1)
+                tools = ([] if adtex_only else ['Rscript']) + ([gatk_executable()] if trim_gatk else [])
+                if not saas_only and coverage_backend == 'bedtools':
+                    tools.append('bedtools')
+                if build_indexes:
+                    tools.append('samtools')
+                with report.stage('preflight') as record:
+                    run_preflight(vcf_path, tumor_id=tumor_id, normal_id=normal_id,
+                                  tumor_bam=None if saas_only else tumor_bam,
+                                  normal_bam=None if saas_only else normal_bam,
+                                  ref_fasta=ref_fasta, bed_targets=None if saas_only else bed_targets,
+                                  sorted_bed=coverage_backend == 'bedtools',
+                                  chroms=None if extracted_baf else chroms, tools=tools,
+                                  modules=['pysam'] if indexed_coverage else [], adtex=not saas_only,
+                                  bam_index=indexed_coverage, fasta_index=trim_gatk,
+                                  vcf_index=vcf_workers > 1 and not (extracted_baf or trim_gatk),
+                                  build_indexes=build_indexes)
+                timings['preflight'] = record['wall_seconds']
+            timings.update(run_stage_graph(stages, max_workers=stage_workers, cache=cache, report=report))
+    except BaseException:
+        report.write(status='failed')
+        raise
+    report.write()
+    print_stage_timings(timings)
+    print("Run report: {}".format(report.report_path))
+    print("CNV PIPELINE COMPLETE.")
 
-        build_coverage_files(tumor_bam=tumor_bam, normal_bam=normal_bam, genome_path=genome_path,
-                             tumor_cov_path=tumor_cov_path, normal_cov_path=normal_cov_path,
-                             target_bed_path=bed_targets)
 
-        run_adtex(normal_cov_path=normal_cov_path,
-                  tumor_cov_path=tumor_cov_path,
-                  adtex_dir=adtex_dir,
-                  baf_path=baf_path,
-                  target_path=bed_targets,
-                  ploidy=ploidy, min_read_depth=min_read_depth,
-                  stdout_path=adtex_stdout)
+def _fused_trim_baf(vcf_path, baf_path, parquet_path, vcf_out=None, tumor_id=None, normal_id=None,
+                    mq_cutoff=30, chroms=None, chunksize=None, ratio_min=0.4, ratio_max=0.6,
+                    min_normal=10, min_tumor=20, min_gq=90, compact=False, n_workers=1):
+    """Filter input VCF and build BAF outputs in one streaming pass."""
+    from .baf_from_vcf import baf_from_vcf
+    print("Running fused VCF trim and BAF extraction.")
+    chunks = iter_selected_snps(vcf_path, tumor_id=tumor_id, normal_id=normal_id,
+                                ratio_min=ratio_min, ratio_max=ratio_max,
+                                min_depth_n=min_normal, min_depth_t=min_tumor,
+                                min_gq_n=min_gq, chunksize=chunksize or FUSED_CHUNKSIZE,
+                                chroms=chroms.split(','), n_workers=n_workers)
+    if vcf_out is not None:
+        chunks = tee_vcf(vcf_path, chunks, vcf_out)
+    baf_from_vcf(None, baf_path, parquet_path=parquet_path,
+                 tumor_id=tumor_id, normal_id=normal_id,
+                 mq_cutoff=mq_cutoff, chroms_str=chroms, vcf_chunks=chunks, compact=compact)
 
-        finalize_loh(adtex_dir)
-    print("CNV PIPELINE COMPLETE.")
+
+def _deferred(module, name):
+    """Stage function <module>.<name> of this package, imported when the stage runs."""
+    def run_stage(*args, **kwargs):
+        return getattr(importlib.import_module('.' + module, __package__), name)(*args, **kwargs)
+    run_stage.__name__ = name
+    return run_stage
+
+
+def _finalize_loh(adtex_dir, normal_bam=None, ref_fasta=None, density=False):
+    """finalize_loh without genome.txt, plotting on the (cached) genome dictionary it would hold."""
+    genome = get_genome_dict(bam_path=normal_bam, ref_fasta=ref_fasta)
+    return _deferred('get_loh_intervals_adtex', 'finalize_loh')(adtex_dir, genome=genome, density=density)
 
 
-def run_saasCNV(sample_id=None, sample_dir=None, baf_path=None, stdout_path='-'):
+def _require_files(*paths):
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError("Expected pre-extracted BAF outputs: {}".format(missing))
+
+
+def _run_adtex_from_stores(tumor_store, normal_store, normal_cov_path=None, tumor_cov_path=None,
+                           **adtex_kw):
+    """Export per-base text from coverage stores, run ADTEx, then remove the text."""
+    from .coverage_store import export_per_base_bed
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = [pool.submit(export_per_base_bed, tumor_store, tumor_cov_path),
+                   pool.submit(export_per_base_bed, normal_store, normal_cov_path)]
+        for future in futures:
+            future.result()
+    try:
+        run_adtex(normal_cov_path=normal_cov_path, tumor_cov_path=tumor_cov_path, **adtex_kw)
+    finally:
+        for path in [tumor_cov_path, normal_cov_path]:
+            os.remove(path)
+
+
+def run_saasCNV(sample_id=None, sample_dir=None, baf_path=None, stdout_path='-', worker=False):
     """Example call from bash:
     Rscript run_saas.R {s_id} {sample_dir} {baf_path} 50 30 FALSE 0.05 0.05
+
+    With worker=True, the job runs on this process's persistent R worker
+    (see saas_worker), with output logged to stdout_path, or the stage log if
+    stdout_path is '-'. If the worker cannot start or dies, the job is rerun
+    with a one-shot Rscript.
     """
-    script_path = os.path.join(PKG_DIR_PATH, 'run_saas.R')
     sample_path = os.path.realpath(sample_dir)
     baf_path = os.path.realpath(baf_path)
-    cmd = (f"Rscript {script_path} {sample_id} {sample_path} {baf_path}"
-           " 50 30 FALSE 0.05 0.05")
-    print("Running saasCNV with command:\n  {}".format(cmd))
-    args = shlex.split(cmd)
+    if worker:
+        log_path = stdout_path if stdout_path not in (None, '-') else \
+            current_stage_log('saas_worker') or os.path.join(sample_path, 'saasCNV.log')
+        print("Running saasCNV on persistent R worker (log: {})".format(log_path))
+        try:
+            get_worker_pool().run(sample_id, sample_path, baf_path, os.path.realpath(log_path),
+                                  timeout=get_tool_policy('saas').timeout)
+            print("saasCNV run complete.")
+            return
+        except SaasWorkerError as e:
+            print("{} Falling back to one-shot Rscript.".format(e))
+    args = saas_oneshot_args(sample_id, sample_path, baf_path)
+    print("Running saasCNV with command:\n  {}".format(' '.join(args)))
     with smart_open(stdout_path) as outfile:
-        proc = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=outfile, stderr=outfile)
-        proc.communicate()
-    print("saasCNV run complete")
+        run_tool('saas', args, stdout=outfile, stderr=outfile)
+    print("saasCNV run complete.")
 
 
 def run_adtex(normal_cov_path=None, tumor_cov_path=None, adtex_dir=None, baf_path=None, target_path=None,
@@ -125,9 +343,8 @@ def run_adtex(normal_cov_path=None, tumor_cov_path=None, adtex_dir=None, baf_pat
     print("Running ADTEx with command:\n  {}".format(cmd))
     args = shlex.split(cmd)
     with smart_open(stdout_path) as outfile:
-        proc = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=outfile, stderr=outfile)
-        proc.communicate()
-    print("ADTEx run complete")
+        run_tool('adtex', args, stdout=outfile, stderr=outfile)
+    print("ADTEx run complete.")
 
 
 @contextlib.contextmanager
@@ -162,13 +379,28 @@ def main():
         __package__ = "cnv_pipeline"
 
     parser = argparse.ArgumentParser("CNV PIPELINE")
-    parser.add_argument('-v', '--vcf', help='VCF file for sample pair', required=True)
+    parser.add_argument('-v', '--vcf', help='VCF file for sample pair (.vcf, .vcf.gz or .bcf)', required=True)
     parser.add_argument('-s', '--sample_dir', help='Sample-specific output dir', required=True)
     parser.add_argument('-t', '--tumor_bam', help='Tumor BAM', required=True)
     parser.add_argument('-n', '--normal_bam', help='Normal BAM', required=True)
     parser.add_argument('-tid', '--tumor_id', help='Tumor name, for vcf extraction', required=True)
     parser.add_argument('-nid', '--normal_id', help='Normal name, for vcf extraction', required=True)
-    parser.add_argument('-R', '--ref_fasta', help='Reference genome fasta path', required=True)
+    add_run_arguments(parser)
+    parser.add_argument('-a', '--adtex_dir', help='ADTEx: output dir', default=None)
+    parser.add_argument('-ao', '--adtex_stdout', help='ADTEx stdout path if overriding STDOUT', default='-')
+
+    args = parser.parse_args()
+    run_kw = get_run_kwargs(args)
+    handle_sigterm()
+    run_cnv(vcf_path=args.vcf, sample_dir=args.sample_dir, adtex_dir=args.adtex_dir,
+            tumor_bam=args.tumor_bam, normal_bam=args.normal_bam,
+            tumor_id=args.tumor_id, normal_id=args.normal_id,
+            adtex_stdout=args.adtex_stdout, **run_kw)
+
+
+def add_run_arguments(parser):
+    """Add run_cnv options shared by all sample pairs to an argparse parser."""
+    parser.add_argument('-R', '--ref_fasta', help='Reference genome fasta path [REQUIRED FOR GATK]', default=None)
     group = parser.add_mutually_exclusive_group()
     group.add_argument('--saas_only', help='Only run saasCNV, not ADTEx.', action='store_true', default=False)
     group.add_argument('--adtex_only', help='Only run ADTEx, not saasCNV.', action='store_true', default=False)
@@ -178,29 +410,85 @@ def main():
     parser.add_argument('-tmin', '--min_tumor', help='Min reads from tumor sample [20]', type=int, default=20)
     parser.add_argument('-nmin', '--min_normal', help='Min reads from normal sample [10]', type=int, default=10)
     parser.add_argument('-gq', '--min_gq', help='Genotype quality cutoff for normal sample [90]', type=int, default=90)
+    parser.add_argument('--trim_backend', help='VCF trimming engine: GATK SelectVariants or built-in '
+                                               'python filter [gatk, or python with --fused]',
+                        choices=TRIM_BACKENDS, default=None)
+    parser.add_argument('--fused', help='Trim VCF and extract BAF in a single streaming pass, '
+                                        'using the python trim backend (not compatible with '
+                                        '--trim_backend gatk)', action='store_true', default=False)
+    parser.add_argument('--keep_trimmed_vcf', help='With --fused, also write snps_trimmed.vcf',
+                        action='store_true', default=False)
+    parser.add_argument('--compact_baf', help='Write saas.parquet with categorical strings, 32-bit numbers '
+                                              'and one row group per chromosome', action='store_true',
+                        default=False)
+    parser.add_argument('--stage_workers', help='Max pipeline stages run concurrently, e.g. 1 to run '
+                                                'saasCNV and ADTEx branches in sequence [no limit]',
+                        type=int, default=None)
+    parser.add_argument('--no_cache', help='Rerun all stages, ignoring the stage cache in sample_dir',
+                        action='store_true', default=False)
+    parser.add_argument('--tool_timeout', help='Timeout for an external tool, as TOOL=SECONDS or TOOL=none. '
+                                               'Repeatable. Tools: {}'.format(', '.join(TOOLS)),
+                        action='append', default=[])
+    parser.add_argument('--tool_retries', help='Retries after transient external tool failures '
+                                               '[per tool, 1-2]', type=int, default=None)
+    parser.add_argument('--saas_worker', help='Run saasCNV on a persistent R worker with libraries '
+                                              'preloaded, reused across pairs in run_cnv_cohort',
+                        action='store_true', default=False)
+    parser.add_argument('--vcf_workers', help='For a tabix/CSI-indexed .vcf.gz or BCF, read chromosomes '
+                                              'in parallel on this many processes (python trim backend '
+                                              'or --fused; requires pysam) [1]', type=int, default=1)
+    parser.add_argument('--no_preflight', help='Skip pre-flight checks of sample ids, indexes, BED sort '
+                                               'order and chromosome naming before the run',
+                        action='store_true', default=False)
+    parser.add_argument('--build_indexes', help='Build missing BAM, FASTA and .vcf.gz indexes during '
+                                                'pre-flight checks, rather than failing', action='store_true',
+                        default=False)
+    parser.add_argument('--chunksize', help='Parse trimmed VCF in chunks of this many records, '
+                                            'to bound memory use [read whole file]', type=int, default=None)
     # ADTEx-specific
-    parser.add_argument('-a', '--adtex_dir', help='ADTEx: output dir', default=None)
     parser.add_argument('-b', '--bed', help='ADTEx: BED file for targeted regions [REQUIRED FOR ADTEx]', default=None)
+    parser.add_argument('--coverage_backend', help='ADTEx: coverage engine, bedtools or in-process pysam '
+                                                   '[bedtools]', choices=COVERAGE_BACKENDS, default='bedtools')
+    parser.add_argument('--coverage_workers', help='ADTEx: compute coverage in region shards on this many '
+                                                   'processes, using pysam and indexed BAMs [1]',
+                        type=int, default=1)
+    parser.add_argument('--coverage_shard_by', help='ADTEx: with --coverage_workers, shard targets by balanced '
+                                                    'genomic chunks or by chromosome [balanced]',
+                        choices=SHARD_MODES, default='balanced')
     parser.add_argument("--ploidy", help="ADTEx: most common ploidy in the tumour sample", type=int, default=None)
     parser.add_argument("--minReadDepth", help="The ADTEx threshold for minimum read depth for each exon [10]",
                         type=int, default=10)
-    parser.add_argument('-ao', '--adtex_stdout', help='ADTEx stdout path if overriding STDOUT', default='-')
-
-    args = parser.parse_args()
+    parser.add_argument('--loh_density', help='ADTEx: draw LOH plot SNPs as density images rather than '
+                                              'markers, for very many SNPs', action='store_true', default=False)
+
+
+def get_run_kwargs(args):
+    """Validate shared options from add_run_arguments, and convert to run_cnv kwargs."""
+    if args.fused and args.trim_backend == 'gatk':
+        raise TrimBackendError("--fused filters the VCF with the python trim backend, "
+                               "so cannot be used with --trim_backend gatk")
+    trim_backend = args.trim_backend or ('python' if args.fused else 'gatk')
+    if trim_backend == 'gatk' and args.ref_fasta is None:
+        raise RefFastaNotFoundError("You must supply a reference FASTA (--ref_fasta) "
+                                    "when using --trim_backend gatk")
     if not args.saas_only and args.bed is None:
         raise BEDFileNotFoundError("You must supply a BED file for targeted regions "
                                    "(--bed) when not using --saas_only")
-    vcf_dict = dict(ratio_min=args.ratio_min, ratio_max=args.ratio_max,
-                    min_tumor=args.min_tumor, min_normal=args.min_normal,
-                    min_gq=args.min_gq)
-    run_cnv(vcf_path=args.vcf, sample_dir=args.sample_dir, adtex_dir=args.adtex_dir,
-            tumor_bam=args.tumor_bam, normal_bam=args.normal_bam,
-            tumor_id=args.tumor_id, normal_id=args.normal_id,
-            ref_fasta=args.ref_fasta,
-            bed_targets=args.bed,
-            saas_only=args.saas_only, adtex_only=args.adtex_only,
-            ploidy=args.ploidy, min_read_depth=args.minReadDepth,
-            adtex_stdout=args.adtex_stdout, **vcf_dict)
+    return dict(ref_fasta=args.ref_fasta,
+                bed_targets=args.bed, chunksize=args.chunksize, trim_backend=trim_backend,
+                fused=args.fused, keep_trimmed_vcf=args.keep_trimmed_vcf,
+                stage_workers=args.stage_workers, use_cache=not args.no_cache,
+                compact_baf=args.compact_baf,
+                coverage_backend=args.coverage_backend,
+                coverage_workers=args.coverage_workers, coverage_shard_by=args.coverage_shard_by,
+                tool_timeouts=parse_tool_timeouts(args.tool_timeout), tool_retries=args.tool_retries,
+                saas_worker=args.saas_worker, vcf_workers=args.vcf_workers,
+                preflight=not args.no_preflight, build_indexes=args.build_indexes,
+                saas_only=args.saas_only, adtex_only=args.adtex_only,
+                ploidy=args.ploidy, min_read_depth=args.minReadDepth, loh_density=args.loh_density,
+                ratio_min=args.ratio_min, ratio_max=args.ratio_max,
+                min_tumor=args.min_tumor, min_normal=args.min_normal,
+                min_gq=args.min_gq)
 
 
 class AdtexNotFoundError(Exception):
@@ -211,4 +499,14 @@ class BEDFileNotFoundError(Exception):
     pass
 
 
+class RefFastaNotFoundError(Exception):
+    pass
+
+
+class TrimBackendError(Exception):
+    pass
+
+
+DEFAULT_CHROMS = '1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,X,Y,MT'
+FUSED_CHUNKSIZE = 100000  # VCF records per chunk in fused mode, if chunksize not given
 PKG_DIR_PATH = os.path.dirname(os.path.realpath(__file__))
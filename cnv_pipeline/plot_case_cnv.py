@@ -1,28 +1,41 @@
 import os
 os.environ['QT_QPA_PLATFORM'] = 'offscreen'
 
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
 import cnv_pipeline.plot_chr_axis as pcnv
+from cnv_pipeline.baf_store import read_baf_store
 
 plt.style.use('ggplot')
 
-g = pcnv.GenomeInfo()
+PLOT_DIMS = ('lrd', 'baf')
+
 
-AX_DICT=dict(xticks=g.size_df.mids,
-             xticklabels=list(g.size_df.index.values),
-             yticks=[],
-             xlim=[0,g.genome_size])
+def get_ax_dict():
+    """Subplot settings for the genome x-axis, from the shared GenomeInfo (built on first use)."""
+    g = pcnv.get_genome_info()
+    return dict(xticks=g.size_df.mids,
+                xticklabels=list(g.size_df.index.values),
+                yticks=[],
+                xlim=[0, g.genome_size])
 
 
-def plot_case_cnv(case_id, tumor_ids=None, feather_dict=None, cnv_dict=None, dim='baf'):
+def plot_case_cnv(case_id, tumor_ids=None, feather_dict=None, cnv_dict=None, dim='baf', density=False,
+                  sample_data=None):
     """Plot cnv profile from SAAS-CNV for single case, return fig/axis handles.
 
     Args:
         tumor_ids (iterable): tumor ids.
         feather_dict [dict]: dictionary mapping tumor ids to cnv data.
+        sample_data [dict]: [optional] maps tumor ids to (baf, cnv) dataframes
+            from load_sample_data, to reuse across dims instead of reading
+            feather_dict and cnv_dict paths.
         dim (str): 'baf' or 'lrd' for minor b-allele frequency or log2 ratio of depths, respectively
+        density (bool): draw SNPs as a density image, see plot_chr_axis.
     Returns:
         hf: matplotlib figure handle
         axs: matplotlib axis handles.
@@ -30,7 +43,7 @@ def plot_case_cnv(case_id, tumor_ids=None, feather_dict=None, cnv_dict=None, dim
 
     hf, axs = plt.subplots(len(tumor_ids), 1, figsize=(14, 10), sharex=True,
                            # gridspec_kw={'height_ratios':[10, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]},
-                           subplot_kw=AX_DICT)
+                           subplot_kw=get_ax_dict())
     axs = [axs] if len(tumor_ids) == 1 else axs  # ensure axs is iterable.
     # for ax in axs:
     #     format_axis(ax, g)
@@ -45,16 +58,15 @@ def plot_case_cnv(case_id, tumor_ids=None, feather_dict=None, cnv_dict=None, dim
         raise Exception("Invalid dim parameter ({}). Must specify 'baf' or 'lrd' as dim parameter.".format(dim))
 
     for sample_id, ax in zip(tumor_ids, axs):
-        temp = pd.read_table(cnv_dict[sample_id], dtype={'chr': str})
-        temp['chr'] = temp['chr'].str.lstrip('chr')
+        if sample_data is not None:
+            baf, temp = sample_data[sample_id]
+        else:
+            baf, temp = load_sample_data(feather_dict[sample_id], cnv_dict[sample_id])
         temp_loss = temp[temp.CNV.isin(['loss', 'LOH'])]
         temp_gain = temp[temp.CNV.isin(['gain'])]
 
-        baf = pd.read_feather(feather_dict[sample_id])
-        baf['baf'] = baf['Tumor.ALT.DP'] / (baf['Tumor.REF.DP'] + baf['Tumor.ALT.DP'])
-        baf['lrd'] = pd.np.log2((baf['Tumor.ALT.DP'] + baf['Tumor.REF.DP']) / (baf['Normal.ALT.DP'] + baf['Normal.REF.DP']))
-
-        pcnv.plot_chr_axis(chrom='CHROM', pos='POS', y=dim, data=baf, markersize=1, alpha=0.2, ylim=ylim, ax=ax)
+        pcnv.plot_chr_axis(chrom='CHROM', pos='POS', y=dim, data=baf, markersize=1, alpha=0.2, ylim=ylim, ax=ax,
+                           density=density)
         if len(temp_loss):
             pcnv.plot_chr_intervals(chrom='chr', posA='posStart', posB='posEnd', data=temp_loss, facecolor='b', ax=ax)
         if len(temp_gain):
@@ -68,21 +80,89 @@ def plot_case_cnv(case_id, tumor_ids=None, feather_dict=None, cnv_dict=None, dim
     return hf, axs
 
 
-def plot_case_cnv_samples_table(sample_file='samples.txt'):
+def load_sample_data(baf_path, cnv_path):
+    """Load one sample's SNP table (feather or parquet) and saasCNV segments.
+
+    Returns:
+        baf (pd.DataFrame): SNP table with added 'baf' and 'lrd' columns.
+        cnv (pd.DataFrame): saasCNV seq.cnv.txt segments, 'chr' prefix removed.
+    """
+    cnv = pd.read_table(cnv_path, dtype={'chr': str})
+    cnv['chr'] = cnv['chr'].str.lstrip('chr')
+    columns = ['CHROM', 'POS', 'Tumor.REF.DP', 'Tumor.ALT.DP', 'Normal.REF.DP', 'Normal.ALT.DP']
+    if baf_path.endswith('.parquet'):
+        baf = read_baf_store(baf_path, columns=columns)
+    else:
+        baf = pd.read_feather(baf_path, columns=columns)
+    tumor_dp = baf['Tumor.REF.DP'] + baf['Tumor.ALT.DP']
+    baf['baf'] = baf['Tumor.ALT.DP'] / tumor_dp
+    baf['lrd'] = np.log2(tumor_dp / (baf['Normal.ALT.DP'] + baf['Normal.REF.DP']))
+    return baf, cnv
+
+
+def plot_case_cnv_samples_table(sample_file='samples.txt', n_workers=1, out_dir='.', force=False,
+                                density=False):
     """Plot cnv figures for each case. Assumes default paths for saas-cnv output.
 
+    Each case is rendered in one task, which loads each sample once and plots
+    both dims (lrd and baf) to <out_dir>/<case_id>_<dim>.png. Cases run on a
+    process pool when n_workers > 1. A case is skipped if its figures are
+    newer than all of its input files, unless force is True.
+
     Args:
-        s (pd.DataFrame): rows are {patient_id,case_id}, {tumor_id,sample_id}, ...
+        sample_file (str): rows are {patient_id,case_id}, {tumor_id,sample_id}, ...
+            Sample data is read from <sample_id>/saas.parquet (or saas.feather)
+            and <sample_id>/saasCNV_results/mid_res/seq.cnv.txt.
+
+    Returns:
+        dict: maps case_id to 'plotted' or 'skipped'.
     """
     s = pd.read_table(sample_file, dtype={'patient_id': str, 'case_id': str, 'tumor_id': str, 'sample_id': str})
     s.rename(columns={'patient_id': 'case_id', 'tumor_id': 'sample_id'}, inplace=True)
 
     sample_lists = s.groupby('case_id')['sample_id'].apply(lambda s: sorted(list(s.values)))
 
-    for case_id, sample_list in sample_lists.iteritems():
-        # LOAD DATA (CNV INPUT AND OUTPUT)
-        feather_dict = {s: '{}/saas.feather'.format(s) for s in sample_list}
+    jobs = []
+    for case_id, sample_list in sample_lists.items():
+        baf_dict = {s: _sample_baf_path(s) for s in sample_list}
         cnv_dict = {s: '{}/saasCNV_results/mid_res/seq.cnv.txt'.format(s) for s in sample_list}
-        for dim in ['lrd', 'baf']:
-            hf, axs = plot_case_cnv(case_id, tumor_ids=sample_list, feather_dict=feather_dict, cnv_dict=cnv_dict, dim=dim)
-            hf.savefig('{}_{}.png'.format(case_id, dim), bbox_inches='tight')
+        out_paths = {dim: os.path.join(out_dir, '{}_{}.png'.format(case_id, dim)) for dim in PLOT_DIMS}
+        inputs = list(baf_dict.values()) + list(cnv_dict.values())
+        if not force and _is_up_to_date(list(out_paths.values()), inputs):
+            print("Plots for {} are up to date. Skipping.".format(case_id))
+            continue
+        jobs.append((case_id, sample_list, baf_dict, cnv_dict, out_paths, density))
+
+    status = {case_id: 'skipped' for case_id in sample_lists.index}
+    if n_workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            for case_id in pool.map(_render_case, *zip(*jobs)):
+                status[case_id] = 'plotted'
+    else:
+        for job in jobs:
+            status[_render_case(*job)] = 'plotted'
+    return status
+
+
+def _render_case(case_id, sample_list, baf_dict, cnv_dict, out_paths, density=False):
+    """Load each sample once, then plot and save every dim for one case."""
+    sample_data = {s: load_sample_data(baf_dict[s], cnv_dict[s]) for s in sample_list}
+    for dim, out_path in out_paths.items():
+        hf, axs = plot_case_cnv(case_id, tumor_ids=sample_list, dim=dim, density=density,
+                                sample_data=sample_data)
+        hf.savefig(out_path, bbox_inches='tight')
+        plt.close(hf)
+    print("Plotted {}".format(case_id))
+    return case_id
+
+
+def _sample_baf_path(sample_id):
+    parquet_path = '{}/saas.parquet'.format(sample_id)
+    return parquet_path if os.path.exists(parquet_path) else '{}/saas.feather'.format(sample_id)
+
+
+def _is_up_to_date(out_paths, inputs):
+    if not all(os.path.exists(p) for p in out_paths + inputs):
+        return False
+    newest_input = max(os.path.getmtime(p) for p in inputs)
+    return min(os.path.getmtime(p) for p in out_paths) >= newest_input
@@ -1,3 +1,6 @@
+import re
+import functools
+
 import matplotlib
 
 matplotlib.use('Agg')
@@ -6,74 +9,149 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib import collections as mc
+from matplotlib import colors as mcolors
 import matplotlib.patches as patches
 
+from .genome_dict import read_genome_dict
+
+
+HG19_CHROM_LENGTHS = [('1', 249250621), ('2', 243199373), ('3', 198022430), ('4', 191154276),
+                      ('5', 180915260), ('6', 171115067), ('7', 159138663), ('8', 146364022),
+                      ('9', 141213431), ('10', 135534747), ('11', 135006516), ('12', 133851895),
+                      ('13', 115169878), ('14', 107349540), ('15', 102531392), ('16', 90354753),
+                      ('17', 81195210), ('18', 78077248), ('19', 59128983), ('20', 63025520),
+                      ('21', 48129895), ('22', 51304566), ('X', 155270560), ('Y', 59373566), ('MT', 16569)]
+HG19_P_LENGTHS = {'1': 125000000, '2': 93300000, '3': 91000000, '4': 50400000, '5': 48400000,
+                  '6': 61000000, '7': 59900000, '8': 45600000, '9': 49000000, '10': 40200000,
+                  '11': 53700000, '12': 35800000, '13': 17900000, '14': 17600000, '15': 19000000,
+                  '16': 36600000, '17': 24000000, '18': 17200000, '19': 26500000, '20': 27500000,
+                  '21': 13200000, '22': 14700000, 'X': 60600000, 'Y': 12500000}
+DENSITY_BINS = (2000, 200)  # (x, y) bins for density mode
+PRIMARY_CHROM_PATTERN = re.compile(r'^(chr)?([0-9]+|X|Y|M|MT)$')
+
 
 class GenomeInfo:
     """Loads basic genome attributes required for plotting genomic data."""
-    def __init__(self, use_Y=False, use_MT=False):
-        """Create attributes: size_df, genome_size, start_dict, lines."""
-        chr_len = ([('1', 249250621), ('2', 243199373), ('3', 198022430), ('4', 191154276),
-                  ('5', 180915260), ('6', 171115067), ('7', 159138663), ('8', 146364022),
-                  ('9', 141213431), ('10', 135534747), ('11', 135006516), ('12', 133851895),
-                  ('13', 115169878), ('14', 107349540), ('15', 102531392), ('16', 90354753),
-                  ('17', 81195210), ('18', 78077248), ('19', 59128983), ('20', 63025520),
-                  ('21', 48129895), ('22', 51304566), ('X', 155270560), ('Y', 59373566), ('MT', 16569)])
-        p_len_dict = {'1': 125000000, '2': 93300000, '3': 91000000, '4': 50400000, '5': 48400000, 
-                      '6': 61000000, '7': 59900000, '8': 45600000, '9': 49000000, '10': 40200000,
-                      '11': 53700000, '12': 35800000, '13': 17900000, '14': 17600000, '15': 19000000,
-                      '16': 36600000, '17': 24000000, '18': 17200000, '19': 26500000, '20': 27500000,
-                      '21': 13200000, '22': 14700000, 'X': 60600000, 'Y': 12500000}
+    def __init__(self, use_Y=False, use_MT=False, genome=None):
+        """Create attributes: size_df, genome_size, start_dict, lines.
+
+        Args:
+            genome: [optional] genome dictionary as a list of (chrom, length),
+                or a path readable by genome_dict.read_genome_dict (genome.txt,
+                .fai, .dict or BAM). Only primary chromosomes are kept.
+                Default is hg19. Chromosomes with hg19 lengths (named e.g.
+                '1' or 'chr1') get hg19 centromere positions; others have
+                their centromere drawn at the midpoint.
+        """
+        if genome is None:
+            chr_len = HG19_CHROM_LENGTHS
+            p_len_dict = HG19_P_LENGTHS
+        else:
+            if isinstance(genome, str):
+                genome = read_genome_dict(genome)
+            chr_len = [(c, n) for c, n in genome if PRIMARY_CHROM_PATTERN.match(c)]
+            p_len_dict = hg19_p_lengths(chr_len)
         sizes = pd.DataFrame(chr_len, columns=['chrom', 'n_sites'])
-        sizes['increment'] = pd.Series([0] + list(sizes.n_sites.cumsum()[:-1]))
+        sizes['increment'] = sizes.n_sites.cumsum() - sizes.n_sites
         sizes['start'] = sizes['increment'] + 1
-        mids = []
-        for i in range(len(sizes)):
-            try:
-                mids.append(0.5 * (sizes.start.iloc[i] + sizes.start.iloc[i+1]))
-            except IndexError:
-                mids.append(sizes.start.iloc[i] + 0.5 * sizes.n_sites.iloc[i-1])
-        sizes['mids'] = mids
-        sizes['centro'] = sizes.apply(lambda r: p_len_dict.get(r.chrom, round(r.n_sites/2)) + r.increment, axis=1)        
+        sizes['mids'] = sizes.start + 0.5 * sizes.n_sites
+        sizes['centro'] = sizes.chrom.map(p_len_dict).fillna((sizes.n_sites / 2).round()).astype(np.int64) \
+            + sizes.increment
         sizes.set_index('chrom', inplace=True)
+        short_names = sizes.index.str.replace('^chr', '', regex=True)
         if not use_Y:
-            sizes.drop('Y', inplace=True)
+            sizes = sizes[short_names != 'Y']
+            short_names = short_names[short_names != 'Y']
         if not use_MT:
-            sizes.drop('MT', inplace=True)
+            sizes = sizes[~short_names.isin(['M', 'MT'])]
         self.p_len_dict = p_len_dict
         self.size_df = sizes
         self.genome_size = sizes.iloc[-1].increment + sizes.iloc[-1].n_sites
-        self.start_dict = dict(sizes.start.iteritems())
+        self.start_dict = dict(sizes.start.items())
         self.lines = [((x, 0), (x, 0.5)) for x in sizes.start]  # chromosome boundaries
+        self._chrom_index = pd.Index(sizes.index)
+        self._starts = sizes.start.to_numpy(dtype=np.float64)
 
     def get_genome_pos(self, chrom, pos):
-        try:
-            return pos + self.start_dict[str(chrom)]
-        except:
-            return np.nan
+        start = self.start_dict.get(str(chrom))
+        return np.nan if start is None else pos + start
+
+    def genome_pos(self, chrom, pos):
+        """Vectorized get_genome_pos: map arrays of (chrom, pos) to genome coordinates.
+
+        Returns:
+            np.ndarray: float genome positions, NaN for chromosomes not in the genome.
+        """
+        ind = self._chrom_index.get_indexer(pd.Series(chrom).astype(str))
+        pos = pd.to_numeric(pd.Series(pos), errors='coerce').to_numpy(dtype=np.float64)
+        return np.where(ind >= 0, self._starts[ind] + pos, np.nan)
+
+
+def hg19_p_lengths(chr_len):
+    """HG19_P_LENGTHS for chromosomes of chr_len whose length matches hg19, keyed by their names."""
+    hg19_lengths = dict(HG19_CHROM_LENGTHS)
+    p_len_dict = {}
+    for chrom, length in chr_len:
+        short = re.sub('^chr', '', chrom)
+        if short in HG19_P_LENGTHS and hg19_lengths.get(short) == length:
+            p_len_dict[chrom] = HG19_P_LENGTHS[short]
+    return p_len_dict
+
+
+@functools.lru_cache(maxsize=32)
+def _cached_genome_info(use_Y, use_MT, genome):
+    return GenomeInfo(use_Y=use_Y, use_MT=use_MT, genome=genome)
+
+
+def get_genome_info(use_Y=False, use_MT=False, genome=None):
+    """Shared GenomeInfo, built once per (use_Y, use_MT, genome). Treat as read-only.
+
+    genome: as in GenomeInfo; a path is read once, so rebuilt files need a new path.
+    """
+    if isinstance(genome, list):
+        genome = tuple(genome)
+    return _cached_genome_info(bool(use_Y), bool(use_MT), genome)
 
 
 def plot_chr_axis(chrom, pos, y, data=None, ax=None, figsize=None, use_Y=False, use_MT=False, 
-                  alpha=0.5, markersize=2, ylim=None, format_axis=True, **dict_kw):
-    """Plot with genome x-axis."""
+                  alpha=0.5, markersize=2, ylim=None, format_axis=True, genome=None, density=False,
+                  density_bins=DENSITY_BINS, **dict_kw):
+    """Plot with genome x-axis. genome: [optional] genome dictionary for GenomeInfo.
+
+    Args:
+        density (bool): draw points as a binned density image (see
+            plot_density) instead of one marker per point, so render time and
+            output size do not grow with the number of points. Suited to
+            hundreds of thousands of points or more, where markers overlap.
+        density_bins (tuple): (x, y) bins for density mode.
+    """
     if data is not None:
         chrom = data[chrom]
         pos = data[pos]
         y = data[y]
-    g = GenomeInfo(use_Y=use_Y, use_MT=use_MT)
+    g = get_genome_info(use_Y=use_Y, use_MT=use_MT, genome=genome)
     d = pd.concat([pd.Series(chrom), pd.Series(pos), pd.Series(y)], axis=1)  # position dataframe
     d.columns = ['chrom', 'pos', 'y']
-    d['g_pos'] = d.apply(lambda r: g.get_genome_pos(r.chrom, r.pos), axis=1)
+    d['g_pos'] = g.genome_pos(d.chrom, d.pos)
     if figsize is None:
         figsize = (14,3)
-    if ax is None:
+    new_ax = ax is None
+    if new_ax:
         hfig, ax = plt.subplots(1, figsize=figsize)
-    d.plot(x='g_pos', y='y', kind='line', marker='.',
-           linewidth=0, alpha=alpha, markersize=markersize, ax=ax, legend=False, **dict_kw)
+    if density:
+        if ylim is None and not new_ax:
+            ylim = ax.get_ylim()  # match existing axis
+        elif ylim is None:
+            ylim = (d.y.min(), d.y.max()) if d.y.notnull().any() else (0, 1)
+        plot_density(ax, d.g_pos, d.y, xlim=(0, g.genome_size), ylim=ylim, bins=density_bins,
+                     color=dict_kw.get('color', 'C0'), alpha=alpha)
+    else:
+        d.plot(x='g_pos', y='y', kind='line', marker='.',
+               linewidth=0, alpha=alpha, markersize=markersize, ax=ax, legend=False, **dict_kw)
     ymin, ymax = ax.get_ylim() if ylim is None else ylim
     if format_axis:
-        g.lines = [((x, ymin), (x, ymax)) for x in g.size_df.start]  # chromosome boundaries
-        lc = mc.LineCollection(g.lines, linewidths=0.5, colors='gray')  # chr boundaries
+        lines = [((x, ymin), (x, ymax)) for x in g.size_df.start]  # chromosome boundaries
+        lc = mc.LineCollection(lines, linewidths=0.5, colors='gray')  # chr boundaries
         ax.add_collection(lc)
         ax.xaxis.set_ticks_position('none') 
         ax.set_xticks(g.size_df.mids)
@@ -84,21 +162,41 @@ def plot_chr_axis(chrom, pos, y, data=None, ax=None, figsize=None, use_Y=False,
     return ax
 
 
+def plot_density(ax, x, y, xlim, ylim, bins=DENSITY_BINS, color='C0', alpha=0.5):
+    """Draw points as a 2D histogram image in a single color.
+
+    Opacity scales with log point count per bin (up to alpha), and empty bins
+    are transparent, so densities for several point sets can be overlaid.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    ok = np.isfinite(x) & np.isfinite(y)
+    counts, _, _ = np.histogram2d(x[ok], y[ok], bins=bins, range=[xlim, ylim])
+    image = np.zeros(counts.T.shape + (4,))
+    image[..., :3] = mcolors.to_rgb(color)
+    if counts.max() > 0:
+        image[..., 3] = alpha * np.log1p(counts.T) / np.log1p(counts.max())
+    ax.imshow(image, origin='lower', extent=(xlim[0], xlim[1], ylim[0], ylim[1]),
+              aspect='auto', interpolation='nearest')
+    return ax
+
+
 def plot_chr_intervals(ax, chrom, posA, posB, data=None, facecolor='r', alpha=0.1,
-                       ylim=None, use_Y=False, use_MT=False, **plot_kw):
-    """Plot intervals on pre-existing genome axis."""
+                       ylim=None, use_Y=False, use_MT=False, genome=None, **plot_kw):
+    """Plot intervals on pre-existing genome axis, as one PatchCollection.
+
+    genome: as in plot_chr_axis.
+    """
     if data is not None:
         chrom = data[chrom]
         posA = data[posA]
         posB = data[posB]
-    g = GenomeInfo(use_Y=use_Y, use_MT=use_MT)
-    d = pd.concat([pd.Series(chrom), pd.Series(posA), pd.Series(posB)], axis=1)  # position dataframe
-    d.columns = ['chrom', 'posA', 'posB']
-    d['g_posA'] = d.apply(lambda r: g.get_genome_pos(r.chrom, r.posA), axis=1)
-    d['width'] = d.posB - d.posA + 1
+    g = get_genome_info(use_Y=use_Y, use_MT=use_MT, genome=genome)
+    g_posA = g.genome_pos(chrom, posA)
+    width = np.asarray(posB, dtype=np.float64) - np.asarray(posA, dtype=np.float64) + 1
+    ok = np.isfinite(g_posA)
     ybottom, ytop = ax.get_ylim()
     yd = abs(ybottom - ytop)
-    for ind, seg in d.iterrows():
-        xs = seg.g_posA
-        xd = seg.width
-        ax.add_patch(patches.Rectangle((xs, ybottom), xd, yd, alpha=alpha, facecolor=facecolor, edgecolor='none'))
+    rects = [patches.Rectangle((xs, ybottom), xd, yd) for xs, xd in zip(g_posA[ok], width[ok])]
+    ax.add_collection(mc.PatchCollection(rects, alpha=alpha, facecolor=facecolor, edgecolor='none'))
+    ax.set_ylim([ybottom, ytop])
@@ -0,0 +1,305 @@
+"""Pre-flight checks of run_cnv inputs, run before any heavy stage.
+
+A bad sample id, an unindexed BAM or an unsorted target BED otherwise
+fails a run only after hours of VCF filtering or coverage. run_preflight
+checks all inputs in parallel, reading only the VCF header, BAM headers,
+index files and one streaming pass over the target BED, and reports every
+problem found in one PreflightError. With build_indexes, missing BAM,
+FASTA and VCF indexes are built instead of reported.
+
+Checks:
+    vcf: tumor and normal ids are sample columns of the VCF header, and AD
+        is a declared FORMAT field.
+    bam: tumor and normal BAMs exist, with an index if the pysam coverage
+        backend will fetch regions from them.
+    fasta: the reference has .fai and .dict indexes if GATK will read it.
+    bed: targets parse, and are sorted as `bedtools coverage -sorted`
+        expects, i.e. chromosomes contiguous and in genome order, starts
+        non-decreasing.
+    naming: BAM, BED, VCF contig and --chroms chromosome names match the
+        genome dictionary that genome.txt will hold (e.g. 'chr1' vs '1').
+    adtex, tools: the ADTEx script, executables and optional python
+        modules needed by the run can be found.
+"""
+import os
+import shutil
+import importlib.util
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .config import GATK_ALIAS
+from .genome_dict import cached_genome_dict, reference_genome_dict, GenomeDictError
+from .run_report import submit_in_context
+from .supervisor import run_tool
+from .vcf_io import read_vcf_header, vcf_format, find_index
+
+PREFLIGHT_WORKERS = 8  # checks mostly wait on file and subprocess I/O
+BAM_INDEX_SUFFIXES = ('.bai', '.csi')
+MAX_LISTED = 5  # names listed per naming problem
+
+CheckResult = namedtuple('CheckResult', ['problems', 'value'])
+CheckResult.__doc__ = """Problems found by a check (list of str), and what it read, if needed later."""
+
+
+def run_preflight(vcf_path, tumor_id=None, normal_id=None, tumor_bam=None, normal_bam=None,
+                  ref_fasta=None, bed_targets=None, chroms=None, tools=(), modules=(), adtex=False,
+                  sorted_bed=True, bam_index=False, fasta_index=False, vcf_index=False, build_indexes=False,
+                  n_workers=PREFLIGHT_WORKERS):
+    """Check run inputs in parallel, raising PreflightError listing all problems.
+
+    Args:
+        vcf_path (str): VCF, .vcf.gz or BCF with tumor_id and normal_id columns.
+        tumor_bam, normal_bam (str): [optional] BAMs for coverage; not checked
+            if None (e.g. saasCNV only).
+        ref_fasta (str): [optional] reference FASTA. Its index, if any, gives
+            the genome dictionary, as in build_genome_file.
+        bed_targets (str): [optional] target BED.
+        sorted_bed (bool): require bed_targets sorted in genome order.
+        chroms (str): [optional] comma-separated chromosomes kept for BAF.
+        tools (iterable): executables that must be on PATH.
+        modules (iterable): optional python modules that must be installed.
+        adtex (bool): check the ADTEx script can be found.
+        bam_index, fasta_index (bool): require BAM indexes, or FASTA .fai
+            and .dict indexes.
+        vcf_index (bool): a VCF tabix/CSI index would allow parallel reads.
+            Only built (with build_indexes), never required.
+        build_indexes (bool): build missing indexes, with samtools (BAM,
+            FASTA) or pysam (.vcf.gz), rather than reporting them.
+    """
+    checks = {
+        'vcf': (check_vcf, vcf_path, tumor_id, normal_id, vcf_index, build_indexes),
+        'tools': (check_tools, tools, modules),
+    }
+    if tumor_bam is not None:
+        checks['tumor_bam'] = (check_bam, tumor_bam, bam_index, build_indexes)
+    if normal_bam is not None:
+        checks['normal_bam'] = (check_bam, normal_bam, bam_index, build_indexes)
+    if ref_fasta is not None:
+        checks['fasta'] = (check_fasta, ref_fasta, fasta_index, build_indexes)
+    if bed_targets is not None:
+        checks['bed'] = (scan_bed, bed_targets, sorted_bed)
+    if adtex:
+        checks['adtex'] = (check_adtex,)
+    print("Running {} pre-flight checks.".format(len(checks)))
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = {name: submit_in_context(pool, *check) for name, check in checks.items()}
+    problems, values = [], {}
+    for name, future in futures.items():
+        try:
+            result = future.result()
+        except Exception as e:
+            problems.append("{}: {}: {}".format(name, type(e).__name__, e))
+            continue
+        problems.extend("{}: {}".format(name, p) for p in result.problems)
+        values[name] = result.value
+    genome = values.get('fasta') or values.get('normal_bam')  # as get_genome_dict
+    problems.extend("naming: {}".format(p) for p in check_naming(
+        genome, bam_genomes={'tumor': values.get('tumor_bam'), 'normal': values.get('normal_bam')},
+        bed_chroms=values.get('bed'), sorted_bed=sorted_bed, vcf_contigs=values.get('vcf'),
+        chroms=chroms.split(',') if chroms else None))
+    if problems:
+        raise PreflightError(problems)
+    print("Pre-flight checks passed.")
+
+
+def check_vcf(vcf_path, tumor_id=None, normal_id=None, want_index=False, build_index=False):
+    """Check sample columns and FORMAT fields in the VCF header. Value: ##contig names."""
+    problems = []
+    meta, columns = read_vcf_header(vcf_path)
+    samples = columns[9:]
+    for label, sample_id in (('tumor', tumor_id), ('normal', normal_id)):
+        if sample_id is not None and sample_id not in samples:
+            problems.append("{} id {} is not a sample in {} (samples: {}).".format(
+                label, sample_id, vcf_path, _truncated(samples)))
+    if tumor_id is not None and tumor_id == normal_id:
+        problems.append("tumor and normal ids are both {}.".format(tumor_id))
+    format_ids = [_meta_id(line) for line in meta if line.startswith('##FORMAT=')]
+    if format_ids and 'AD' not in format_ids:
+        problems.append("{} declares no AD FORMAT field, needed for BAF.".format(vcf_path))
+    if want_index and find_index(vcf_path) is None:
+        if build_index:
+            problems.extend(_index_vcf(vcf_path))
+        else:
+            print("{} has no tabix or CSI index, so will be read sequentially.".format(vcf_path))
+    contigs = [_meta_id(line) for line in meta if line.startswith('##contig=')]
+    return CheckResult(problems, contigs or None)
+
+
+def check_bam(bam_path, need_index=False, build_index=False):
+    """Check the BAM exists and, if needed, is indexed. Value: its genome dictionary."""
+    if not os.path.exists(bam_path):
+        return CheckResult(["{} not found.".format(bam_path)], None)
+    problems = []
+    if need_index and find_bam_index(bam_path) is None:
+        if build_index:
+            print("Indexing {}.".format(bam_path))
+            run_tool('samtools', ['samtools', 'index', bam_path], name='samtools_index')
+        else:
+            problems.append("{} has no index (.bai/.csi), needed by the pysam coverage backend; "
+                            "run `samtools index` or use --build_indexes.".format(bam_path))
+    return CheckResult(problems, cached_genome_dict(bam_path))
+
+
+def find_bam_index(bam_path):
+    """Path of the index of a BAM (.bai or .csi) or CRAM (.crai), or None."""
+    stem = os.path.splitext(bam_path)[0]
+    suffixes = ('.crai',) if bam_path.endswith('.cram') else BAM_INDEX_SUFFIXES
+    for path in [bam_path + s for s in suffixes] + [stem + s for s in suffixes]:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def check_fasta(ref_fasta, need_index=False, build_index=False):
+    """Check the reference FASTA and, if needed, its .fai and .dict indexes.
+
+    Value: the genome dictionary from its index, or None if it has none (in
+    which case genome.txt is built from the normal BAM header).
+    """
+    if not os.path.exists(ref_fasta):
+        return CheckResult(["{} not found.".format(ref_fasta)], None)
+    stem = ref_fasta[:-3] if ref_fasta.endswith('.gz') else ref_fasta
+    dict_path = os.path.splitext(stem)[0] + '.dict'
+    missing = []
+    if need_index and not os.path.exists(ref_fasta + '.fai'):
+        missing.append(('.fai', ['samtools', 'faidx', ref_fasta]))
+    if need_index and not os.path.exists(dict_path) and not os.path.exists(ref_fasta + '.dict'):
+        missing.append(('.dict', ['samtools', 'dict', '-o', dict_path, ref_fasta]))
+    problems = []
+    for suffix, args in missing:
+        if build_index:
+            print("Building {} index of {}.".format(suffix, ref_fasta))
+            run_tool('samtools', args, name='samtools_' + args[1])
+        else:
+            problems.append("{} has no {} index; run `{}` or use --build_indexes.".format(
+                ref_fasta, suffix, ' '.join(args)))
+    try:
+        genome = reference_genome_dict(ref_fasta)
+    except GenomeDictError:
+        genome = None
+    return CheckResult(problems, genome)
+
+
+def scan_bed(bed_path, check_order=True):
+    """Streaming format and sort-order check of a target BED. Value: chromosomes in file order.
+
+    bedtools coverage -sorted needs each chromosome's targets contiguous and
+    in order of start; chromosome order is checked against the genome in
+    check_naming. Stops at the first problem.
+    """
+    chrom_order, seen = [], set()
+    prev_chrom, prev_start = None, None
+    with open(bed_path) as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            fields = line.rstrip('\r\n').split('\t')
+            try:
+                chrom, start, end = fields[0], int(fields[1]), int(fields[2])
+            except (IndexError, ValueError):
+                return CheckResult(["line {} of {} is not chrom<TAB>start<TAB>end: {!r}".format(
+                    line_no, bed_path, line.rstrip('\r\n'))], None)
+            if end < start:
+                return CheckResult(["line {} of {} ends before it starts.".format(line_no, bed_path)], None)
+            if chrom not in seen:
+                chrom_order.append(chrom)
+                seen.add(chrom)
+            elif check_order and chrom != prev_chrom:
+                return CheckResult(["{} targets are not contiguous (line {} of {}); sort with "
+                                    "`bedtools sort -faidx genome.txt`.".format(chrom, line_no, bed_path)], None)
+            elif check_order and start < prev_start:
+                return CheckResult(["targets are not sorted by start (line {} of {}); sort with "
+                                    "`bedtools sort -faidx genome.txt`.".format(line_no, bed_path)], None)
+            prev_chrom, prev_start = chrom, start
+    if not chrom_order:
+        return CheckResult(["{} has no targets.".format(bed_path)], None)
+    return CheckResult([], chrom_order)
+
+
+def check_naming(genome, bam_genomes=None, bed_chroms=None, sorted_bed=True, vcf_contigs=None, chroms=None):
+    """Problems with chromosome names and order relative to the genome dictionary.
+
+    Args:
+        genome (list): [(chrom, length)] as for genome.txt, or None if unknown.
+        bam_genomes (dict): [optional] maps 'tumor'/'normal' to BAM header
+            dictionaries (or None).
+    """
+    problems = []
+    if genome is not None:
+        names = [chrom for chrom, _ in genome]
+        rank = {chrom: i for i, chrom in enumerate(names)}
+        for label, bam_genome in sorted((bam_genomes or {}).items()):
+            if bam_genome is not None and [c for c, _ in bam_genome] != names:
+                problems.append("{} BAM sequences ({}) differ from genome ({}).".format(
+                    label, _truncated(c for c, _ in bam_genome), _truncated(names)))
+        if bed_chroms is not None:
+            unknown = [c for c in bed_chroms if c not in rank]
+            if unknown:
+                problems.append("BED chromosomes not in genome: {} (genome has {}).".format(
+                    _truncated(unknown), _truncated(names)))
+            elif sorted_bed and bed_chroms != sorted(bed_chroms, key=rank.get):
+                problems.append("BED chromosome order ({}) differs from genome order ({}), as needed "
+                                "by bedtools coverage -sorted.".format(_truncated(bed_chroms), _truncated(names)))
+        if vcf_contigs is not None and not set(vcf_contigs) & set(rank):
+            problems.append("no VCF contig is in the genome (VCF has {}, genome has {}).".format(
+                _truncated(vcf_contigs), _truncated(names)))
+    if chroms is not None and vcf_contigs is not None and not set(chroms) & set(vcf_contigs):
+        problems.append("none of the BAF chromosomes ({}) are VCF contigs ({}).".format(
+            _truncated(chroms), _truncated(vcf_contigs)))
+    return problems
+
+
+def check_tools(tools, modules=()):
+    problems = ["{} not found on PATH.".format(tool) for tool in tools if shutil.which(tool) is None]
+    problems.extend("python module {} is not installed.".format(module) for module in modules
+                    if importlib.util.find_spec(module) is None)
+    return CheckResult(problems, None)
+
+
+def check_adtex():
+    from .pipeline import _locate_adtex_script
+    return CheckResult([], _locate_adtex_script())
+
+
+def gatk_executable():
+    """First word of GATK_ALIAS, e.g. 'java' for 'java -jar GenomeAnalysisTK.jar'."""
+    return GATK_ALIAS.split()[0] if GATK_ALIAS.split() else 'gatk'
+
+
+def _index_vcf(vcf_path):
+    """Build a tabix index for a bgzipped VCF, returning problems."""
+    if vcf_format(vcf_path) != 'vcf.gz':
+        return ["{} has no index; index it with `bcftools index`.".format(vcf_path)]
+    from .vcf_io import _import_pysam
+    print("Indexing {}.".format(vcf_path))
+    try:
+        _import_pysam().tabix_index(vcf_path, preset='vcf', keep_original=True)
+    except (OSError, ValueError) as e:  # e.g. gzip but not bgzip
+        return ["could not index {} ({}); recompress with bgzip.".format(vcf_path, e)]
+    return []
+
+
+def _meta_id(line):
+    """ID of a '##KEY=<ID=...,...>' meta-information line."""
+    body = line.split('=<', 1)[-1].rstrip('>')
+    for field in body.split(','):
+        key, _, value = field.partition('=')
+        if key == 'ID':
+            return value
+    return None
+
+
+def _truncated(names):
+    names = list(names)
+    shown = ', '.join(names[:MAX_LISTED])
+    return shown + (', ... ({} total)'.format(len(names)) if len(names) > MAX_LISTED else '')
+
+
+class PreflightError(Exception):
+    """All problems found by run_preflight, one per line after a summary line."""
+    def __init__(self, problems):
+        self.problems = list(problems)
+        summary = "Pre-flight check failed: {}".format(self.problems[0])
+        if len(self.problems) > 1:
+            summary += " (+{} more)".format(len(self.problems) - 1)
+        super().__init__('\n  '.join([summary] + self.problems))
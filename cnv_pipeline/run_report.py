@@ -0,0 +1,497 @@
+"""Resource accounting for pipeline stages and subprocesses.
+
+run_cnv records, for each stage, wall time, CPU time of the thread running
+the stage and, labelled process_*, figures for the whole process: CPU time,
+bytes read and written (from /proc/self/io) and peak RSS since process
+start. Concurrent stages overlap in the process_* figures.
+Subprocesses started through run_command are reaped with os.wait4, which
+gives their exit status, user/system CPU and block I/O. Their peak RSS is
+sampled from /proc/<pid>/status while they run: the wait4 figure
+(rusage_peak_rss_bytes) is an upper bound only, as Linux carries the
+parent's high-water mark over into the child. Results
+go to <sample_dir>/run_report.json; aggregate_run_reports summarizes many
+samples (see the cnv_report command).
+
+Each command runs in its own session. On timeout, interrupt or
+RunReport.cancel its process group is sent SIGTERM, then SIGKILL, so tools
+launched through wrappers (e.g. a GATK container) do not outlive the run.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import resource
+import collections
+import threading
+import contextlib
+import contextvars
+import subprocess
+
+REPORT_NAME = 'run_report.json'
+REPORT_VERSION = 1
+BLOCK_BYTES = 512  # unit of ru_inblock / ru_oublock
+RSS_SAMPLE_SECONDS = 0.1
+KILL_GRACE_SECONDS = 10  # between SIGTERM and SIGKILL of a command's process group
+STDERR_TAIL_LINES = 20
+LOG_DIR_NAME = 'logs'
+
+_current_report = contextvars.ContextVar('current_report', default=None)
+_current_stage = contextvars.ContextVar('current_stage', default=None)
+_active_commands = {}  # running Popen -> RunReport (or None)
+_active_lock = threading.Lock()
+
+
+class RunReport:
+    """Collects stage and subprocess records for one run_cnv call."""
+    def __init__(self, sample_dir):
+        self.sample_dir = sample_dir
+        self.report_path = os.path.join(sample_dir, REPORT_NAME)
+        self.started = time.time()
+        self.stages = []
+        self.subprocesses = []
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Make this the report that run_command records into, in this context."""
+        token = _current_report.set(self)
+        try:
+            yield self
+        finally:
+            _current_report.reset(token)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Record resource use of the enclosed block as stage name."""
+        record = dict(name=name, status='running', skipped=False)
+        stage_token = _current_stage.set(name)
+        report_token = _current_report.set(self)
+        io_start = _process_io()
+        t0, cpu0, proc_cpu0 = time.perf_counter(), time.thread_time(), time.process_time()
+        try:
+            yield record
+            record['status'] = 'skipped' if record['skipped'] else 'success'
+        except BaseException as e:
+            record['status'] = 'failed'
+            record['error'] = '{}: {}'.format(type(e).__name__, e)
+            if isinstance(e, CommandError):
+                record['command_error'] = e.to_dict()
+            raise
+        finally:
+            record['wall_seconds'] = time.perf_counter() - t0
+            record['cpu_seconds'] = time.thread_time() - cpu0
+            record['process_cpu_seconds'] = time.process_time() - proc_cpu0
+            record['process_peak_rss_bytes'] = _self_peak_rss()
+            io_end = _process_io()
+            for key in ('read_bytes', 'write_bytes'):
+                if key in io_start and key in io_end:
+                    record['process_' + key] = io_end[key] - io_start[key]
+            _current_stage.reset(stage_token)
+            _current_report.reset(report_token)
+            with self._lock:
+                children = [p for p in self.subprocesses if p['stage'] == name]
+                record['child_cpu_seconds'] = sum(p['user_cpu_seconds'] + p['sys_cpu_seconds']
+                                                  for p in children)
+                record['child_peak_rss_bytes'] = max([p['peak_rss_bytes'] or 0 for p in children], default=0)
+                self.stages.append(record)
+
+    def cancel(self):
+        """Kill running commands started under this report, and refuse to start new ones."""
+        with _active_lock:  # see _register_command
+            self.cancelled = True
+        terminate_commands(self)
+
+    def add_subprocess(self, record):
+        with self._lock:
+            self.subprocesses.append(record)
+
+    def write(self, status='success'):
+        """Write run_report.json to sample_dir."""
+        with self._lock:
+            report = dict(version=REPORT_VERSION, sample_dir=os.path.realpath(self.sample_dir),
+                          host=socket.gethostname(), pid=os.getpid(), status=status,
+                          started=self.started, finished=time.time(),
+                          wall_seconds=time.time() - self.started,
+                          peak_rss_bytes=_self_peak_rss(),
+                          stages=self.stages, subprocesses=self.subprocesses)
+        tmp_path = self.report_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(report, f, indent=1)
+        os.replace(tmp_path, self.report_path)
+        return report
+
+
+def run_command(args, stdin=subprocess.DEVNULL, stdout=None, stderr=None, check=False, timeout=None,
+                log_path=None, **popen_kw):
+    """Run a command to completion, recording its resource use in the active report.
+
+    The command runs in its own session, so that on timeout, interrupt or
+    cancellation (see terminate_commands) its whole process tree is killed.
+
+    Args:
+        args (list): command arguments, as for subprocess.Popen.
+        check (bool): raise CommandError on non-zero exit status.
+        timeout (float): [optional] seconds before the process tree is killed.
+            A timed out command has a negative exit status and, with check,
+            raises CommandError with timed_out set.
+        log_path (str): [optional] append stderr to this file. Stderr is read
+            on a background thread and still echoed to stderr (or sys.stderr).
+
+    Returns:
+        int: exit status (negative signal number if killed by a signal).
+    """
+    owner = _current_report.get()
+    if getattr(owner, 'cancelled', False):
+        raise CommandError(None, args, cancelled=True, stage=_current_stage.get())
+    t0 = time.perf_counter()
+    tee = None
+    proc = subprocess.Popen(args, stdin=stdin, stdout=stdout,
+                            stderr=subprocess.PIPE if log_path is not None else stderr,
+                            start_new_session=True, **popen_kw)
+    if _register_command(proc, owner):
+        kill_process_tree(proc, 'cancel')
+    if log_path is not None:
+        tee = _StderrTee(proc.stderr, log_path, echo=stderr)
+    sampler = _RssSampler(proc.pid)
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, kill_process_tree, args=(proc, 'timeout'))
+        timer.daemon = True
+        timer.start()
+    try:
+        os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)  # leave a zombie: pid is not reused
+        sampler.stop()
+        _, status, usage = _wait4(proc.pid)
+    except BaseException:
+        sampler.stop()
+        kill_process_tree(proc)
+        proc.wait()
+        raise
+    finally:
+        if timer is not None:
+            timer.cancel()
+        with _active_lock:
+            _active_commands.pop(proc, None)
+        if tee is not None:
+            tee.join()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    killed_by = getattr(proc, 'killed_by', None)
+    timed_out = killed_by == 'timeout'
+    record = dict(stage=_current_stage.get(), cmd=list(map(str, args)), exit_status=proc.returncode,
+                  wall_seconds=time.perf_counter() - t0,
+                  user_cpu_seconds=usage.ru_utime, sys_cpu_seconds=usage.ru_stime,
+                  peak_rss_bytes=sampler.peak_rss,
+                  rusage_peak_rss_bytes=usage.ru_maxrss * 1024,
+                  read_bytes=usage.ru_inblock * BLOCK_BYTES,
+                  write_bytes=usage.ru_oublock * BLOCK_BYTES,
+                  timed_out=timed_out, log_path=log_path)
+    if owner is not None:
+        owner.add_subprocess(record)
+    if check and proc.returncode != 0:
+        raise CommandError(proc.returncode, args, timed_out=timed_out, timeout=timeout,
+                           cancelled=killed_by == 'cancel', log_path=log_path,
+                           stderr_tail=tee.tail() if tee is not None else None, stage=record['stage'])
+    return proc.returncode
+
+
+def terminate_commands(owner=None):
+    """Kill the process trees of running commands started under report owner.
+
+    owner None matches commands run outside any report. See RunReport.cancel.
+    """
+    with _active_lock:
+        procs = [p for p, o in _active_commands.items() if o is owner]
+    for proc in procs:
+        kill_process_tree(proc, 'cancel')
+
+
+@contextlib.contextmanager
+def track_command(proc):
+    """Register a process started outside run_command, so that RunReport.cancel kills it too."""
+    owner = _current_report.get()
+    if getattr(owner, 'cancelled', False):
+        raise CommandError(None, proc.args, cancelled=True, stage=_current_stage.get())
+    if _register_command(proc, owner):
+        with _active_lock:
+            _active_commands.pop(proc, None)
+        kill_process_tree(proc, 'cancel')
+        raise CommandError(None, proc.args, cancelled=True, stage=_current_stage.get())
+    try:
+        yield
+    finally:
+        with _active_lock:
+            _active_commands.pop(proc, None)
+
+
+def _register_command(proc, owner):
+    """Add proc to the active commands, returning True if owner was cancelled meanwhile.
+
+    Registration and the cancelled check share _active_lock with
+    RunReport.cancel, so a command started while its report is being
+    cancelled is either killed by cancel or seen here, never missed.
+    """
+    with _active_lock:
+        _active_commands[proc] = owner
+        return getattr(owner, 'cancelled', False)
+
+
+def record_command(cmd, exit_status, wall_seconds, pid=None, cpu_start=(0.0, 0.0), **fields):
+    """Record work done by a long-lived process (e.g. one job of a worker) in the active report.
+
+    CPU time is the change in the process's own user/system time since
+    cpu_start (from process_cpu_seconds). Peak RSS is the process's
+    high-water mark so far, so may come from an earlier job.
+    """
+    report = _current_report.get()
+    if report is None:
+        return
+    user, sys_ = process_cpu_seconds(pid) if pid is not None else cpu_start
+    record = dict(stage=_current_stage.get(), cmd=list(map(str, cmd)), exit_status=exit_status,
+                  wall_seconds=wall_seconds,
+                  user_cpu_seconds=max(user - cpu_start[0], 0.0), sys_cpu_seconds=max(sys_ - cpu_start[1], 0.0),
+                  peak_rss_bytes=_peak_rss_of(pid) if pid is not None else None,
+                  rusage_peak_rss_bytes=None, read_bytes=None, write_bytes=None,
+                  timed_out=False, log_path=None)
+    record.update(fields)
+    report.add_subprocess(record)
+
+
+def process_cpu_seconds(pid):
+    """User and system CPU seconds of a running process, from /proc/<pid>/stat (0.0 if unavailable)."""
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        ticks = os.sysconf('SC_CLK_TCK')
+        return int(fields[11]) / ticks, int(fields[12]) / ticks
+    except (OSError, ValueError, IndexError):
+        return 0.0, 0.0
+
+
+def current_stage_log(name):
+    """Log path <sample_dir>/logs/<stage>.<name>.log for the active report and stage, or None."""
+    report = _current_report.get()
+    if report is None:
+        return None
+    log_dir = os.path.join(report.sample_dir, LOG_DIR_NAME)
+    os.makedirs(log_dir, exist_ok=True)
+    return os.path.join(log_dir, '{}.{}.log'.format(_current_stage.get() or 'run', name))
+
+
+def submit_in_context(pool, func, *args, **kwargs):
+    """pool.submit that carries the current report and stage into the worker thread."""
+    return pool.submit(contextvars.copy_context().run, func, *args, **kwargs)
+
+
+def load_run_report(sample_dir):
+    with open(os.path.join(sample_dir, REPORT_NAME)) as f:
+        return json.load(f)
+
+
+def aggregate_run_reports(sample_dirs):
+    """Stage records from many samples' run reports.
+
+    Returns:
+        stages (pd.DataFrame): one row per sample and stage.
+        totals (pd.DataFrame): per stage, number of samples run, total and
+            mean wall time, total thread and child CPU time, max peak RSS,
+            sorted by total wall time.
+    """
+    import pandas as pd
+    rows = []
+    for sample_dir in sample_dirs:
+        if not os.path.exists(os.path.join(sample_dir, REPORT_NAME)):
+            print("{}: no run report.".format(sample_dir), file=sys.stderr)
+            continue
+        report = load_run_report(sample_dir)
+        for stage in report['stages']:
+            row = dict(sample_dir=sample_dir)
+            row.update({k: v for k, v in stage.items() if k != 'error'})
+            rows.append(row)
+    columns = ['sample_dir', 'name', 'status', 'wall_seconds', 'cpu_seconds', 'child_cpu_seconds',
+               'process_peak_rss_bytes', 'child_peak_rss_bytes']
+    stages = pd.DataFrame(rows).reindex(columns=columns)
+    ran = stages[stages.status != 'skipped']
+    totals = ran.groupby('name').agg(
+        n_samples=('sample_dir', 'nunique'), failed=('status', lambda s: (s == 'failed').sum()),
+        wall_seconds=('wall_seconds', 'sum'), mean_wall_seconds=('wall_seconds', 'mean'),
+        cpu_seconds=('cpu_seconds', 'sum'), child_cpu_seconds=('child_cpu_seconds', 'sum'),
+        max_peak_rss_bytes=('process_peak_rss_bytes', 'max'),
+        max_child_peak_rss_bytes=('child_peak_rss_bytes', 'max'))
+    totals['wall_fraction'] = totals.wall_seconds / totals.wall_seconds.sum()
+    return stages, totals.sort_values('wall_seconds', ascending=False)
+
+
+class _RssSampler:
+    """Poll VmHWM of a running process on a background thread.
+
+    peak_rss is None if the process exited before the first sample.
+    """
+    def __init__(self, pid, interval=RSS_SAMPLE_SECONDS):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            rss = _peak_rss_of(self.pid)
+            if rss is not None:
+                self.peak_rss = max(self.peak_rss or 0, rss)
+            if self._stopped.wait(self.interval):
+                return
+
+
+class _StderrTee:
+    """Copy a command's stderr pipe to a log file and an echo stream, keeping the last lines."""
+    def __init__(self, pipe, log_path, echo=None):
+        self.pipe = pipe
+        self.log_path = log_path
+        self.echo = echo
+        self._tail = collections.deque(maxlen=STDERR_TAIL_LINES)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def join(self):
+        self._thread.join()
+        self.pipe.close()
+
+    def tail(self):
+        return ''.join(self._tail)
+
+    def _run(self):
+        echo = self.echo if self.echo is not None else sys.stderr
+        with open(self.log_path, 'a') as log:
+            for raw in iter(self.pipe.readline, b''):
+                line = raw.decode(errors='replace')
+                self._tail.append(line)
+                log.write(line)
+                log.flush()
+                try:
+                    echo.write(line)
+                    echo.flush()
+                except (OSError, ValueError):  # echo stream closed
+                    pass
+
+
+def kill_process_tree(proc, reason='interrupt', grace=KILL_GRACE_SECONDS):
+    """SIGTERM the command's process group, then SIGKILL whatever remains after grace seconds."""
+    if getattr(proc, 'killed_by', None) is None:
+        proc.killed_by = reason
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except (ProcessLookupError, PermissionError):
+        return
+    deadline = time.monotonic() + grace
+    while time.monotonic() < deadline:
+        try:
+            if os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None:
+                break
+        except ChildProcessError:  # already reaped
+            break
+        time.sleep(0.1)
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _peak_rss_of(pid):
+    """VmHWM of pid in bytes, or None if unavailable (e.g. process exited)."""
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _wait4(pid):
+    while True:
+        try:
+            return os.wait4(pid, 0)
+        except InterruptedError:
+            continue
+
+
+def _self_peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # Linux reports KiB
+
+
+def _process_io():
+    """read_bytes/write_bytes of this process from /proc/self/io (Linux only)."""
+    try:
+        with open('/proc/self/io') as f:
+            return {k: int(v) for k, v in (line.split(': ') for line in f)}
+    except (OSError, ValueError):
+        return {}
+
+
+class CommandError(subprocess.CalledProcessError):
+    """A command failed, timed out or was cancelled.
+
+    Attributes (besides returncode and cmd): stage, timed_out, timeout,
+    cancelled, log_path (stderr log, if any), stderr_tail (last lines of
+    stderr, if captured) and attempts (set by supervisor.run_tool).
+    """
+    def __init__(self, returncode, cmd, stage=None, timed_out=False, timeout=None, cancelled=False,
+                 log_path=None, stderr_tail=None, attempts=1):
+        super().__init__(returncode, cmd, stderr=stderr_tail)
+        self.stage = stage
+        self.timed_out = timed_out
+        self.timeout = timeout
+        self.cancelled = cancelled
+        self.log_path = log_path
+        self.stderr_tail = stderr_tail
+        self.attempts = attempts
+
+    def __str__(self):
+        cmd = ' '.join(map(str, self.cmd))
+        if self.cancelled:
+            msg = "Command cancelled: {}".format(cmd)
+        elif self.timed_out:
+            msg = "Command timed out after {}s: {}".format(self.timeout, cmd)
+        else:
+            msg = "Command failed with exit status {}: {}".format(self.returncode, cmd)
+        if self.stage is not None:
+            msg += " (stage {})".format(self.stage)
+        if self.attempts > 1:
+            msg += " after {} attempts".format(self.attempts)
+        if self.log_path is not None:
+            msg += ". Log: {}".format(self.log_path)
+        if self.stderr_tail:
+            msg += "\n" + self.stderr_tail.rstrip()
+        return msg
+
+    def to_dict(self):
+        return dict(cmd=list(map(str, self.cmd)), exit_status=self.returncode, stage=self.stage,
+                    timed_out=self.timed_out, cancelled=self.cancelled, attempts=self.attempts,
+                    log_path=self.log_path, stderr_tail=self.stderr_tail)
+
+
+def main():
+    parser = argparse.ArgumentParser("CNV RUN REPORT")
+    parser.add_argument('sample_dirs', nargs='+', help='Sample output dir(s) with run_report.json')
+    parser.add_argument('-o', '--out_path', help='Also write per-sample stage table (tsv)', default=None)
+    args = parser.parse_args()
+
+    import pandas as pd
+    stages, totals = aggregate_run_reports(args.sample_dirs)
+    if args.out_path is not None:
+        stages.to_csv(args.out_path, sep='\t', index=False)
+    totals = totals.copy()
+    for col in ['max_peak_rss_bytes', 'max_child_peak_rss_bytes']:
+        totals[col.replace('_bytes', '_mb')] = (totals.pop(col) / 1024 ** 2).round(0)
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(totals.round(2).to_string())
@@ -0,0 +1,201 @@
+"""Persistent R workers for saasCNV.
+
+A one-shot `Rscript run_saas.R` pays R startup and the saasCNV, DNAcopy,
+RANN and arrow library load for every sample. A SaasWorker starts
+saas_worker.R once and sends it one job per sample over a pipe (a
+tab-separated line on stdin; replies are marker lines on stdout, see
+saas_worker.R). Job output goes to a per-job log file.
+
+Each process keeps a small pool of workers (get_worker_pool), so a cohort
+worker process reuses one R worker for all the pairs it runs. Workers exit
+when their stdin is closed, including when the Python process dies.
+"""
+import os
+import sys
+import time
+import queue
+import atexit
+import threading
+import itertools
+import subprocess
+import collections
+
+from .run_report import (CommandError, track_command, record_command, process_cpu_seconds,
+                         kill_process_tree)
+
+PKG_DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+ONESHOT_SCRIPT = os.path.join(PKG_DIR_PATH, 'run_saas.R')
+WORKER_SCRIPT = os.path.join(PKG_DIR_PATH, 'saas_worker.R')
+LIB_SCRIPT = os.path.join(PKG_DIR_PATH, 'saas_lib.R')
+MARKER = '@@SAAS_WORKER@@'
+START_TIMEOUT = 600  # seconds for R to start and load libraries
+STOP_TIMEOUT = 10
+STDERR_TAIL_LINES = 20
+# NGS.CNV arguments: min.snps, max.chpts, use.null.data, merge.pvalue.cutoff, cnvcall.pvalue.cutoff
+SAAS_PARAMS = ('50', '30', 'FALSE', '0.05', '0.05')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class SaasWorker:
+    """One persistent `Rscript saas_worker.R` process.
+
+    Raises SaasWorkerError if the worker does not report ready within
+    start_timeout seconds.
+    """
+    def __init__(self, start_timeout=START_TIMEOUT):
+        self.cmd = ['Rscript', WORKER_SCRIPT]
+        self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE, universal_newlines=True, bufsize=1,
+                                     start_new_session=True)
+        self._replies = queue.Queue()
+        self._stderr_tail = collections.deque(maxlen=STDERR_TAIL_LINES)
+        self._job_ids = itertools.count(1)
+        for target in (self._read_stdout, self._read_stderr):
+            threading.Thread(target=target, daemon=True).start()
+        reply = self._next_reply(start_timeout)
+        if not reply or reply[0] != 'READY':
+            self.kill()
+            raise SaasWorkerError("saasCNV worker failed to start: {}".format(self.stderr_tail() or reply))
+        self.pid = self.proc.pid
+
+    @property
+    def alive(self):
+        return self.proc.poll() is None
+
+    def run(self, sample_id, sample_dir, seq_path, log_path, params=SAAS_PARAMS, timeout=None):
+        """Run one saasCNV job, raising CommandError if it fails, times out or is cancelled.
+
+        Raises SaasWorkerError if the worker dies for another reason, in
+        which case the job may be rerun elsewhere.
+        """
+        job_id = str(next(self._job_ids))
+        fields = [job_id, log_path, sample_id, sample_dir, seq_path] + list(params)
+        if any('\t' in f or '\n' in f for f in fields):
+            raise ValueError("saasCNV job fields may not contain tabs or newlines: {}".format(fields))
+        cmd = self.cmd + fields[2:]
+        t0 = time.perf_counter()
+        cpu_start = process_cpu_seconds(self.pid)
+        with track_command(self.proc):
+            try:
+                self.proc.stdin.write('\t'.join(fields) + '\n')
+                self.proc.stdin.flush()
+            except OSError:
+                raise SaasWorkerError("saasCNV worker (pid {}) exited before job: {}".format(
+                    self.pid, self.stderr_tail()))
+            reply = self._next_reply(timeout)
+        timed_out = reply is None
+        ok = bool(reply) and reply[2] == 'OK'
+        exit_status = 0 if ok else 1 if reply else None if timed_out else self.proc.wait()
+        record_command(cmd, exit_status, time.perf_counter() - t0,
+                       pid=self.pid, cpu_start=cpu_start, timed_out=timed_out, log_path=log_path,
+                       worker_pid=self.pid)
+        if timed_out:
+            kill_process_tree(self.proc, 'timeout')
+            self.proc.wait()
+        if not reply:
+            killed_by = getattr(self.proc, 'killed_by', None)
+            if killed_by in ('timeout', 'cancel'):
+                raise CommandError(self.proc.returncode, cmd, timed_out=killed_by == 'timeout', timeout=timeout,
+                                   cancelled=killed_by == 'cancel', log_path=log_path,
+                                   stderr_tail=self.stderr_tail())
+            raise SaasWorkerError("saasCNV worker (pid {}) died during job (exit status {}): {}".format(
+                self.pid, exit_status, self.stderr_tail()))
+        if reply[1] != job_id:
+            self.kill()
+            raise SaasWorkerError("saasCNV worker replied to job {}, expected {}.".format(reply[1], job_id))
+        if not ok:
+            raise CommandError(1, cmd, log_path=log_path, stderr_tail='\t'.join(reply[3:]))
+
+    def close(self, timeout=STOP_TIMEOUT):
+        """Ask the worker to exit by closing its stdin, killing it if it does not."""
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
+
+    def kill(self):
+        if self.alive:
+            kill_process_tree(self.proc, grace=STOP_TIMEOUT)
+        self.proc.wait()
+
+    def stderr_tail(self):
+        return ''.join(self._stderr_tail)
+
+    def _next_reply(self, timeout=None):
+        """Next marker line as a list of fields, [] if the worker exited, or None on timeout."""
+        try:
+            return self._replies.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _read_stdout(self):
+        for line in self.proc.stdout:
+            if line.startswith(MARKER + '\t'):
+                self._replies.put(line.rstrip('\n').split('\t')[1:])
+            else:  # output before a job's log is open
+                sys.stderr.write(line)
+        self._replies.put([])
+
+    def _read_stderr(self):
+        for line in self.proc.stderr:
+            self._stderr_tail.append(line)
+            sys.stderr.write(line)
+
+
+class SaasWorkerPool:
+    """Up to max_workers persistent workers, started on demand and reused across jobs."""
+    def __init__(self, max_workers=1):
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def run(self, *args, **kwargs):
+        """Run a job (see SaasWorker.run) on an idle or new worker."""
+        with self._slots:
+            with self._lock:
+                worker = self._idle.pop() if self._idle else None
+            if worker is None or not worker.alive:
+                worker = SaasWorker()
+            try:
+                worker.run(*args, **kwargs)
+            except CommandError:
+                if worker.alive:  # the job failed in R: worker still usable
+                    self._release(worker)
+                raise
+            except BaseException:
+                worker.kill()
+                raise
+            self._release(worker)
+
+    def _release(self, worker):
+        with self._lock:
+            self._idle.append(worker)
+
+    def close(self):
+        with self._lock:
+            workers, self._idle = self._idle, []
+        for worker in workers:
+            worker.close()
+
+
+def get_worker_pool():
+    """This process's worker pool, created on first use and closed at exit."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SaasWorkerPool()
+            atexit.register(_pool.close)
+        return _pool
+
+
+def saas_oneshot_args(sample_id, sample_dir, seq_path, params=SAAS_PARAMS):
+    """Command line for a one-shot run of run_saas.R."""
+    return ['Rscript', ONESHOT_SCRIPT, sample_id, sample_dir, seq_path] + list(params)
+
+
+class SaasWorkerError(Exception):
+    pass
+
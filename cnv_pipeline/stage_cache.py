@@ -0,0 +1,174 @@
+"""Stage cache: skip pipeline stages whose inputs, parameters and outputs are unchanged.
+
+Each completed stage is recorded in a JSON manifest in the sample dir, keyed
+on a hash of the stage parameters and the fingerprints of its input files.
+Small files are fingerprinted by content (so a recomputed but identical
+upstream output does not invalidate downstream stages); large files such as
+BAMs and VCFs by size and modification time. A stage is skipped on rerun if
+its key matches and its recorded outputs are unchanged.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import threading
+
+MANIFEST_NAME = '.stage_cache.json'
+MANIFEST_VERSION = 1
+CONTENT_HASH_MAX_BYTES = 64 * 1024 ** 2  # larger files use size + mtime
+
+
+class StageCache:
+    """Manifest of completed stages for one sample dir."""
+    def __init__(self, sample_dir):
+        self.sample_dir = sample_dir
+        self.manifest_path = os.path.join(sample_dir, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        self.entries = self._load()
+
+    def stage_key(self, stage):
+        """Hash of stage name, parameters and input file fingerprints."""
+        inputs = {path: fingerprint(path) for path in stage.inputs}
+        blob = json.dumps({'stage': stage.name, 'params': stage.params, 'inputs': inputs},
+                          sort_keys=True, default=str)
+        return hashlib.sha256(blob.encode()).hexdigest()
+
+    def is_valid(self, stage, key):
+        """True if stage completed with this key and its outputs are unchanged."""
+        entry = self.entries.get(stage.name)
+        if entry is None or entry['key'] != key:
+            return False
+        if sorted(entry['outputs']) != sorted(stage.outputs):
+            return False
+        return all(fp is not None and fingerprint(path) == fp
+                   for path, fp in entry['outputs'].items())
+
+    def invalidate(self, stage_name):
+        with self._lock:
+            if self.entries.pop(stage_name, None) is not None:
+                self._save()
+
+    def record(self, stage, key, seconds=None):
+        entry = dict(key=key, outputs={path: fingerprint(path) for path in stage.outputs},
+                     completed=time.time(), seconds=seconds)
+        with self._lock:
+            self.entries[stage.name] = entry
+            self._save()
+
+    def clear(self, stage_names=None, remove_outputs=False):
+        """Remove entries (all, or named stages), optionally deleting their outputs.
+
+        Returns:
+            list: names of removed stages, i.e. of those that had an entry.
+        """
+        removed = []
+        with self._lock:
+            names = list(self.entries) if stage_names is None else stage_names
+            for name in names:
+                entry = self.entries.pop(name, None)
+                if entry is None:
+                    continue
+                removed.append(name)
+                if remove_outputs:
+                    _remove_paths(entry['outputs'])
+            if removed:
+                self._save()
+        return removed
+
+    def prune(self, max_age_days=None, remove_outputs=False):
+        """Remove entries older than max_age_days, or whose outputs are gone.
+
+        Returns:
+            list: names of removed stages.
+        """
+        cutoff = None if max_age_days is None else time.time() - max_age_days * 86400
+        stale = [name for name, entry in self.entries.items()
+                 if (cutoff is not None and entry['completed'] < cutoff)
+                 or not all(os.path.exists(path) for path in entry['outputs'])]
+        return self.clear(stale, remove_outputs=remove_outputs)
+
+    def _load(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except ValueError:
+            print("Ignoring unreadable stage cache manifest: {}".format(self.manifest_path))
+            return {}
+        if manifest.get('version') != MANIFEST_VERSION:
+            return {}
+        return manifest['stages']
+
+    def _save(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'stages': self.entries}, f, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+
+def fingerprint(path):
+    """Content hash for small files, size + mtime for large files and dir contents.
+
+    Returns None if path does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+    if os.path.isdir(path):
+        entries = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                st = os.stat(file_path)
+                entries.append((os.path.relpath(file_path, path), st.st_size, st.st_mtime_ns))
+        return 'dir:' + hashlib.sha256(json.dumps(entries).encode()).hexdigest()
+    st = os.stat(path)
+    if st.st_size > CONTENT_HASH_MAX_BYTES:
+        return 'stat:{}:{}'.format(st.st_size, st.st_mtime_ns)
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 ** 2), b''):
+            h.update(block)
+    return 'sha256:' + h.hexdigest()
+
+
+def _remove_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser("CNV STAGE CACHE")
+    parser.add_argument('command', choices=['list', 'clear', 'prune'],
+                        help='list entries; clear entries; prune old or orphaned entries')
+    parser.add_argument('sample_dirs', nargs='+', help='Sample output dir(s)')
+    parser.add_argument('--stage', action='append', default=None,
+                        help='clear: only clear this stage (repeatable)')
+    parser.add_argument('--max_age_days', type=float, default=None,
+                        help='prune: remove entries completed more than this many days ago')
+    parser.add_argument('--remove_outputs', action='store_true', default=False,
+                        help='clear/prune: also delete the output files of removed entries')
+    args = parser.parse_args()
+
+    for sample_dir in args.sample_dirs:
+        if not os.path.exists(os.path.join(sample_dir, MANIFEST_NAME)):
+            print("{}: no stage cache.".format(sample_dir), file=sys.stderr)
+            continue
+        cache = StageCache(sample_dir)
+        if args.command == 'list':
+            for name, entry in cache.entries.items():
+                completed = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['completed']))
+                print("{}\t{}\t{}\t{}".format(sample_dir, name, completed, entry['key'][:12]))
+        elif args.command == 'clear':
+            removed = cache.clear(args.stage, remove_outputs=args.remove_outputs)
+            print("{}: cleared {}".format(sample_dir, ', '.join(removed) or 'nothing'))
+        else:
+            removed = cache.prune(args.max_age_days, remove_outputs=args.remove_outputs)
+            print("{}: pruned {}".format(sample_dir, ', '.join(removed) or 'nothing'))
@@ -0,0 +1,179 @@
+"""Pipeline stage names and cross-process concurrency limits.
+
+Heavy stages (GATK, bedtools, R) compete for memory when many sample pairs
+run at once. A cohort runner can register one semaphore per stage in each
+worker process via set_stage_limits; run_cnv then holds a slot for the
+duration of each stage. Stages without a registered semaphore run freely.
+
+Within a sample, run_cnv describes its stages as a small dependency graph
+(Stage, run_stage_graph) so that independent branches run concurrently.
+"""
+import time
+import contextlib
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .run_report import submit_in_context, terminate_commands
+
+STAGES = ('trim', 'baf', 'saas', 'genome', 'coverage', 'adtex', 'loh')
+
+_STAGE_SEMAPHORES = {}
+
+
+def set_stage_limits(semaphores):
+    """Register stage semaphores for this process.
+
+    Args:
+        semaphores (dict): maps stage name to a multiprocessing semaphore.
+    """
+    for stage in semaphores:
+        if stage not in STAGES:
+            raise ValueError("Invalid stage ({}). Choose from {}.".format(stage, STAGES))
+    _STAGE_SEMAPHORES.clear()
+    _STAGE_SEMAPHORES.update(semaphores)
+
+
+@contextlib.contextmanager
+def stage_slot(stage):
+    """Hold a concurrency slot for stage, if a limit is registered."""
+    semaphore = _STAGE_SEMAPHORES.get(stage)
+    if semaphore is None:
+        yield
+        return
+    with semaphore:
+        yield
+
+
+def parse_stage_limits(limit_strs):
+    """Parse ['saas=2', 'coverage=4'] style CLI values to {stage: int}."""
+    limits = {}
+    for limit_str in limit_strs or []:
+        stage, _, n = limit_str.partition('=')
+        if stage not in STAGES or not n.isdigit() or int(n) < 1:
+            raise ValueError("Invalid stage limit ({}). Use STAGE=N with STAGE in {}."
+                             .format(limit_str, STAGES))
+        limits[stage] = int(n)
+    return limits
+
+
+class Stage:
+    """Pipeline stage: a named zero-argument callable with upstream dependencies.
+
+    inputs, outputs and params are used by the stage cache. params defaults to
+    the bound arguments when func is a functools.partial.
+    """
+    def __init__(self, name, func, deps=(), inputs=(), outputs=(), params=None):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.inputs = [p for p in inputs if p is not None]
+        self.outputs = [p for p in outputs if p is not None]
+        if params is None and isinstance(func, partial):
+            params = {'args': func.args, 'kwargs': func.keywords}
+        self.params = params
+
+    def __repr__(self):
+        return "Stage({!r}, deps={})".format(self.name, self.deps)
+
+
+def run_stage_graph(stages, max_workers=None, cache=None, report=None):
+    """Run stages on a thread pool, starting each once its dependencies finish.
+
+    Independent branches (e.g. saasCNV and coverage generation) run
+    concurrently; the heavy lifting is in subprocesses or pandas/pyarrow code
+    that releases the GIL. If a stage fails, no further stages are started,
+    subprocesses of running stages are killed (see run_report.run_command),
+    and the first error is raised once running stages have returned. The same
+    happens on interrupt (KeyboardInterrupt or SystemExit).
+
+    Args:
+        stages (list): Stage objects. Dependencies must name stages in the list.
+        max_workers (int): [optional] max concurrent stages. Default is no limit.
+            Use 1 to run stages one at a time.
+        cache (StageCache): [optional] skip stages that are still valid, and
+            record stages as they complete.
+        report (RunReport): [optional] record resource use of each stage, and
+            of subprocesses it runs via run_report.run_command.
+
+    Returns:
+        dict: wall-clock seconds per stage name, in completion order.
+    """
+    names = [s.name for s in stages]
+    for stage in stages:
+        missing = [d for d in stage.deps if d not in names]
+        if missing:
+            raise ValueError("Stage {} depends on unknown stages {}.".format(stage.name, missing))
+    timings = {}
+    pending = list(stages)
+    running = {}
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers or max(len(stages), 1)) as pool:
+        try:
+            while pending or running:
+                if not errors:
+                    ready = [s for s in pending if all(d in timings for d in s.deps)]
+                    for stage in ready:
+                        pending.remove(stage)
+                        running[submit_in_context(pool, _run_stage, stage, cache, report)] = stage
+                if not running:
+                    if errors:
+                        break
+                    raise ValueError("Circular stage dependencies: {}".format(pending))
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    try:
+                        timings[stage.name] = future.result()
+                    except Exception as e:
+                        print("Stage {} failed.".format(stage.name))
+                        if not errors:
+                            _cancel_commands(report)
+                        errors.append(e)
+        except BaseException:
+            _cancel_commands(report)
+            raise
+    if errors:
+        raise errors[0]
+    return timings
+
+
+def print_stage_timings(timings):
+    """Print wall-clock seconds per stage."""
+    print("Stage timings (wall clock):")
+    for name, seconds in timings.items():
+        print("  {:<10} {:>9.1f}s".format(name, seconds))
+
+
+def _cancel_commands(report=None):
+    """Kill subprocesses of running stages (those of report, if given)."""
+    if report is not None:
+        report.cancel()
+    else:
+        terminate_commands(None)
+
+
+def _run_stage(stage, cache=None, report=None):
+    if report is None:
+        return _run_cached_stage(stage, cache) or 0.0
+    with report.stage(stage.name) as record:
+        elapsed = _run_cached_stage(stage, cache)
+        record['skipped'] = elapsed is None
+    return elapsed or 0.0
+
+
+def _run_cached_stage(stage, cache=None):
+    """Run stage unless the cache says it is up to date. Returns seconds, or None if skipped."""
+    if cache is not None:
+        key = cache.stage_key(stage)
+        if cache.is_valid(stage, key):
+            print("Stage {} is up to date. Skipping.".format(stage.name))
+            return None
+        cache.invalidate(stage.name)
+    with stage_slot(stage.name):
+        t0 = time.perf_counter()
+        stage.func()
+        elapsed = time.perf_counter() - t0
+    if cache is not None:
+        cache.record(stage, key, seconds=elapsed)
+    print("Stage {} complete ({:.1f}s).".format(stage.name, elapsed))
+    return elapsed
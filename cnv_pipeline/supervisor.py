@@ -0,0 +1,173 @@
+"""Supervised runs of external tools: per-tool timeouts and retries.
+
+run_tool runs a command through run_report.run_command under the policy of
+its tool (timeout, retries, backoff). Stderr goes to
+<sample_dir>/logs/<stage>.<name>.log as well as to its usual destination.
+Failures that look transient (the process was killed by a signal it did
+not get from us, or stderr reports a resource or network error) are
+retried with exponential backoff; anything else raises CommandError at
+once, with the exit status, log path and last lines of stderr.
+
+Policies can be overridden for the current context (e.g. one run_cnv call)
+with tool_policies, from CLI values parsed by parse_tool_timeouts.
+"""
+import re
+import sys
+import time
+import signal
+import contextlib
+import contextvars
+from collections import namedtuple
+
+from .run_report import run_command, current_stage_log, CommandError
+
+ToolPolicy = namedtuple('ToolPolicy', ['timeout', 'retries', 'backoff', 'retry_timeout'])
+ToolPolicy.__doc__ = """Run policy for one external tool.
+
+timeout: seconds before the process tree is killed (None: no limit).
+retries: extra attempts after a transient failure.
+backoff: seconds before the first retry, doubled for each further retry.
+retry_timeout: also retry after a timeout.
+"""
+
+TOOL_POLICIES = {
+    'gatk': ToolPolicy(timeout=6 * 3600, retries=2, backoff=30, retry_timeout=False),
+    'bedtools': ToolPolicy(timeout=6 * 3600, retries=2, backoff=30, retry_timeout=False),
+    'samtools': ToolPolicy(timeout=600, retries=2, backoff=10, retry_timeout=True),
+    'saas': ToolPolicy(timeout=4 * 3600, retries=1, backoff=30, retry_timeout=False),
+    'adtex': ToolPolicy(timeout=12 * 3600, retries=1, backoff=30, retry_timeout=False),
+}
+TOOLS = tuple(TOOL_POLICIES)
+DEFAULT_POLICY = ToolPolicy(timeout=None, retries=0, backoff=30, retry_timeout=False)
+TRANSIENT_SIGNALS = (signal.SIGKILL, signal.SIGBUS, signal.SIGHUP)
+TRANSIENT_STDERR = re.compile(r'Resource temporarily unavailable|Cannot allocate memory|Stale file handle|'
+                              r'Input/output error|Connection (?:reset|refused|timed out)|'
+                              r'Too many open files', re.IGNORECASE)
+
+_policy_overrides = contextvars.ContextVar('tool_policy_overrides', default={})
+
+
+def get_tool_policy(tool):
+    """Policy for tool in the current context."""
+    return _policy_overrides.get().get(tool, TOOL_POLICIES.get(tool, DEFAULT_POLICY))
+
+
+@contextlib.contextmanager
+def tool_policies(timeouts=None, retries=None):
+    """Override tool timeouts and/or retry counts within the enclosed block.
+
+    Args:
+        timeouts (dict): maps tool name to seconds, or None for no limit.
+        retries (int): [optional] retries after transient failures, for all tools.
+    """
+    overrides = dict(_policy_overrides.get())
+    for tool in TOOLS:
+        policy = overrides.get(tool, TOOL_POLICIES[tool])
+        if timeouts and tool in timeouts:
+            policy = policy._replace(timeout=timeouts[tool])
+        if retries is not None:
+            policy = policy._replace(retries=retries)
+        overrides[tool] = policy
+    token = _policy_overrides.set(overrides)
+    try:
+        yield
+    finally:
+        _policy_overrides.reset(token)
+
+
+def parse_tool_timeouts(timeout_strs):
+    """Parse ['saas=3600', 'adtex=none'] style CLI values to {tool: seconds or None}."""
+    timeouts = {}
+    for timeout_str in timeout_strs or []:
+        tool, _, seconds = timeout_str.partition('=')
+        try:
+            value = None if seconds.lower() == 'none' else float(seconds)
+        except ValueError:
+            value = -1
+        if tool not in TOOLS or (value is not None and value <= 0):
+            raise ValueError("Invalid tool timeout ({}). Use TOOL=SECONDS (or TOOL=none) with TOOL in {}."
+                             .format(timeout_str, TOOLS))
+        timeouts[tool] = value
+    return timeouts
+
+
+def run_tool(tool, args, name=None, stdout=None, stderr=None, log_path=None, **popen_kw):
+    """Run an external tool to completion under its policy, raising CommandError on failure.
+
+    Args:
+        tool (str): policy name, one of TOOLS.
+        args (list): command arguments.
+        name (str): [optional] log name, to tell apart several runs of a tool
+            in one stage. Default is tool.
+        stdout: as for subprocess.Popen. A regular file is truncated before
+            each retry.
+        stderr: where stderr is echoed besides the log. Default sys.stderr.
+        log_path (str): [optional] stderr log. Default
+            <sample_dir>/logs/<stage>.<name>.log in the active run report;
+            without a report, stderr is not logged.
+    """
+    policy = get_tool_policy(tool)
+    if log_path is None:
+        log_path = current_stage_log(name or tool)
+    attempt = 1
+    while True:
+        if log_path is not None:
+            with open(log_path, 'a') as log:
+                log.write("### attempt {}: {}\n".format(attempt, ' '.join(map(str, args))))
+        try:
+            run_command(args, stdout=stdout, stderr=stderr, check=True, timeout=policy.timeout,
+                        log_path=log_path, **popen_kw)
+            return
+        except CommandError as e:
+            e.attempts = attempt
+            if attempt > policy.retries or not is_transient(e, policy):
+                raise
+            delay = policy.backoff * 2 ** (attempt - 1)
+            print("{} failed ({}), retrying in {:.0f}s (attempt {} of {}).".format(
+                tool, _failure_str(e), delay, attempt + 1, policy.retries + 1), file=sys.stderr)
+            time.sleep(delay)
+        except OSError as e:  # could not launch, e.g. EAGAIN from fork
+            if attempt > policy.retries or not isinstance(e, BlockingIOError):
+                raise
+            time.sleep(policy.backoff * 2 ** (attempt - 1))
+        _rewind(stdout)
+        attempt += 1
+
+
+def handle_sigterm():
+    """Exit on SIGTERM (e.g. from a scheduler) by raising SystemExit in the main thread.
+
+    Unlike the default handler, this lets run_cnv kill the process trees of
+    running tools and write its run report before exiting.
+    """
+    def _exit(signum, frame):
+        raise SystemExit(128 + signum)
+    signal.signal(signal.SIGTERM, _exit)
+
+
+def is_transient(error, policy=DEFAULT_POLICY):
+    """Whether a failed command is worth retrying."""
+    if error.cancelled:
+        return False
+    if error.timed_out:
+        return policy.retry_timeout
+    if error.returncode is not None and error.returncode < 0 and -error.returncode in TRANSIENT_SIGNALS:
+        return True
+    return bool(error.stderr_tail and TRANSIENT_STDERR.search(error.stderr_tail))
+
+
+def _failure_str(error):
+    if error.timed_out:
+        return "timed out after {}s".format(error.timeout)
+    return "exit status {}".format(error.returncode)
+
+
+def _rewind(stream):
+    """Truncate a regular output file, so a retry does not append to partial output."""
+    if stream is None or stream in (sys.stdout, sys.stderr) or not hasattr(stream, 'truncate'):
+        return
+    try:
+        stream.seek(0)
+        stream.truncate()
+    except (OSError, ValueError):
+        pass
@@ -1,18 +1,46 @@
 import os
-import subprocess
+import csv
 import shlex
+from functools import partial
 
 from .config import GATK_ALIAS
+from .supervisor import run_tool
+from .vcf_io import read_vcf_header, read_vcf_chunks, indexed_chroms, map_vcf_regions
+
+TRIM_BACKENDS = ('gatk', 'python')
+
+VCF_FIXED_COLUMNS = ['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT']
+NORMAL_FIELDS = ('GT', 'AD', 'DP', 'GQ')  # FORMAT fields tested by select_snps
 
 
 def trim_vcf(vcf_in=None, tumor_id=None, normal_id=None, ref_fasta=None,
              ratio_min=0.4, ratio_max=0.6, min_depth_n=10, min_depth_t=20,
-             min_gq_n=90, vcf_out=None, sample_dir=None):
-    """Create new filtered vcf file for tumor and normal sample."""
+             min_gq_n=90, vcf_out=None, sample_dir=None, backend='gatk', chunksize=100000,
+             n_workers=1):
+    """Create new filtered vcf file for tumor and normal sample.
+
+    Args:
+        backend (str): 'gatk' runs GATK SelectVariants. 'python' applies the
+            same selection in a single streaming pass (see select_snps), with
+            no JVM or reference FASTA required.
+        chunksize (int): records per chunk for the 'python' backend.
+        n_workers (int): 'python' backend: for an indexed .vcf.gz or BCF,
+            filter chromosomes in parallel on this many processes.
+    """
     if normal_id is None:
         normal_id = tumor_id + 'N'
     if vcf_out is None:
         vcf_out = os.path.join(sample_dir, 'snps_trimmed.vcf')
+    if backend == 'python':
+        chunks = iter_selected_snps(vcf_in, tumor_id=tumor_id, normal_id=normal_id,
+                                    ratio_min=ratio_min, ratio_max=ratio_max,
+                                    min_depth_n=min_depth_n, min_depth_t=min_depth_t,
+                                    min_gq_n=min_gq_n, chunksize=chunksize, n_workers=n_workers)
+        write_vcf(vcf_in, chunks, vcf_out)
+        print("Created vcf: {}".format(vcf_out))
+        return
+    elif backend != 'gatk':
+        raise ValueError("Invalid trim backend ({}). Choose from {}.".format(backend, TRIM_BACKENDS))
     cmd = (
         f"""{GATK_ALIAS} SelectVariants -R {ref_fasta} -V {vcf_in} -sn {normal_id} -sn {tumor_id} """
         f"""--select-type-to-include SNP --restrict-alleles-to BIALLELIC -select 'vc.getGenotype("{normal_id}").isHet() """
@@ -20,8 +48,121 @@ def trim_vcf(vcf_in=None, tumor_id=None, normal_id=None, ref_fasta=None,
         f"""&& vc.getGenotype("{tumor_id}").getDP() > {min_depth_t - 1} """
         f"""&& vc.getGenotype("{normal_id}").getGQ() > {min_gq_n} """
         f"""&& 1.0 * vc.getGenotype("{normal_id}").getAD().1 /  vc.getGenotype("{normal_id}").getDP() > {ratio_min} """
-        f"""&& 1.0 * vc.getGenotype("{normal_id}").getAD().1 /  vc.getGenotype("{normal_id}").getDP() < {ratio_max}' """ 
+        f"""&& 1.0 * vc.getGenotype("{normal_id}").getAD().1 /  vc.getGenotype("{normal_id}").getDP() < {ratio_max}' """
         f"""--output {vcf_out}""")
     print("VCF trim command: {}".format(cmd))
-    subprocess.check_call(shlex.split(cmd))
+    run_tool('gatk', shlex.split(cmd), stdin=None)
     print("Created vcf: {}".format(vcf_out))
+
+
+def iter_selected_snps(vcf_in, tumor_id=None, normal_id=None,
+                       ratio_min=0.4, ratio_max=0.6, min_depth_n=10, min_depth_t=20,
+                       min_gq_n=90, chunksize=100000, chroms=None, n_workers=1):
+    """Stream VCF in chunks, yielding records that pass select_snps.
+
+    Yielded dataframes hold VCF text fields, restricted to the fixed columns
+    plus the normal and tumor sample columns, and can be passed to
+    baf_from_vcf(vcf_chunks=...) without writing an intermediate VCF.
+
+    If vcf_in is an indexed .vcf.gz or BCF, only the chromosomes in chroms
+    (default all) are read, one chromosome per process on n_workers
+    processes, and records are yielded in index order.
+    """
+    meta, columns = read_vcf_header(vcf_in)
+    for sample_id in (tumor_id, normal_id):
+        if sample_id not in columns:
+            raise ValueError("Sample {} not found in VCF header: {}".format(sample_id, vcf_in))
+    select = partial(select_snps, tumor_id=tumor_id, normal_id=normal_id,
+                     ratio_min=ratio_min, ratio_max=ratio_max,
+                     min_depth_n=min_depth_n, min_depth_t=min_depth_t,
+                     min_gq_n=min_gq_n)
+    regions = indexed_chroms(vcf_in, chroms)
+    if regions is not None:
+        yield from map_vcf_regions(select, vcf_in, regions, n_workers=n_workers, chunksize=chunksize)
+        return
+    for df in read_vcf_chunks(vcf_in, len(meta), chunksize=chunksize):
+        yield select(df)
+
+
+def select_snps(df, tumor_id=None, normal_id=None, ratio_min=0.4, ratio_max=0.6,
+                min_depth_n=10, min_depth_t=20, min_gq_n=90):
+    """Vectorized equivalent of the SelectVariants call in trim_vcf.
+
+    Keeps biallelic SNPs where the normal genotype is heterozygous, normal and
+    tumor FORMAT DP meet the depth minimums, normal GQ exceeds min_gq_n and
+    normal alt AD / DP lies strictly within (ratio_min, ratio_max). As in GATK,
+    a missing DP, GQ or AD fails the corresponding predicate.
+
+    Args:
+        df (pd.DataFrame): VCF records of strings, as from read_vcf_chunks.
+
+    Returns:
+        pd.DataFrame: passing records, with only the normal and tumor sample
+            columns retained (in their original VCF order). INFO is passed
+            through unchanged, unlike SelectVariants which recomputes AC/AN/AF.
+    """
+    from .baf_from_vcf import extract_format_fields
+    normal = extract_format_fields(df.FORMAT, df[normal_id], fields=NORMAL_FIELDS)
+    tumor_dp = _to_numeric(extract_format_fields(df.FORMAT, df[tumor_id], fields=('DP',)).DP)
+    keep = snp_mask(df) & pair_mask(normal, tumor_dp, ratio_min=ratio_min, ratio_max=ratio_max,
+                                    min_depth_n=min_depth_n, min_depth_t=min_depth_t, min_gq_n=min_gq_n)
+    sample_cols = [c for c in df.columns[len(VCF_FIXED_COLUMNS):] if c in (normal_id, tumor_id)]
+    return df.loc[keep, VCF_FIXED_COLUMNS + sample_cols]
+
+
+def snp_mask(df):
+    """Biallelic SNP records, as a boolean series."""
+    return (df.REF.str.match(r'^[ACGTNacgtn]$') & df.ALT.str.match(r'^[ACGTNacgtn]$')
+            & (df.REF.str.upper() != df.ALT.str.upper()))
+
+
+def pair_mask(normal, tumor_dp, ratio_min=0.4, ratio_max=0.6, min_depth_n=10, min_depth_t=20, min_gq_n=90):
+    """Sample predicates of select_snps, as a boolean series.
+
+    Args:
+        normal (pd.DataFrame): normal NORMAL_FIELDS strings, from extract_format_fields.
+        tumor_dp (pd.Series): numeric tumor DP.
+    """
+    import numpy as np
+    normal_dp = _to_numeric(normal.DP)
+    alleles = normal.GT.str.extract(r'^([0-9]+)[/|]([0-9]+)$')
+    is_het = alleles[0].notnull() & (alleles[0] != alleles[1])
+    alt_ratio = 1.0 * _to_numeric(normal.AD.str.split(',').str[1]) / normal_dp
+    with np.errstate(invalid='ignore'):
+        keep = (is_het
+                & (normal_dp > min_depth_n - 1)
+                & (tumor_dp > min_depth_t - 1)
+                & (_to_numeric(normal.GQ) > min_gq_n)
+                & (alt_ratio > ratio_min)
+                & (alt_ratio < ratio_max))
+    return keep.fillna(False).astype(bool)
+
+
+def write_vcf(vcf_in, chunks, vcf_out):
+    """Write VCF record chunks under the meta-information header of vcf_in."""
+    for _ in tee_vcf(vcf_in, chunks, vcf_out):
+        pass
+
+
+def tee_vcf(vcf_in, chunks, vcf_out):
+    """Pass through VCF record chunks, writing each to vcf_out on the way.
+
+    Lets a fused pipeline keep the trimmed VCF as a by-product of streaming
+    records into baf_from_vcf, without a second pass.
+    """
+    meta, columns = read_vcf_header(vcf_in)
+    header = True
+    with open(vcf_out, 'w') as out:
+        for line in meta:
+            out.write(line + '\n')
+        for df in chunks:
+            df.to_csv(out, sep='\t', index=False, header=header, quoting=csv.QUOTE_NONE)
+            header = False
+            yield df
+        if header:  # no records
+            out.write('\t'.join(columns) + '\n')
+
+
+def _to_numeric(series):
+    import pandas as pd
+    return pd.to_numeric(series, errors='coerce')
@@ -0,0 +1,191 @@
+"""VCF input: plain text, bgzipped text (.vcf.gz) and BCF.
+
+Plain and gzipped VCF text is parsed by pandas directly. BCF, and region
+queries on a VCF with a tabix (.tbi) or CSI (.csi) index, are read
+through pysam (optional). For an indexed VCF, map_vcf_regions applies a
+chunk function per chromosome on a process pool, so that only the
+chromosomes of interest are read, and in parallel.
+"""
+import io
+import os
+import csv
+import gzip
+import multiprocessing
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+
+VCF_FORMATS = ('vcf', 'vcf.gz', 'bcf')
+INDEX_SUFFIXES = ('.tbi', '.csi')
+REGION_CHUNKSIZE = 100000  # records per chunk in region reads
+GZIP_MAGIC = b'\x1f\x8b'
+BCF_MAGIC = b'BCF'
+
+
+def vcf_format(vcf_path):
+    """'vcf', 'vcf.gz' (gzip or bgzip) or 'bcf' (compressed or not), from the file contents."""
+    with open(vcf_path, 'rb') as f:
+        magic = f.read(3)
+    if magic[:2] != GZIP_MAGIC:
+        return 'bcf' if magic == BCF_MAGIC else 'vcf'
+    with gzip.open(vcf_path, 'rb') as f:
+        return 'bcf' if f.read(3) == BCF_MAGIC else 'vcf.gz'
+
+
+def find_index(vcf_path):
+    """Path of the tabix or CSI index of vcf_path, or None."""
+    for suffix in INDEX_SUFFIXES:
+        if os.path.exists(vcf_path + suffix):
+            return vcf_path + suffix
+    return None
+
+
+def read_vcf_header(vcf_path):
+    """Return '##' meta-information lines and column names from the header line."""
+    if vcf_format(vcf_path) == 'bcf':
+        pysam = _import_pysam()
+        with pysam.VariantFile(vcf_path) as vf:
+            lines = str(vf.header).rstrip('\n').split('\n')
+        return lines[:-1], lines[-1].split('\t')
+    meta = []
+    with _open_text(vcf_path) as file:
+        for line in file:
+            if line.startswith('##'):
+                meta.append(line.rstrip('\n'))
+            else:
+                columns = line.rstrip('\n').split('\t')
+                break
+        else:
+            raise ValueError("No header line found in VCF: {}".format(vcf_path))
+    return meta, columns
+
+
+def read_vcf_chunks(vcf_path, skip, chunksize=None, region=None):
+    """Yield VCF records as dataframes of strings, with header as column names.
+
+    Args:
+        vcf_path (str): full or relative path of a VCF, .vcf.gz or BCF.
+        skip (int): number of '##' meta-information lines to skip.
+        chunksize (int): records per dataframe. If None, yield a single
+            dataframe with all records.
+        region (str): [optional] chromosome or 'chrom:start-end' to read,
+            using the VCF index. Requires pysam.
+    """
+    import pandas as pd
+    fmt = vcf_format(vcf_path)
+    if region is None and fmt != 'bcf':
+        reader = pd.read_csv(vcf_path, sep='\t', skiprows=skip, dtype=str, na_filter=False,
+                             quoting=csv.QUOTE_NONE, chunksize=chunksize,
+                             compression='gzip' if fmt == 'vcf.gz' else None)
+        if chunksize is None:
+            yield reader
+            return
+        with reader:
+            for df in reader:
+                yield df
+        return
+    _, columns = read_vcf_header(vcf_path)
+    lines = []
+    for line in _iter_record_lines(vcf_path, fmt, region):
+        lines.append(line)
+        if len(lines) == chunksize:
+            yield _parse_lines(lines, columns)
+            lines = []
+    if lines or chunksize is None:
+        yield _parse_lines(lines, columns)
+
+
+def indexed_chroms(vcf_path, chroms=None):
+    """Chromosomes in the index of vcf_path, in index order, optionally restricted to chroms.
+
+    Returns None if vcf_path has no index, or pysam is not installed, in
+    which case the file can only be read sequentially.
+    """
+    index_path = find_index(vcf_path)
+    if index_path is None:
+        return None
+    try:
+        pysam = _import_pysam()
+    except ImportError:
+        return None
+    if vcf_format(vcf_path) == 'bcf':
+        with pysam.VariantFile(vcf_path, index_filename=index_path) as vf:
+            contigs = list(vf.index)
+    else:
+        with pysam.TabixFile(vcf_path, index=index_path) as tbx:
+            contigs = list(tbx.contigs)
+    if chroms is not None:
+        chroms = set(chroms)
+        contigs = [c for c in contigs if c in chroms]
+    return contigs
+
+
+def map_vcf_regions(func, vcf_path, regions, n_workers=1, chunksize=REGION_CHUNKSIZE):
+    """Apply func to each chunk of records in each region, yielding results in region order.
+
+    Args:
+        func (callable): takes a dataframe from read_vcf_chunks. Its result
+            is returned from the worker process, so should be small (e.g.
+            filtered records) and picklable, as should func itself.
+        regions (list): chromosomes or 'chrom:start-end' strings, see indexed_chroms.
+        n_workers (int): worker processes, one region at a time each. With 1,
+            regions are read in this process. Workers are spawned rather than
+            forked, as this is called from stage threads while other threads
+            (e.g. subprocess monitors) are running.
+    """
+    if n_workers <= 1:
+        for region in regions:
+            for df in read_vcf_chunks(vcf_path, None, chunksize=chunksize, region=region):
+                yield func(df)
+        return
+    print("Reading {} regions of {} with {} workers.".format(len(regions), vcf_path, n_workers))
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        for results in pool.map(_map_region, repeat(func), repeat(vcf_path), regions, repeat(chunksize)):
+            for res in results:
+                yield res
+
+
+def _map_region(func, vcf_path, region, chunksize):
+    return [func(df) for df in read_vcf_chunks(vcf_path, None, chunksize=chunksize, region=region)]
+
+
+def _iter_record_lines(vcf_path, fmt, region=None):
+    """Yield record lines, with trailing newlines, read through pysam."""
+    pysam = _import_pysam()
+    index_path = find_index(vcf_path)
+    if region is not None and index_path is None:
+        raise ValueError("Region reads need a tabix or CSI index: {}".format(vcf_path))
+    if fmt == 'bcf':
+        with pysam.VariantFile(vcf_path, index_filename=index_path) as vf:
+            records = vf.fetch(region) if region is not None else vf
+            for rec in records:
+                yield str(rec)
+    elif fmt == 'vcf.gz':
+        with pysam.TabixFile(vcf_path, index=index_path) as tbx:
+            for line in tbx.fetch(region):
+                yield line + '\n'
+    else:
+        raise ValueError("Region reads need a bgzipped VCF or BCF: {}".format(vcf_path))
+
+
+def _parse_lines(lines, columns):
+    """Record lines to a dataframe of strings, parsed as in read_vcf_chunks."""
+    import pandas as pd
+    if not lines:
+        return pd.DataFrame({c: pd.Series([], dtype=object) for c in columns}, columns=columns)
+    return pd.read_csv(io.StringIO(''.join(lines)), sep='\t', header=None, names=columns, dtype=str,
+                       na_filter=False, quoting=csv.QUOTE_NONE)
+
+
+def _open_text(vcf_path):
+    if vcf_format(vcf_path) == 'vcf.gz':
+        return gzip.open(vcf_path, 'rt')
+    return open(vcf_path, 'r')
+
+
+def _import_pysam():
+    try:
+        import pysam
+    except ImportError:
+        raise ImportError("Reading BCF or indexed VCF regions requires pysam "
+                          "(conda install -c bioconda pysam, or pip install pysam).")
+    return pysam
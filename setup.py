@@ -14,6 +14,11 @@ setup(name='cnv_pipeline',
       install_requires=[
           'pandas>=0.22', 'matplotlib', 'numpy', 'pyarrow',
       ],
-      entry_points={'console_scripts': ['run_cnv = cnv_pipeline.pipeline:main']},
+      extras_require={'pysam': ['pysam']},
+      entry_points={'console_scripts': ['run_cnv = cnv_pipeline.pipeline:main',
+                                        'run_cnv_cohort = cnv_pipeline.cohort:main',
+                                        'cnv_cache = cnv_pipeline.stage_cache:main',
+                                        'cnv_coverage = cnv_pipeline.coverage_store:main',
+                                        'cnv_report = cnv_pipeline.run_report:main']},
       zip_safe=False,
       )
@@ -0,0 +1,73 @@
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+from cnv_pipeline.baf_from_vcf import BafWriter, build_saas_table, empty_saas_table, SAAS_SCHEMA
+
+BAF_COLUMNS = ['chrom', 'SNP_loc', 'control_BAF', 'tumor_BAF', 'control_doc', 'tumor_doc']
+
+
+def saas_table(n_records, chrom='1'):
+    """saasCNV table as built by build_saas_table, with n_records records."""
+    df = pd.DataFrame({'#CHROM': [chrom] * n_records,
+                       'POS': [str(100 + i) for i in range(n_records)],
+                       'ID': ['.'] * n_records, 'REF': ['A'] * n_records, 'ALT': ['G'] * n_records,
+                       'QUAL': ['50.5'] * n_records}, dtype=object)
+    mq = pd.Series([60.0] * n_records, dtype=float)
+    gt = pd.Series(['0/1'] * n_records, dtype=object)
+    depths = pd.Series([10] * n_records, dtype='int64')
+    return build_saas_table(df, mq, (gt, depths, depths), (gt, depths, depths * 2),
+                            mq_cutoff=30, chrom_list=[chrom])
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_empty_first_chunk(tmp_path, compact):
+    baf_path, parquet_path = str(tmp_path / 'baf.txt'), str(tmp_path / 'saas.parquet')
+    with BafWriter(baf_path, parquet_path, compact=compact) as writer:
+        writer.write(saas_table(0))
+        writer.write(saas_table(3))
+        writer.write(saas_table(0, chrom='2'))
+        writer.write(saas_table(2, chrom='2'))
+    df = pq.read_table(parquet_path).to_pandas()
+    assert len(df) == 5
+    assert list(df.columns) == SAAS_SCHEMA.names
+    assert df.CHROM.astype(str).tolist() == ['1'] * 3 + ['2'] * 2
+    baf = pd.read_csv(baf_path, sep='\t', dtype={'chrom': str})
+    assert list(baf.columns) == BAF_COLUMNS
+    assert baf.chrom.tolist() == ['1'] * 3 + ['2'] * 2
+    assert baf.tumor_BAF.tolist() == [0.5] * 5
+
+
+def test_standard_schema_is_fixed(tmp_path):
+    parquet_path = str(tmp_path / 'saas.parquet')
+    with BafWriter(str(tmp_path / 'baf.txt'), parquet_path) as writer:
+        writer.write(saas_table(0))
+    assert pq.read_schema(parquet_path).remove_metadata().equals(SAAS_SCHEMA)
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_zero_records(tmp_path, compact):
+    baf_path, parquet_path = str(tmp_path / 'baf.txt'), str(tmp_path / 'saas.parquet')
+    with BafWriter(baf_path, parquet_path, compact=compact):
+        pass
+    assert len(pq.read_table(parquet_path)) == 0
+    with open(baf_path) as f:
+        assert f.read() == '\t'.join(BAF_COLUMNS) + '\n'
+
+
+def test_empty_saas_table_columns():
+    df = empty_saas_table()
+    assert list(df.columns) == SAAS_SCHEMA.names
+    assert len(df) == 0
+
+
+@pytest.mark.parametrize('compact', [False, True])
+@pytest.mark.parametrize('n_chunks', [0, 2])
+def test_error_removes_outputs(tmp_path, compact, n_chunks):
+    baf_path, parquet_path = str(tmp_path / 'baf.txt'), str(tmp_path / 'saas.parquet')
+    with pytest.raises(RuntimeError):
+        with BafWriter(baf_path, parquet_path, compact=compact) as writer:
+            for _ in range(n_chunks):
+                writer.write(saas_table(3))
+            raise RuntimeError("truncated VCF")
+    assert list(tmp_path.iterdir()) == []
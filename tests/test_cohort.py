@@ -0,0 +1,53 @@
+import os
+import subprocess
+
+import pandas as pd
+
+from cnv_pipeline import cohort
+from cnv_pipeline.cohort import run_cohort
+
+
+def write_sample_sheet(path, tumor_ids):
+    rows = [dict(tumor_id=t, normal_id='N', vcf='pair.vcf', tumor_bam=t + '.bam', normal_bam='N.bam')
+            for t in tumor_ids]
+    pd.DataFrame(rows).to_csv(path, sep='\t', index=False)
+    return path
+
+
+def run_cnv_with_tools(tumor_id, **kwargs):
+    print("python output")
+    subprocess.run(['sh', '-c', 'echo tool stdout; echo tool stderr >&2'], check=True)
+
+
+def run_cnv_killed(tumor_id, **kwargs):
+    if tumor_id == 'T2':
+        os._exit(1)
+
+
+def test_tool_output_in_pair_log(tmp_path, monkeypatch):
+    monkeypatch.setattr(cohort, 'run_cnv', run_cnv_with_tools)  # inherited by forked workers
+    sample_file = write_sample_sheet(str(tmp_path / 'samples.txt'), ['T1'])
+    summary = run_cohort(sample_file, out_dir=str(tmp_path))
+    assert summary.status.tolist() == ['success']
+    with open(summary.log_path[0]) as f:
+        assert f.read().split('\n')[:3] == ['python output', 'tool stdout', 'tool stderr']
+
+
+def test_dead_worker_fails_only_its_pair(tmp_path, monkeypatch):
+    monkeypatch.setattr(cohort, 'run_cnv', run_cnv_killed)
+    tumor_ids = ['T1', 'T2', 'T3', 'T4', 'T5']
+    sample_file = write_sample_sheet(str(tmp_path / 'samples.txt'), tumor_ids)
+    summary = run_cohort(sample_file, out_dir=str(tmp_path), n_workers=1)
+    saved = pd.read_csv(str(tmp_path / 'cohort_summary.txt'), sep='\t')
+    assert saved.tumor_id.tolist() == tumor_ids
+    assert summary.status.tolist() == ['success', 'failed', 'success', 'success', 'success']
+    assert summary.error[1].startswith('BrokenProcessPool')
+
+
+def test_dead_worker_with_concurrent_pairs(tmp_path, monkeypatch):
+    monkeypatch.setattr(cohort, 'run_cnv', run_cnv_killed)
+    tumor_ids = ['T1', 'T2', 'T3', 'T4', 'T5']
+    sample_file = write_sample_sheet(str(tmp_path / 'samples.txt'), tumor_ids)
+    summary = run_cohort(sample_file, out_dir=str(tmp_path), n_workers=2)
+    failed = summary.tumor_id[summary.status == 'failed'].tolist()
+    assert 'T2' in failed and len(failed) <= 2  # at most the pair running alongside it
@@ -0,0 +1,83 @@
+import os
+
+import pandas as pd
+import pytest
+import pyarrow.parquet as pq
+
+from cnv_pipeline import cohort_baf
+from cnv_pipeline.baf_from_vcf import baf_from_vcf
+from cnv_pipeline.cohort_baf import extract_pairs, PairOutput
+from cnv_pipeline.trim_vcf import iter_selected_snps
+from cnv_pipeline.vcf_io import read_vcf_chunks
+
+HEADER = ['##fileformat=VCFv4.2',
+          '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+          '##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths">',
+          '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth">',
+          '##FORMAT=<ID=GQ,Number=1,Type=Integer,Description="Genotype quality">',
+          '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tN\tT1\tT2\tT3']
+GOOD = '0/1:15,15:30:99'
+LOW_DP = '0/1:3,2:5:99'
+# T3 has no passing records in the first chunk (2 records); T2 has a '.' AD in the second.
+RECORDS = [('1', '100', 'A', 'G', GOOD, GOOD, LOW_DP),
+           ('1', '200', 'C', 'T', GOOD, GOOD, LOW_DP),
+           ('1', '300', 'G', 'A', GOOD, '0/1:.:30:99', GOOD),
+           ('2', '400', 'T', 'C', GOOD, GOOD, GOOD)]
+
+
+def write_vcf(path):
+    with open(path, 'w') as f:
+        f.write('\n'.join(HEADER) + '\n')
+        for chrom, pos, ref, alt, t1, t2, t3 in RECORDS:
+            f.write('\t'.join([chrom, pos, '.', ref, alt, '50', 'PASS', 'MQ=60', 'GT:AD:DP:GQ',
+                               '0/1:10,10:20:99', t1, t2, t3]) + '\n')
+
+
+def pair_output(tmp_path, tumor_id):
+    sample_dir = tmp_path / tumor_id
+    sample_dir.mkdir()
+    return PairOutput(tumor_id, 'N', str(sample_dir / 'baf.txt'), str(sample_dir / 'saas.parquet'))
+
+
+def test_failed_pair_does_not_fail_others(tmp_path):
+    vcf_path = str(tmp_path / 'cohort.vcf')
+    write_vcf(vcf_path)
+    pairs = [pair_output(tmp_path, t) for t in ('T1', 'T2', 'T3')]
+    failed = extract_pairs(vcf_path, pairs, chroms_str='1,2', chunksize=2)
+    assert list(failed) == [pairs[1]]
+    assert failed[pairs[1]].startswith('ValueError')
+    assert not os.path.exists(pairs[1].baf_path) and not os.path.exists(pairs[1].parquet_path)
+    for pair, positions in ((pairs[0], [100, 200, 300, 400]), (pairs[2], [300, 400])):
+        assert pq.read_table(pair.parquet_path).column('POS').to_pylist() == positions
+        assert pd.read_csv(pair.baf_path, sep='\t').SNP_loc.tolist() == positions
+
+
+def test_matches_per_pair_extraction(tmp_path):
+    vcf_path = str(tmp_path / 'cohort.vcf')
+    write_vcf(vcf_path)
+    pairs = [pair_output(tmp_path, t) for t in ('T1', 'T3')]
+    assert extract_pairs(vcf_path, pairs, chroms_str='1,2', chunksize=2) == {}
+    for pair in pairs:
+        baf_path, parquet_path = str(tmp_path / 'single_baf.txt'), str(tmp_path / 'single.parquet')
+        chunks = iter_selected_snps(vcf_path, tumor_id=pair.tumor_id, normal_id='N', chunksize=2)
+        baf_from_vcf(None, baf_path, parquet_path=parquet_path, tumor_id=pair.tumor_id, normal_id='N',
+                     chroms_str='1,2', vcf_chunks=chunks)
+        assert pq.read_table(pair.parquet_path).equals(pq.read_table(parquet_path))
+        with open(pair.baf_path) as a, open(baf_path) as b:
+            assert a.read() == b.read()
+
+
+def test_vcf_read_error_leaves_no_outputs(tmp_path, monkeypatch):
+    vcf_path = str(tmp_path / 'cohort.vcf')
+    write_vcf(vcf_path)
+
+    def read_then_fail(*args, **kwargs):
+        yield next(read_vcf_chunks(*args, **kwargs))  # some records are written before the error
+        raise IOError("truncated VCF")
+
+    monkeypatch.setattr(cohort_baf, 'read_vcf_chunks', read_then_fail)
+    pairs = [pair_output(tmp_path, t) for t in ('T1', 'T3')]
+    with pytest.raises(IOError):
+        extract_pairs(vcf_path, pairs, chroms_str='1,2', chunksize=2)
+    for pair in pairs:
+        assert not os.path.exists(pair.baf_path) and not os.path.exists(pair.parquet_path)
@@ -0,0 +1,60 @@
+import pysam
+
+from cnv_pipeline.build_coverage_files import build_coverage_files
+from cnv_pipeline.coverage_store import CoverageStore
+
+TARGETS = [('1', 100, 200), ('1', 250, 300), ('2', 50, 120)]
+
+
+def write_bam(path, reads):
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+              'SQ': [{'SN': '1', 'LN': 1000}, {'SN': '2', 'LN': 1000}]}
+    with pysam.AlignmentFile(path, 'wb', header=header) as bam:
+        for i, (tid, start, length) in enumerate(reads):
+            read = pysam.AlignedSegment(bam.header)
+            read.query_name = 'r{}'.format(i)
+            read.reference_id, read.reference_start = tid, start
+            read.cigarstring = '{}M'.format(length)
+            read.query_sequence = 'A' * length
+            read.mapping_quality = 60
+            bam.write(read)
+    pysam.index(path)
+    return path
+
+
+def expected_depth(reads, chrom, start, end):
+    tid = int(chrom) - 1
+    return [sum(1 for t, s, n in reads if t == tid and s <= pos < s + n) for pos in range(start, end)]
+
+
+def test_pysam_backend_parallel(tmp_path):
+    reads = {'tumor': [(0, 90, 50), (0, 120, 50), (0, 260, 30), (1, 40, 100)],
+             'normal': [(0, 150, 120), (1, 100, 10)]}
+    bams = {which: write_bam(str(tmp_path / (which + '.bam')), r) for which, r in reads.items()}
+    bed_path = tmp_path / 'targets.bed'
+    bed_path.write_text(''.join('{}\t{}\t{}\n'.format(*t) for t in TARGETS))
+    stores = {which: str(tmp_path / (which + '_cov.cov')) for which in reads}
+    build_coverage_files(tumor_bam=bams['tumor'], normal_bam=bams['normal'],
+                         tumor_cov_path=stores['tumor'], normal_cov_path=stores['normal'],
+                         target_bed_path=str(bed_path), parallel=True, backend='pysam')
+    for which, store_dir in stores.items():
+        store = CoverageStore(store_dir)
+        for i, target in enumerate(TARGETS):
+            assert store.target_depth(i).tolist() == expected_depth(reads[which], *target)
+
+
+def test_overwrite_replaces_store(tmp_path):
+    reads = [(0, 90, 50)]
+    bam = write_bam(str(tmp_path / 'tumor.bam'), reads)
+    bed_path = tmp_path / 'targets.bed'
+    bed_path.write_text(''.join('{}\t{}\t{}\n'.format(*t) for t in TARGETS))
+    stores = [str(tmp_path / 'tumor_cov.cov'), str(tmp_path / 'normal_cov.cov')]
+    kwargs = dict(tumor_bam=bam, normal_bam=bam, tumor_cov_path=stores[0], normal_cov_path=stores[1],
+                  target_bed_path=str(bed_path), parallel=False, backend='pysam')
+    build_coverage_files(**kwargs)
+    write_bam(bam, reads + [(0, 100, 10)])
+    build_coverage_files(**kwargs)  # existing stores are kept without overwrite
+    assert CoverageStore(stores[0]).target_depth(0).tolist() == expected_depth(reads, *TARGETS[0])
+    build_coverage_files(overwrite=True, **kwargs)
+    assert CoverageStore(stores[0]).target_depth(0).tolist() == expected_depth(reads + [(0, 100, 10)],
+                                                                             *TARGETS[0])
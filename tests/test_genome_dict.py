@@ -0,0 +1,69 @@
+import os
+
+import pytest
+
+from cnv_pipeline import genome_dict
+from cnv_pipeline.genome_dict import get_genome_dict, cached_genome_dict, file_key
+from cnv_pipeline.plot_chr_axis import GenomeInfo, HG19_CHROM_LENGTHS, HG19_P_LENGTHS
+
+
+def write_fai(path, genome):
+    with open(path, 'w') as f:
+        for chrom, length in genome:
+            f.write('{}\t{}\t0\t60\t61\n'.format(chrom, length))
+
+
+def test_reference_dict_cached_without_reading_index(tmp_path, monkeypatch):
+    ref = tmp_path / 'ref.fa'
+    ref.write_text('')
+    write_fai(str(ref) + '.fai', [('1', 1000), ('2', 500)])
+    cache_dir = str(tmp_path / 'cache')
+    assert get_genome_dict(ref_fasta=str(ref), cache_dir=cache_dir) == [('1', 1000), ('2', 500)]
+    genome_dict._cached_genome_dict.cache_clear()
+    reads = []
+    real_read = genome_dict.read_genome_dict
+    monkeypatch.setattr(genome_dict, 'read_genome_dict', lambda path: reads.append(path) or real_read(path))
+    assert get_genome_dict(ref_fasta=str(ref), cache_dir=cache_dir) == [('1', 1000), ('2', 500)]
+    assert reads == [os.path.join(cache_dir, file_key(os.path.realpath(str(ref) + '.fai')) + '.genome.txt')]
+
+
+def test_bam_header_dict_cached(tmp_path, monkeypatch):
+    bam = tmp_path / 'normal.bam'
+    bam.write_bytes(b'not read twice')
+    headers = []
+
+    def header_lines(path):
+        headers.append(path)
+        return ['@HD\tVN:1.6', '@SQ\tSN:chr1\tLN:1000', '@SQ\tSN:chr2\tLN:500']
+
+    monkeypatch.setattr(genome_dict, '_alignment_header_lines', header_lines)
+    cache_dir = str(tmp_path / 'cache')
+    for _ in range(2):
+        assert get_genome_dict(bam_path=str(bam), cache_dir=cache_dir) == [('chr1', 1000), ('chr2', 500)]
+        genome_dict._cached_genome_dict.cache_clear()
+    assert len(headers) == 1
+
+
+def test_changed_file_gets_new_key(tmp_path):
+    path = tmp_path / 'ref.fa.fai'
+    write_fai(str(path), [('1', 1000)])
+    key = file_key(str(path))
+    write_fai(str(path), [('1', 1000), ('2', 500)])
+    os.utime(str(path), ns=(1, 1))
+    assert file_key(str(path)) != key
+    assert cached_genome_dict(str(path), cache_dir=str(tmp_path / 'cache')) == [('1', 1000), ('2', 500)]
+
+
+@pytest.mark.parametrize('prefix', ['', 'chr'])
+def test_hg19_genome_keeps_centromeres(prefix):
+    genome = [(prefix + c, n) for c, n in HG19_CHROM_LENGTHS]
+    default, given = GenomeInfo(), GenomeInfo(genome=genome)
+    assert given.size_df.centro.tolist() == default.size_df.centro.tolist()
+    assert given.p_len_dict[prefix + '1'] == HG19_P_LENGTHS['1']
+
+
+def test_other_genome_uses_midpoints():
+    genome = [('1', 248956422), ('2', 242193529)]  # hg38 lengths
+    info = GenomeInfo(genome=genome)
+    assert info.p_len_dict == {}
+    assert info.size_df.centro.tolist() == [124478211, 248956422 + 121096764]
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cnv_pipeline.intervals import count_overlaps, overlaps_any
+
+
+def brute_force(a, b):
+    return np.array([sum(1 for bc, bs, be in b if bc == ac and bs < ae and be > as_) for ac, as_, ae in a],
+                    dtype=np.int64)
+
+
+def random_intervals(rng, n, chroms):
+    chrom = rng.choice(chroms, n)
+    start = rng.randint(0, 1000, n)
+    return list(zip(chrom, start, start + rng.randint(1, 100, n)))
+
+
+def columns(intervals):
+    chrom, start, end = zip(*intervals) if intervals else ((), (), ())
+    return list(chrom), list(start), list(end)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_matches_brute_force(seed):
+    rng = np.random.RandomState(seed)
+    a = random_intervals(rng, 200, ['1', '2', 'X'])
+    b = random_intervals(rng, 100, ['1', '2', 'Y'])  # no X in b, no Y in a
+    counts = count_overlaps(*columns(a), *columns(b))
+    np.testing.assert_array_equal(counts, brute_force(a, b))
+    np.testing.assert_array_equal(overlaps_any(*columns(a), *columns(b)), brute_force(a, b) > 0)
+
+
+def test_touching_intervals_do_not_overlap():
+    a = [('1', 10, 20), ('1', 10, 20), ('1', 10, 20)]
+    b = [('1', 0, 10), ('1', 20, 30), ('1', 19, 21)]  # end at a.start, start at a.end, one base inside
+    assert count_overlaps(*columns(a), *columns(b)).tolist() == [1, 1, 1]
+    assert count_overlaps(*columns(a[:1]), *columns(b[:2])).tolist() == [0]
+
+
+def test_chromosomes_missing_from_other_set():
+    a = [('1', 0, 100), ('2', 0, 100)]
+    b = [('3', 0, 100), ('1', 50, 60)]
+    assert count_overlaps(*columns(a), *columns(b)).tolist() == [1, 0]
+
+
+def test_categorical_chromosomes():
+    a_chrom = pd.Categorical(['1', '2'], categories=['1', '2', 'X'])
+    assert count_overlaps(a_chrom, [0, 0], [10, 10], ['2'], [5], [6]).tolist() == [0, 1]
+
+
+@pytest.mark.parametrize('a, b', [([], [('1', 0, 10)]), ([('1', 0, 10)], []), ([], [])])
+def test_empty_inputs(a, b):
+    counts = count_overlaps(*columns(a), *columns(b))
+    assert counts.dtype == np.int64 and counts.tolist() == [0] * len(a)
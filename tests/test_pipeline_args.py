@@ -0,0 +1,51 @@
+import argparse
+
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+from cnv_pipeline.pipeline import (add_run_arguments, get_run_kwargs, _fused_trim_baf,
+                                   TrimBackendError, RefFastaNotFoundError)
+
+
+def run_kwargs(*argv):
+    parser = argparse.ArgumentParser()
+    add_run_arguments(parser)
+    return get_run_kwargs(parser.parse_args(['--saas_only'] + list(argv)))
+
+
+def test_default_backend_is_gatk():
+    assert run_kwargs('-R', 'ref.fa')['trim_backend'] == 'gatk'
+    with pytest.raises(RefFastaNotFoundError):
+        run_kwargs()
+
+
+def test_fused_uses_python_backend():
+    kw = run_kwargs('--fused')
+    assert kw['fused'] and kw['trim_backend'] == 'python'
+    assert run_kwargs('--fused', '--trim_backend', 'python')['trim_backend'] == 'python'
+
+
+def test_fused_rejects_gatk_backend():
+    with pytest.raises(TrimBackendError):
+        run_kwargs('--fused', '--trim_backend', 'gatk', '-R', 'ref.fa')
+
+
+def test_fused_with_empty_first_chunks(tmp_path):
+    vcf_path = tmp_path / 'pair.vcf'
+    lines = ['##fileformat=VCFv4.2', '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tN\tT']
+    for pos in range(1, 6):  # only the last record passes: first chunks have no records
+        normal = '0/1:10,10:20:99' if pos == 5 else '0/0:20,0:20:99'
+        lines.append('\t'.join(['1', str(pos), '.', 'A', 'G', '50', 'PASS', 'MQ=60', 'GT:AD:DP:GQ',
+                                normal, '0/1:15,15:30:99']))
+    vcf_path.write_text('\n'.join(lines) + '\n')
+    baf_path, parquet_path = str(tmp_path / 'baf.txt'), str(tmp_path / 'saas.parquet')
+    _fused_trim_baf(str(vcf_path), baf_path, parquet_path, tumor_id='T', normal_id='N', chroms='1',
+                    chunksize=2)
+    assert pq.read_table(parquet_path).column('POS').to_pylist() == [5]
+    assert pd.read_csv(baf_path, sep='\t').SNP_loc.tolist() == [5]
+
+
+def test_loh_density_flag():
+    assert not run_kwargs('-R', 'ref.fa')['loh_density']
+    assert run_kwargs('-R', 'ref.fa', '--loh_density')['loh_density']
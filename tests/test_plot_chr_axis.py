@@ -0,0 +1,25 @@
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+from cnv_pipeline.plot_chr_axis import plot_chr_axis
+
+
+def snps(n):
+    rng = np.random.RandomState(0)
+    return pd.DataFrame({'chrom': rng.choice(['1', '2'], n), 'pos': rng.randint(1, 10 ** 8, n),
+                         'baf': rng.uniform(size=n)})
+
+
+def test_markers_by_default():
+    ax = plot_chr_axis('chrom', 'pos', 'baf', data=snps(300000), ylim=(0, 1))
+    assert len(ax.lines) == 1 and not ax.images
+    plt.close('all')
+
+
+def test_density_on_request():
+    ax = plot_chr_axis('chrom', 'pos', 'baf', data=snps(1000), ylim=(0, 1), density=True)
+    assert len(ax.images) == 1 and not ax.lines
+    plt.close('all')
@@ -0,0 +1,20 @@
+from cnv_pipeline.stage_cache import StageCache
+from cnv_pipeline.stages import Stage
+
+
+def record_stage(cache, tmp_path, name):
+    out_path = tmp_path / (name + '.txt')
+    out_path.write_text(name)
+    stage = Stage(name, None, outputs=[str(out_path)])
+    cache.record(stage, cache.stage_key(stage))
+    return out_path
+
+
+def test_clear_returns_removed_stages(tmp_path):
+    cache = StageCache(str(tmp_path))
+    record_stage(cache, tmp_path, 'trim')
+    out_path = record_stage(cache, tmp_path, 'baf')
+    assert cache.clear(['baf', 'saas'], remove_outputs=True) == ['baf']
+    assert not out_path.exists()
+    assert cache.clear(['baf']) == []
+    assert StageCache(str(tmp_path)).clear() == ['trim']
@@ -0,0 +1,172 @@
+import os
+import sys
+import time
+import threading
+import subprocess
+
+import pytest
+
+from cnv_pipeline import run_report, supervisor
+from cnv_pipeline.run_report import RunReport, CommandError, run_command
+from cnv_pipeline.supervisor import run_tool, tool_policies, is_transient, parse_tool_timeouts
+
+
+def test_timeout_kills_tool(tmp_path):
+    report = RunReport(str(tmp_path))
+    t0 = time.perf_counter()
+    with tool_policies(timeouts={'samtools': 0.5}, retries=0), report.stage('genome'):
+        with pytest.raises(CommandError) as info:
+            run_tool('samtools', ['sleep', '30'])
+    assert time.perf_counter() - t0 < 5
+    e = info.value
+    assert e.timed_out and not e.cancelled
+    assert e.timeout == 0.5
+    assert e.returncode < 0
+    assert e.stage == 'genome'
+    assert "timed out after 0.5s" in str(e)
+    assert report.subprocesses[0]['timed_out']
+
+
+def test_transient_failure_retried_with_backoff(tmp_path, monkeypatch):
+    delays = []
+    monkeypatch.setattr(supervisor.time, 'sleep', delays.append)
+    counter = tmp_path / 'attempts'
+    script = ('n=$(cat {0} 2>/dev/null || echo 0); n=$((n+1)); echo $n > {0}; '
+              '[ $n -ge 3 ] && exit 0; echo "Resource temporarily unavailable" >&2; exit 1').format(counter)
+    report = RunReport(str(tmp_path))
+    with report.stage('coverage'):
+        run_tool('bedtools', ['sh', '-c', script])
+    assert counter.read_text().strip() == '3'
+    backoff = supervisor.TOOL_POLICIES['bedtools'].backoff
+    assert delays == [backoff, 2 * backoff]
+    with open(os.path.join(str(tmp_path), 'logs', 'coverage.bedtools.log')) as f:
+        log = f.read()
+    assert log.count('### attempt') == 3
+
+
+def test_retries_exhausted(tmp_path, monkeypatch):
+    monkeypatch.setattr(supervisor.time, 'sleep', lambda seconds: None)
+    report = RunReport(str(tmp_path))
+    with tool_policies(retries=1), report.stage('coverage'):
+        with pytest.raises(CommandError) as info:
+            run_tool('bedtools', ['sh', '-c', 'echo "Stale file handle" >&2; exit 2'])
+    assert info.value.attempts == 2
+    assert "after 2 attempts" in str(info.value)
+
+
+def test_permanent_failure_not_retried(tmp_path, monkeypatch):
+    monkeypatch.setattr(supervisor.time, 'sleep', lambda seconds: pytest.fail("retried"))
+    report = RunReport(str(tmp_path))
+    with report.stage('trim'):
+        with pytest.raises(CommandError) as info:
+            run_tool('gatk', ['sh', '-c', 'echo "A USER ERROR has occurred" >&2; exit 3'])
+    e = info.value
+    assert e.returncode == 3
+    assert e.attempts == 1
+    assert e.cmd == ['sh', '-c', 'echo "A USER ERROR has occurred" >&2; exit 3']
+    assert e.stage == 'trim'
+    assert e.log_path == os.path.join(str(tmp_path), 'logs', 'trim.gatk.log')
+    assert 'A USER ERROR has occurred' in e.stderr_tail
+    assert e.to_dict() == dict(cmd=e.cmd, exit_status=3, stage='trim', timed_out=False, cancelled=False,
+                               attempts=1, log_path=e.log_path, stderr_tail=e.stderr_tail)
+    assert str(e).startswith("Command failed with exit status 3: sh -c")
+
+
+def test_is_transient():
+    policy = supervisor.TOOL_POLICIES['samtools']
+    assert is_transient(CommandError(-9, ['x']), policy)
+    assert not is_transient(CommandError(-9, ['x'], cancelled=True), policy)
+    assert is_transient(CommandError(-15, ['x'], timed_out=True), policy)
+    assert not is_transient(CommandError(-15, ['x'], timed_out=True), supervisor.TOOL_POLICIES['gatk'])
+    assert not is_transient(CommandError(1, ['x'], stderr_tail='bad input'), policy)
+    assert is_transient(CommandError(1, ['x'], stderr_tail='Cannot allocate memory'), policy)
+
+
+def test_parse_tool_timeouts():
+    assert parse_tool_timeouts(['saas=3600', 'adtex=none']) == {'saas': 3600.0, 'adtex': None}
+    for bad in (['saas=0'], ['nosuchtool=5'], ['saas=soon']):
+        with pytest.raises(ValueError):
+            parse_tool_timeouts(bad)
+
+
+def test_cancel_kills_running_command(tmp_path):
+    report = RunReport(str(tmp_path))
+    errors = []
+
+    def run():
+        with report.stage('adtex'):
+            try:
+                run_tool('adtex', ['sleep', '30'])
+            except CommandError as e:
+                errors.append(e)
+
+    thread = threading.Thread(target=run)
+    t0 = time.perf_counter()
+    thread.start()
+    deadline = time.monotonic() + 5
+    while not report.subprocesses and not run_report._active_commands and time.monotonic() < deadline:
+        time.sleep(0.01)
+    report.cancel()
+    thread.join(10)
+    assert time.perf_counter() - t0 < 5
+    assert errors and errors[0].cancelled and errors[0].attempts == 1
+    assert str(errors[0]).startswith("Command cancelled: sleep 30")
+
+
+def test_cancelled_report_refuses_new_commands(tmp_path):
+    report = RunReport(str(tmp_path))
+    report.cancel()
+    with report.activate():
+        with pytest.raises(CommandError) as info:
+            run_command(['sleep', '30'], check=True)
+    assert info.value.cancelled
+    assert not report.subprocesses
+
+
+def test_cancel_between_start_and_registration(tmp_path, monkeypatch):
+    """A cancel landing just after Popen, before the command is registered, still kills it."""
+    report = RunReport(str(tmp_path))
+    real_popen = subprocess.Popen
+
+    def popen_then_cancel(*args, **kwargs):
+        proc = real_popen(*args, **kwargs)
+        report.cancel()
+        return proc
+
+    monkeypatch.setattr(run_report.subprocess, 'Popen', popen_then_cancel)
+    t0 = time.perf_counter()
+    with report.activate():
+        with pytest.raises(CommandError) as info:
+            run_command(['sleep', '30'], check=True)
+    assert time.perf_counter() - t0 < 5
+    assert info.value.cancelled
+
+
+def test_track_command_cancelled_before_registration(tmp_path):
+    class LateCancelReport(RunReport):
+        """Not cancelled at track_command's first check, cancelled by registration."""
+        checks = 0
+
+        @property
+        def cancelled(self):
+            self.checks += 1
+            return self.checks > 1
+
+        @cancelled.setter
+        def cancelled(self, value):
+            pass
+
+    report = LateCancelReport(str(tmp_path))
+    proc = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'], start_new_session=True)
+    try:
+        with report.activate():
+            with pytest.raises(CommandError) as info:
+                with run_report.track_command(proc):
+                    pytest.fail("tracked block ran after cancel")
+        assert info.value.cancelled
+        assert proc.wait(5) < 0
+        assert proc not in run_report._active_commands
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
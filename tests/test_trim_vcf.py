@@ -0,0 +1,84 @@
+"""Python trim backend against the SelectVariants JEXL selection in trim_vcf.
+
+Each record of data/trim_fixture.vcf (ID names the case) tests one
+predicate of:
+
+    vc.getGenotype(N).isHet()
+    && vc.getGenotype(N).getDP() > min_depth_n - 1
+    && vc.getGenotype(T).getDP() > min_depth_t - 1
+    && vc.getGenotype(N).getGQ() > min_gq_n
+    && 1.0 * vc.getGenotype(N).getAD().1 / vc.getGenotype(N).getDP() > ratio_min
+    && 1.0 * vc.getGenotype(N).getAD().1 / vc.getGenotype(N).getDP() < ratio_max
+
+with --select-type-to-include SNP --restrict-alleles-to BIALLELIC. Missing
+values (GATK's -1 DP/GQ, null AD) fail their predicate.
+"""
+import os
+
+import pytest
+
+from cnv_pipeline.trim_vcf import iter_selected_snps, trim_vcf
+from cnv_pipeline.vcf_io import read_vcf_header, read_vcf_chunks
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'data', 'trim_fixture.vcf')
+# Selected with the defaults: depth minimums 10 (normal) and 20 (tumor), GQ > 90, ratio in (0.4, 0.6)
+SELECTED = ['het', 'het_phased', 'het_alt_first', 'normal_dp_at_min', 'tumor_dp_at_min', 'gq_above_min',
+            'ratio_above_low_edge', 'ratio_below_high_edge', 'lowercase_snp', 'format_reordered']
+
+
+def selected_ids(**kwargs):
+    chunks = iter_selected_snps(FIXTURE, tumor_id='TUMOR', normal_id='NORMAL', **kwargs)
+    return [i for df in chunks for i in df.ID]
+
+
+def all_ids():
+    meta, _ = read_vcf_header(FIXTURE)
+    return list(next(read_vcf_chunks(FIXTURE, len(meta))).ID)
+
+
+def test_fixture_selection():
+    assert selected_ids() == SELECTED
+
+
+@pytest.mark.parametrize('chunksize', [1, 4, 1000])
+def test_selection_independent_of_chunksize(chunksize):
+    assert selected_ids(chunksize=chunksize) == SELECTED
+
+
+@pytest.mark.parametrize('kwargs, dropped', [
+    (dict(min_depth_n=11), ['normal_dp_at_min']),
+    (dict(min_depth_t=21), ['tumor_dp_at_min']),
+    (dict(min_gq_n=91), ['gq_above_min']),
+    (dict(ratio_min=0.45), ['ratio_above_low_edge']),
+    (dict(ratio_max=0.55), ['ratio_below_high_edge']),
+])
+def test_threshold_boundaries(kwargs, dropped):
+    assert selected_ids(**kwargs) == [i for i in SELECTED if i not in dropped]
+
+
+def test_relaxed_thresholds_admit_boundary_records():
+    ids = selected_ids(min_depth_n=9, min_depth_t=19, min_gq_n=89, ratio_min=0.39, ratio_max=0.61)
+    for record_id in ['normal_dp_below_min', 'tumor_dp_below_min', 'gq_at_min',
+                      'ratio_at_low_edge', 'ratio_at_high_edge']:
+        assert record_id in ids
+
+
+def test_rejections_cover_every_other_record():
+    rejected = set(all_ids()) - set(SELECTED)
+    assert rejected == {'hom_ref', 'hom_alt', 'hom_alt_phased', 'no_call', 'haploid',
+                        'normal_dp_below_min', 'tumor_dp_below_min', 'gq_at_min',
+                        'ratio_at_low_edge', 'ratio_at_high_edge', 'ratio_uses_format_dp',
+                        'multiallelic', 'insertion', 'deletion', 'mnp', 'spanning_deletion',
+                        'normal_dp_missing', 'normal_gq_missing', 'normal_ad_missing',
+                        'normal_fields_truncated', 'tumor_dp_missing', 'tumor_no_call',
+                        'format_without_gq'}
+
+
+def test_trim_vcf_python_backend(tmp_path):
+    vcf_out = str(tmp_path / 'snps_trimmed.vcf')
+    trim_vcf(FIXTURE, tumor_id='TUMOR', normal_id='NORMAL', vcf_out=vcf_out, backend='python')
+    meta_in, columns_in = read_vcf_header(FIXTURE)
+    meta_out, columns_out = read_vcf_header(vcf_out)
+    assert meta_out == meta_in
+    assert columns_out == columns_in
+    assert list(next(read_vcf_chunks(vcf_out, len(meta_out))).ID) == SELECTED
@@ -0,0 +1,50 @@
+import gzip
+import shutil
+
+import pysam
+
+from cnv_pipeline.vcf_io import vcf_format, indexed_chroms, map_vcf_regions
+
+LINES = ['##fileformat=VCFv4.2',
+         '##contig=<ID=1,length=1000>',
+         '##contig=<ID=2,length=1000>',
+         '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+         '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tN']
+RECORDS = [('1', 100), ('1', 200), ('1', 300), ('2', 400), ('2', 500)]
+
+
+def write_vcf(path):
+    with open(path, 'w') as f:
+        f.write('\n'.join(LINES) + '\n')
+        for chrom, pos in RECORDS:
+            f.write('\t'.join([chrom, str(pos), '.', 'A', 'G', '50', 'PASS', '.', 'GT', '0/1']) + '\n')
+    return path
+
+
+def write_bcf(vcf_path, bcf_path, mode):
+    with pysam.VariantFile(vcf_path) as vin, pysam.VariantFile(bcf_path, mode, header=vin.header) as vout:
+        for rec in vin:
+            vout.write(rec)
+    return bcf_path
+
+
+def test_vcf_format(tmp_path):
+    vcf_path = write_vcf(str(tmp_path / 'a.vcf'))
+    assert vcf_format(vcf_path) == 'vcf'
+    pysam.tabix_compress(vcf_path, vcf_path + '.gz')
+    assert vcf_format(vcf_path + '.gz') == 'vcf.gz'
+    bcf_path = write_bcf(vcf_path, str(tmp_path / 'a.bcf'), 'wb')
+    assert vcf_format(bcf_path) == 'bcf'
+    with gzip.open(bcf_path, 'rb') as fin, open(str(tmp_path / 'u.bcf'), 'wb') as fout:
+        shutil.copyfileobj(fin, fout)  # uncompressed BCF, as from bcftools view -Ou
+    assert vcf_format(str(tmp_path / 'u.bcf')) == 'bcf'
+
+
+def test_map_vcf_regions_workers(tmp_path):
+    vcf_path = write_vcf(str(tmp_path / 'a.vcf'))
+    gz_path = pysam.tabix_index(vcf_path, preset='vcf', keep_original=True)
+    regions = indexed_chroms(gz_path)
+    assert regions == ['1', '2']
+    serial = list(map_vcf_regions(len, gz_path, regions, n_workers=1, chunksize=2))
+    assert serial == [2, 1, 2]
+    assert list(map_vcf_regions(len, gz_path, regions, n_workers=2, chunksize=2)) == serial